@@ -1,16 +1,39 @@
 # from .new_hooks import pytest_pilot_hookimpl as hookimpl
-from .pytest_marks import EasyMarker
+import sys as _sys
 
-try:
-    # -- Distribution mode --
-    # import from _version.py generated by setuptools_scm during release
-    from ._version import version as __version__
-except ImportError:
-    # -- Source mode --
-    # use setuptools_scm to get the current version from src using git
-    from setuptools_scm import get_version as _gv
-    from os import path as _path
-    __version__ = _gv(_path.join(_path.dirname(__file__), _path.pardir))
+
+def _get_version():
+    try:
+        # -- Distribution mode --
+        # import from _version.py generated by setuptools_scm during release
+        from ._version import version
+    except ImportError:
+        # -- Source mode --
+        # use setuptools_scm to get the current version from src using git
+        from setuptools_scm import get_version as _gv
+        from os import path as _path
+        version = _gv(_path.join(_path.dirname(__file__), _path.pardir))
+    return version
+
+
+if _sys.version_info >= (3, 7):
+    # This package is imported by the pytest plugin entry point in every pytest process, even when no EasyMarker is
+    # used. `EasyMarker` and `__version__` are therefore only imported/computed on first access (PEP 562).
+    def __getattr__(name):
+        if name == 'EasyMarker':
+            from .pytest_marks import EasyMarker as value
+        elif name == '__version__':
+            value = _get_version()
+        else:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(__all__))
+else:
+    from .pytest_marks import EasyMarker
+    __version__ = _get_version()
 
 
 __all__ = [
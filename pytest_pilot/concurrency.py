@@ -0,0 +1,251 @@
+"""
+The `--pilot-concurrency <marker_id>:<query>=<n>` option: with pytest-xdist, at most `n` items marked with the values
+of the query (for example `envid:hw-lab=2`) run at the same time, across all workers.
+
+With the default `load` distribution, the limits are enforced by the controller, see `scheduling.py`: after their
+collection, the workers write the limits of their items in a temporary directory created by the controller and
+shipped to them, and the controller only sends a limited item to a worker when a slot of each of its limits is free.
+Until then, the limited items are held back and the workers keep receiving the other items.
+
+The workers also enforce the limits with cross-process semaphores made of `n` lock files each, in the same directory:
+running an item requires holding a lock on one of the files of each of its semaphores. A worker that can not get
+these locks blocks until it gets them, and the items queued on this worker (limited or not) wait too, since
+pytest-xdist expects each worker to run its items in the order in which they were received. With the `load`
+distribution this only happens when the controller had to send a limited item beyond its limits to avoid a deadlock
+(items with several limits). With the other distributions (`loadscope`, `loadfile`...), the items are assigned to the
+workers without knowing their limits, and workers block as described.
+"""
+import hashlib
+import json
+import os
+import time
+
+try:  # python 3.5+
+    from typing import Dict, Iterable, List, Tuple
+except ImportError:
+    pass
+
+import pytest
+from _pytest.config import UsageError
+
+from .pytest_marks import EasyMarker, _matches_any
+from .selection import MarksReader
+
+try:
+    import fcntl
+
+    def _try_lock(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+except ImportError:
+    # windows
+    import msvcrt
+
+    def _try_lock(fd):
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(fd):
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+# the key of the directory of the lock files in the workerinput
+CONCURRENCY_KEY = "pytest_pilot_concurrency"
+
+# the name of the file where each worker writes the limits of its items {nodeid: [limit indices]}, in this directory
+ITEMS_FILE_NAME = "items-%s.json"
+
+# the time (in seconds) between two attempts to acquire the locks of an item
+POLL_INTERVAL = 0.05
+
+
+class ConcurrencyLimit(object):
+    """
+    A parsed `--pilot-concurrency` option. Use `parse_concurrency` to create it.
+    """
+    __slots__ = 'marker', 'values', 'limit'
+
+    def __init__(self,
+                 marker,  # type: EasyMarker
+                 values,  # type: frozenset
+                 limit    # type: int
+                 ):
+        self.marker = marker
+        # the values that share the limit, or None for a marker without argument
+        self.values = values
+        self.limit = limit
+
+    @property
+    def key(self):
+        """A string identifying the limit in all processes"""
+        if self.values is None:
+            return self.marker.marker_id
+        return "%s:%s" % (self.marker.marker_id, ",".join(sorted(str(v) for v in self.values)))
+
+    def matches(self, required_marks):
+        """Return True if an item with marks `required_marks` (see `EasyMarker.parse_marks`) is limited"""
+        if len(required_marks) == 0:
+            return False
+        return self.values is None or _matches_any(self.values, required_marks)
+
+    def __repr__(self):
+        return "ConcurrencyLimit(%s=%s)" % (self.key, self.limit)
+
+
+def parse_concurrency(sources,  # type: List[str]
+                      markers,  # type: Iterable[EasyMarker]
+                      groups    # type: Dict[str, Dict[str, Tuple]]
+                      ):
+    # type: (...) -> List[ConcurrencyLimit]
+    """
+    Parses the `--pilot-concurrency` options. Each option is `<marker_id>:<query>=<n>` for a marker with argument, for
+    example `envid:hw-lab=2` or `envid:@lab=2` (all the values of the query share the same limit), or
+    `<marker_id>=<n>` for a marker without argument.
+
+    :param sources: the option values
+    :param markers: the available markers
+    :param groups: the named groups of values of all markers, see `read_query_groups`
+    :return:
+    :raises UsageError: if an option is invalid
+    """
+    markers_by_id = {m.marker_id: m for m in markers}
+    limits = []
+    for source in sources:
+        name, sep, limit = source.rpartition("=")
+        try:
+            limit = int(limit)
+        except ValueError:
+            sep = None
+        if not sep:
+            raise UsageError("Invalid `--pilot-concurrency %s`: it should have the form `<marker_id>:<value>=<n>`, "
+                             "for example `envid:hw-lab=2`" % source)
+        if limit < 1:
+            raise UsageError("Invalid `--pilot-concurrency %s`: the limit should be at least 1" % source)
+
+        marker_id, _, query = name.partition(":")
+        marker_id = marker_id.strip()
+        try:
+            marker = markers_by_id[marker_id]
+        except KeyError:
+            raise UsageError("Invalid `--pilot-concurrency %s`: %r is not a known marker. Known markers are %s"
+                             % (source, marker_id, sorted(markers_by_id)))
+        if not marker.has_arg:
+            if query:
+                raise UsageError("Invalid `--pilot-concurrency %s`: marker %r has no argument" % (source, marker_id))
+            values = None
+        elif not query or marker.is_all_query(query):
+            raise UsageError("Invalid `--pilot-concurrency %s`: the values of marker %r should be provided, for "
+                             "example `%s:<value>=%s`" % (source, marker_id, marker_id, limit))
+        else:
+            try:
+                values = marker.parse_query(query, groups.get(marker_id))
+            except ValueError as e:
+                raise UsageError("Invalid `--pilot-concurrency %s`: %s" % (source, e))
+        limits.append(ConcurrencyLimit(marker, values, limit))
+
+    return limits
+
+
+class _FileSemaphore(object):
+    """A semaphore shared by all processes, made of `limit` lock files in `directory`"""
+    __slots__ = 'paths', 'fd'
+
+    def __init__(self, directory, key, limit):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        self.paths = [os.path.join(directory, "%s-%s.lock" % (name, i)) for i in range(limit)]
+        # the file descriptor of the lock file held, if any
+        self.fd = None
+
+    def try_acquire(self):
+        """Return True if one of the lock files could be locked, without waiting"""
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            if _try_lock(fd):
+                self.fd = fd
+                return True
+            os.close(fd)
+        return False
+
+    def release(self):
+        _unlock(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+
+class ConcurrencyLocks(object):
+    """
+    A plugin registered in pytest-xdist workers, that tells the controller which items are limited and enforces the
+    concurrency limits with lock files, see module docstring.
+    """
+
+    def __init__(self,
+                 limits,     # type: List[ConcurrencyLimit]
+                 directory,  # type: str
+                 workerid,   # type: str
+                 reader      # type: MarksReader
+                 ):
+        self.limits = limits
+        self.directory = directory
+        self.workerid = workerid
+        self.semaphores = [_FileSemaphore(directory, limit.key, limit.limit) for limit in limits]
+        self.reader = reader
+
+    def get_limit_indices(self, item):
+        # type: (...) -> List[int]
+        """Return the indices of the limits that apply to `item`"""
+        all_marks = self.reader.read_marks(item)
+        indices = []
+        for i, limit in enumerate(self.limits):
+            required_marks, _ = limit.marker.parse_marks(all_marks.get(limit.marker.marker_id, ()))
+            if limit.matches(required_marks):
+                indices.append(i)
+        return indices
+
+    @staticmethod
+    def try_acquire(semaphores):
+        """Return True if all `semaphores` could be acquired, without waiting. Otherwise none of them is held"""
+        acquired = []
+        for semaphore in semaphores:
+            if not semaphore.try_acquire():
+                for s in acquired:
+                    s.release()
+                return False
+            acquired.append(semaphore)
+        return True
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection_finish(self, session):
+        # (before pytest-xdist sends the collection to the controller, that reads this file when it receives it)
+        limited = dict()
+        for item in session.items:
+            indices = self.get_limit_indices(item)
+            if indices:
+                limited[item.nodeid] = indices
+        path = os.path.join(self.directory, ITEMS_FILE_NAME % self.workerid)
+        with open(path + ".tmp", "w") as f:
+            json.dump(limited, f)
+        os.replace(path + ".tmp", path)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        semaphores = [self.semaphores[i] for i in self.get_limit_indices(item)]
+        if semaphores:
+            # all semaphores are acquired at once (and otherwise none is held), so that two workers waiting for the
+            # same semaphores can not block each other
+            while not self.try_acquire(semaphores):
+                time.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            for semaphore in semaphores:
+                semaphore.release()
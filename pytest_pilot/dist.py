@@ -0,0 +1,74 @@
+"""
+Support for pytest-xdist: the selection is computed once on the controller, from the marks index, and shipped to all
+workers in their `workerinput` as a compact payload:
+
+ - `digest`: a digest of the node ids of all items that the collection is expected to produce,
+ - `selected`: the zlib-compressed, newline-separated node ids of the selected items.
+
+Each worker checks that its own collection has the same digest, and then selects items with a set lookup instead of
+evaluating all EasyMarkers on them. If the collections differ, the worker evaluates the items as usual.
+"""
+import hashlib
+import zlib
+
+try:  # python 3.5+
+    from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+except ImportError:
+    pass
+
+
+# the key of the payload in the workerinput
+SELECTION_KEY = "pytest_pilot_selection"
+
+
+def is_xdist_worker(config):
+    """Return True if we are in a pytest-xdist worker"""
+    return hasattr(config, "workerinput")
+
+
+def is_first_process(config):
+    """Return True if we are not in a pytest-xdist worker, or if we are in the first one (gw0)"""
+    workerinput = getattr(config, "workerinput", None)
+    return workerinput is None or workerinput.get("workerid") == "gw0"
+
+
+def get_collection_digest(nodeids):
+    # type: (Iterable[str]) -> str
+    """Return a digest of a set of node ids, that does not depend on their order"""
+    return hashlib.sha1("\n".join(sorted(nodeids)).encode("utf-8")).hexdigest()
+
+
+def encode_selection(entries):
+    # type: (Iterable[Tuple[str, str, bool]]) -> Dict
+    """
+    Creates the payload to ship to workers.
+
+    :param entries: the (file, nodeid, is_selected) of all items
+    :return:
+    """
+    nodeids = []
+    selected = []
+    for _, nodeid, is_selected in entries:
+        nodeids.append(nodeid)
+        if is_selected:
+            selected.append(nodeid)
+    return dict(digest=get_collection_digest(nodeids),
+                selected=zlib.compress("\n".join(selected).encode("utf-8")))
+
+
+def decode_selection(payload,  # type: Dict
+                     nodeids   # type: Iterable[str]
+                     ):
+    # type: (...) -> Optional[FrozenSet[str]]
+    """
+    Reads the payload received from the controller.
+
+    :param payload: the payload created with `encode_selection`
+    :param nodeids: the node ids of the items collected by this worker
+    :return: the set of selected node ids, or None if the collection of this worker is not the one the payload was
+        computed for.
+    """
+    if get_collection_digest(nodeids) != payload["digest"]:
+        return None
+    selected = zlib.decompress(payload["selected"]).decode("utf-8")
+    return frozenset(selected.split("\n")) if selected else frozenset()
@@ -0,0 +1,191 @@
+"""
+Boolean selection expressions across markers, for the `--pilot-expr` option. For example
+
+    envid in {a, b} and not slow or flavour == 'red'
+
+An expression is parsed once with `ast`, validated against the registered EasyMarkers, and compiled into a single
+python function that is then evaluated on each item.
+
+ - `<marker_id>` is true if the item is marked with this marker (the agnostic mark does not count),
+ - `<marker_id> == <value>` and `<marker_id> in {<values>}` are true if one of the item's marks matches, or if the
+   item has the agnostic mark. `!=` and `not in` are their negation, except that they are also true for agnostic items.
+ - `and`, `or`, `not` and parenthesis can be used to combine them.
+
+Values can be quoted strings, numbers, or bare words (interpreted as strings).
+"""
+import ast
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, Tuple
+except ImportError:
+    pass
+
+from _pytest.config import UsageError
+
+from .pytest_marks import EasyMarker
+
+
+_NO_MARKS = ((), False)
+
+
+class PilotExpression(object):
+    """
+    A compiled `--pilot-expr` expression. Use `compile_expression` to create it.
+    """
+    __slots__ = 'source', 'markers', '_func'
+
+    def __init__(self, source, markers, func):
+        self.source = source
+        self.markers = markers
+        self._func = func
+
+    @property
+    def marker_ids(self):
+        return tuple(m.marker_id for m in self.markers)
+
+    def matches(self, parsed_marks):
+        """
+        Evaluates the expression.
+
+        :param parsed_marks: a dictionary {marker_id: (values, is_agnostic)}. Markers that are absent are considered
+            as not marked.
+        :return:
+        """
+        return self._func(parsed_marks, _NO_MARKS)
+
+    def __repr__(self):
+        return "PilotExpression(%r)" % self.source
+
+
+def _get_value(node):
+    """Return the python value of a constant or bare word ast node"""
+    if isinstance(node, ast.Name):
+        # bare word
+        return node.id
+    elif isinstance(node, getattr(ast, 'Constant', ())):
+        # python 3.8+
+        return node.value
+    elif isinstance(node, getattr(ast, 'Str', ())):
+        return node.s
+    elif isinstance(node, getattr(ast, 'Num', ())):
+        return node.n
+    elif isinstance(node, getattr(ast, 'NameConstant', ())):
+        return node.value
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_get_value(node.operand)
+    else:
+        raise ValueError("invalid value")
+
+
+class _ExpressionCompiler(object):
+    """Converts a validated python ast into the python source code of the body of the evaluation function"""
+
+    def __init__(self, source, markers_by_id):
+        self.source = source
+        self.markers_by_id = markers_by_id
+        # the markers used in the expression, by order of appearance
+        self.used = []
+        self.used_ids = []
+        # the constants (values and sets of values) used in the expression
+        self.constants = []
+
+    def error(self, msg):
+        return UsageError("Invalid `--pilot-expr %s`: %s" % (self.source, msg))
+
+    def var(self, name):
+        """Return the index of the marker named `name` in the used markers"""
+        try:
+            marker = self.markers_by_id[name]
+        except KeyError:
+            raise self.error("%r is not a known marker. Known markers are %s"
+                             % (name, sorted(self.markers_by_id)))
+        # note: we compare the ids since markers can not be compared with ==
+        try:
+            return self.used_ids.index(name)
+        except ValueError:
+            self.used.append(marker)
+            self.used_ids.append(name)
+            return len(self.used) - 1
+
+    def const(self, value):
+        self.constants.append(value)
+        return "_c%s" % (len(self.constants) - 1)
+
+    def check_value(self, marker, value):
+        if marker.allowed_values is not None and value not in marker.allowed_values:
+            raise self.error("%r is not allowed for marker %r. Allowed values are %r"
+                             % (value, marker.marker_id, marker.allowed_values))
+
+    def values(self, marker, node):
+        """Return the set of values in `node`, a single value or a set/list/tuple of values"""
+        try:
+            if isinstance(node, (ast.Set, ast.List, ast.Tuple)):
+                values = frozenset(_get_value(n) for n in node.elts)
+            else:
+                values = frozenset((_get_value(node),))
+        except (ValueError, TypeError):
+            raise self.error("invalid value(s) for marker %r: only strings, numbers or bare words can be used"
+                             % marker.marker_id)
+        for v in values:
+            self.check_value(marker, v)
+        return values
+
+    def convert(self, node):
+        if isinstance(node, ast.BoolOp):
+            op = " and " if isinstance(node.op, ast.And) else " or "
+            return "(%s)" % op.join(self.convert(v) for v in node.values)
+
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return "(not %s)" % self.convert(node.operand)
+
+        elif isinstance(node, ast.Name):
+            # the item is marked
+            return "(len(v%s) > 0)" % self.var(node.id)
+
+        elif isinstance(node, ast.Compare):
+            if len(node.ops) != 1 or not isinstance(node.left, ast.Name):
+                raise self.error("comparisons should be of the form `<marker> <op> <value(s)>`")
+            i = self.var(node.left.id)
+            marker = self.used[i]
+            if not marker.has_arg:
+                raise self.error("marker %r has no argument, it can only be used alone" % marker.marker_id)
+            op, right = node.ops[0], node.comparators[0]
+            values = self.const(self.values(marker, right))
+            if isinstance(op, (ast.Eq, ast.In)):
+                return "(a%s or not %s.isdisjoint(v%s))" % (i, values, i)
+            elif isinstance(op, (ast.NotEq, ast.NotIn)):
+                return "(a%s or %s.isdisjoint(v%s))" % (i, values, i)
+            else:
+                raise self.error("only `==`, `!=`, `in` and `not in` are supported")
+
+        else:
+            raise self.error("only markers, comparisons, `and`, `or`, `not` and parenthesis can be used")
+
+
+def compile_expression(source,   # type: str
+                       markers   # type: Iterable[EasyMarker]
+                       ):
+    # type: (...) -> PilotExpression
+    """
+    Parses, validates and compiles a `--pilot-expr` expression.
+
+    :param source: the expression
+    :param markers: the available markers
+    :return:
+    :raises UsageError: if the expression is invalid
+    """
+    compiler = _ExpressionCompiler(source, {m.marker_id: m for m in markers})
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise compiler.error("%s" % e.msg)
+
+    body = compiler.convert(tree.body)
+    code = ["def _pilot_expr(parsed_marks, _no_marks):"]
+    for i, marker in enumerate(compiler.used):
+        code.append("    v%s, a%s = parsed_marks.get(%r, _no_marks)" % (i, i, marker.marker_id))
+    code.append("    return %s" % body)
+
+    namespace = {"_c%s" % i: c for i, c in enumerate(compiler.constants)}
+    exec(compile("\n".join(code), "<pilot-expr>", "exec"), namespace)
+    return PilotExpression(source, tuple(compiler.used), namespace["_pilot_expr"])
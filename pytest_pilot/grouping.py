@@ -0,0 +1,184 @@
+"""
+The `--pilot-group <marker_ids>` option: after the selection, the items are grouped by the values of some markers (for
+example all `@envid('a')` items, then all `@envid('b')` items), so that the fixtures that depend on these values (such
+as a connection pool or a deployed stack) are not torn down and set up again each time the value changes.
+
+Groups are ordered by the position of their first item, and items keep their order within each group. With several
+markers, items are grouped by the values of the first marker, then by the values of the second one, etc.
+
+The effect of the grouping is reported with two numbers, before and after the grouping:
+
+ - the number of times the values change between two consecutive items. This is the number of times that a fixture
+   that depends on the values (for example through the `easymarkers` fixture) would be set up if it kept a single
+   instance at a time.
+ - the number of setups of the fixtures with a higher scope than "function", estimated from the fixtures statically
+   requested by each item: a fixture is set up again when its scope node (module, class...) is left or when its
+   parameter changes, like pytest does. Note that grouping items of different modules can increase this number.
+"""
+try:  # python 3.5+
+    from typing import Iterable, List, Tuple
+except ImportError:
+    pass
+
+import pytest
+from _pytest.config import UsageError
+
+from .pytest_compat import stash_get
+from .pytest_marks import EasyMarker
+from .selection import VALUES_KEY, MarksReader
+
+
+def parse_group(source,  # type: str
+                markers  # type: Iterable[EasyMarker]
+                ):
+    # type: (...) -> List[EasyMarker]
+    """
+    Parses the `--pilot-group` option: comma-separated marker ids, for example `envid,flavour`.
+
+    :param source: the option value
+    :param markers: the available markers
+    :return: the markers to group items by, in order
+    :raises UsageError: if the option is invalid
+    """
+    markers_by_id = {m.marker_id: m for m in markers}
+    group_markers = []
+    for marker_id in source.split(","):
+        marker_id = marker_id.strip()
+        try:
+            marker = markers_by_id[marker_id]
+        except KeyError:
+            raise UsageError("Invalid `--pilot-group %s`: %r is not a known marker. Known markers are %s"
+                             % (source, marker_id, sorted(markers_by_id)))
+        if all(m.marker_id != marker_id for m in group_markers):
+            group_markers.append(marker)
+    return group_markers
+
+
+def get_group_key(markers,  # type: Iterable[EasyMarker]
+                  reader,   # type: MarksReader
+                  item
+                  ):
+    # type: (...) -> Tuple
+    """
+    Return the values of `markers` for `item`: a tuple containing for each marker the tuple of its values (`(True,)`
+    for a marker without argument, and `()` if the item is not marked). For items run once per value (`--<option>=all`)
+    this is the value of the item.
+    """
+    all_marks = reader.read_marks(item)
+    item_values = stash_get(item, VALUES_KEY) or dict()
+    key = []
+    for marker in markers:
+        marker_id = marker.marker_id
+        if marker_id in item_values:
+            key.append((item_values[marker_id],))
+            continue
+        required_marks, _ = marker.parse_marks(all_marks.get(marker_id, ()))
+        if not marker.has_arg:
+            key.append((True,) if len(required_marks) > 0 else ())
+        else:
+            key.append(tuple(sorted(set(required_marks), key=str)))
+    return tuple(key)
+
+
+def group_items(items,    # type: List
+                markers,  # type: List[EasyMarker]
+                reader    # type: MarksReader
+                ):
+    # type: (...) -> List
+    """
+    Return `items` grouped by the values of `markers`, see module docstring.
+
+    :param items: the items to run
+    :param markers: the markers to group the items by, in order
+    :param reader: the `MarksReader` to use to read the marks of items
+    :return:
+    """
+    # the rank of each value of each marker, in order of first appearance
+    ranks = [dict() for _ in markers]
+    sort_keys = dict()
+    for item in items:
+        sort_key = []
+        for marker_ranks, values in zip(ranks, get_group_key(markers, reader, item)):
+            sort_key.append(marker_ranks.setdefault(values, len(marker_ranks)))
+        sort_keys[id(item)] = sort_key
+    # (the sort is stable)
+    return sorted(items, key=lambda item: sort_keys[id(item)])
+
+
+def count_value_changes(items,    # type: List
+                        markers,  # type: List[EasyMarker]
+                        reader    # type: MarksReader
+                        ):
+    # type: (...) -> int
+    """Return the number of times the values of `markers` change between two consecutive items of `items`"""
+    nb_changes = 0
+    previous = None
+    for item in items:
+        key = get_group_key(markers, reader, item)
+        if previous is not None and key != previous:
+            nb_changes += 1
+        previous = key
+    return nb_changes
+
+
+def _get_scope_nodeid(item, scope):
+    """Return the node id of the node of `item` that holds the fixtures of `scope`"""
+    if scope == "session":
+        return ""
+    if scope == "package":
+        node = item.getparent(pytest.Package) if hasattr(pytest, "Package") else None
+        return node.nodeid if node is not None else ""
+    if scope == "module":
+        node = item.getparent(pytest.Module)
+    else:
+        node = item.getparent(pytest.Class)
+    # the item itself for items that are not in a module (doctest text files...) or test functions not in a class
+    return node.nodeid if node is not None else item.nodeid
+
+
+def get_fixture_instances(item):
+    # type: (...) -> List[Tuple]
+    """
+    Return the instances of the fixtures with a higher scope than "function" statically requested by `item`: a list
+    of tuples (fixture definition, scope node id, parameter index).
+    """
+    fixtureinfo = getattr(item, "_fixtureinfo", None)
+    if fixtureinfo is None:
+        return []
+    callspec = getattr(item, "callspec", None)
+    indices = getattr(callspec, "indices", dict())
+    instances = []
+    for name in fixtureinfo.names_closure:
+        fixturedefs = fixtureinfo.name2fixturedefs.get(name)
+        if not fixturedefs:
+            continue
+        fixturedef = fixturedefs[-1]
+        scope = fixturedef.scope
+        if scope == "function":
+            continue
+        instances.append((fixturedef, _get_scope_nodeid(item, scope), indices.get(name)))
+    return instances
+
+
+def count_setups(items  # type: List
+                 ):
+    # type: (...) -> int
+    """
+    Return the estimated number of setups of the fixtures with a higher scope than "function" when `items` are run in
+    this order, see module docstring.
+    """
+    # the instance currently set up for each fixture definition {id(fixturedef): (scope node id, param index)}
+    alive = dict()
+    nb_setups = 0
+    for item in items:
+        # the fixtures whose scope node is left are torn down
+        chain = set(node.nodeid for node in item.listchain())
+        for key, (nodeid, _) in list(alive.items()):
+            if nodeid not in chain:
+                del alive[key]
+        for fixturedef, nodeid, param_index in get_fixture_instances(item):
+            instance = (nodeid, param_index)
+            if alive.get(id(fixturedef)) != instance:
+                alive[id(fixturedef)] = instance
+                nb_setups += 1
+    return nb_setups
@@ -0,0 +1,141 @@
+"""
+The failure history of tests, for the `--pilot-failed-first` option. It is stored in the pytest cache, and contains the
+failure rates of the items and of the marker values that recently failed.
+
+Rates are exponentially weighted moving averages: after each run, the rate of an item becomes
+`rate * (1 - WEIGHT) + WEIGHT` if it failed, and `rate * (1 - WEIGHT)` if it passed. The rate of a marker value is
+updated the same way with the proportion of its items that failed. Rates that become negligible are forgotten, so
+that the history only contains what failed recently.
+"""
+try:  # python 3.5+
+    from typing import Dict, Iterable, List
+except ImportError:
+    pass
+
+from .pytest_marks import EasyMarker
+from .selection import MarksReader
+
+
+# the key of the history in the pytest cache
+CACHE_KEY = "pytest-pilot/failures"
+
+# the weight of the last run in the rates
+WEIGHT = 0.5
+
+# the rates below this are forgotten
+MIN_RATE = 0.01
+
+
+def get_value_keys(markers,  # type: Iterable[EasyMarker]
+                   reader,   # type: MarksReader
+                   item
+                   ):
+    # type: (...) -> List[str]
+    """Return the keys of the marker values of `item` in the history, for example `['envid=a', 'slow']`"""
+    all_marks = reader.read_marks(item)
+    keys = []
+    for marker in markers:
+        marks = all_marks.get(marker.marker_id)
+        if not marks:
+            continue
+        required_marks, _ = marker.parse_marks(marks)
+        if marker.has_arg:
+            keys += ["%s=%s" % (marker.marker_id, v) for v in required_marks]
+        elif len(required_marks) > 0:
+            keys.append(marker.marker_id)
+    return keys
+
+
+def _update_rates(rates,    # type: Dict[str, float]
+                  results   # type: Dict[str, float]
+                  ):
+    """Updates `rates` with the failure proportions in `results`, forgetting the negligible ones"""
+    for key, failed in results.items():
+        rate = rates.get(key, 0.) * (1 - WEIGHT) + WEIGHT * failed
+        if rate < MIN_RATE:
+            rates.pop(key, None)
+        else:
+            rates[key] = rate
+
+
+class FailureHistory(object):
+    """
+    The failure history of tests, see module docstring. Use `FailureHistory.load` to create it. It is registered as a
+    pytest plugin to receive the test reports.
+    """
+    __slots__ = 'item_rates', 'value_rates', 'outcomes', 'value_keys'
+
+    def __init__(self,
+                 item_rates,   # type: Dict[str, float]
+                 value_rates   # type: Dict[str, float]
+                 ):
+        self.item_rates = item_rates
+        self.value_rates = value_rates
+        # the outcomes of this run {nodeid: failed}
+        self.outcomes = dict()
+        # the value keys of the items of this run {nodeid: keys}, see `get_value_keys`
+        self.value_keys = dict()
+
+    @classmethod
+    def load(cls, config):
+        # type: (...) -> FailureHistory
+        """Reads the history from the pytest cache of `config`, if any"""
+        cache = getattr(config, 'cache', None)
+        data = cache.get(CACHE_KEY, None) if cache is not None else None
+        if not isinstance(data, dict):
+            data = dict()
+        return cls(data.get('items', dict()), data.get('values', dict()))
+
+    def prioritize(self,
+                   items,    # type: List
+                   markers,  # type: Iterable[EasyMarker]
+                   reader    # type: MarksReader
+                   ):
+        # type: (...) -> List
+        """
+        Return `items` sorted by decreasing failure rate of the item, and then by decreasing failure rate of its marker
+        values. The sort is stable, so that items without history keep their order.
+
+        :param items: the items to run
+        :param markers: the markers
+        :param reader: the `MarksReader` to use to read the marks of items
+        :return:
+        """
+        markers = tuple(markers)
+        item_rates = self.item_rates
+        value_rates = self.value_rates
+        sort_keys = dict()
+        for item in items:
+            keys = self.value_keys[item.nodeid] = get_value_keys(markers, reader, item)
+            value_rate = max([value_rates.get(k, 0.) for k in keys]) if value_rates and keys else 0.
+            sort_keys[id(item)] = (-item_rates.get(item.nodeid, 0.), -value_rate)
+        return sorted(items, key=lambda item: sort_keys[id(item)])
+
+    def pytest_runtest_logreport(self, report):
+        """Records the outcome of a test report. An item fails if any of its phases fails"""
+        if report.failed:
+            self.outcomes[report.nodeid] = True
+        elif report.when == "call":
+            self.outcomes.setdefault(report.nodeid, False)
+
+    def save(self, config):
+        """Updates the rates with the outcomes of this run, and stores them in the pytest cache"""
+        cache = getattr(config, 'cache', None)
+        if cache is None or len(self.outcomes) == 0:
+            return
+
+        _update_rates(self.item_rates, self.outcomes)
+
+        # note: the value keys are only known in the processes that collected the items (not on the xdist controller)
+        value_counts = dict()
+        for nodeid, failed in self.outcomes.items():
+            for key in self.value_keys.get(nodeid, ()):
+                try:
+                    counts = value_counts[key]
+                except KeyError:
+                    counts = value_counts[key] = [0, 0]
+                counts[0] += 1
+                counts[1] += failed
+        _update_rates(self.value_rates, {key: float(nb_failed) / nb for key, (nb, nb_failed) in value_counts.items()})
+
+        cache.set(CACHE_KEY, dict(items=self.item_rates, values=self.value_rates))
@@ -0,0 +1,265 @@
+"""
+A persistent index of the EasyMarker marks of all collected items, stored in the pytest cache (`.pytest_cache`).
+
+It is a compact file made of
+
+ - a header line with a magic string and the format version,
+ - a json table of contents line containing the key of the collection that produced it (rootdir, args, marker
+   definitions, fingerprint of the configuration file...), the fingerprints of all test files and of their conftest
+   files (mtime and size), the fingerprints of their directories (the sorted names of the test files, conftest files
+   and sub-directories that they contain), and for each test file the position of its records in the file,
+ - for each test file, one `<nodeid>\t<json marks>` record line per item.
+
+The table of contents is small, and the records of a test file are only read and decoded when needed, from a
+memory-mapped view of the file. An index is fresh if all fingerprints are unchanged: in that case the marks of all
+items can be known without importing any test module.
+"""
+import json
+import mmap
+import os
+from fnmatch import fnmatch
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, List, Optional, Tuple
+except ImportError:
+    pass
+
+from .pytest_compat import get_inipath, get_rootdir
+
+
+INDEX_FILE_NAME = "marks.idx"
+
+_MAGIC = b"pytest-pilot-marks-index 1\n"
+
+# the mark values that can be stored in the index
+_INDEXABLE_TYPES = (str, int, float, bool, type(None))
+
+
+class UnindexableValue(Exception):
+    """Raised when a mark value can not be stored in the index"""
+
+
+def get_collection_key(config, markers):
+    """
+    Return the key identifying the set of files that a collection would gather with `config`, and how their marks are
+    read and selected with `markers`. An index can only be used instead of collecting if its key is the same.
+
+    :param config: the pytest config
+    :param markers: all EasyMarkers (declared in python or in the `pilot_markers` ini option)
+    :return:
+    """
+    inipath = get_inipath(config)
+    key = dict(rootdir=get_rootdir(config), cwd=os.getcwd(), args=list(config.args),
+               python_files=list(config.getini("python_files")), norecursedirs=list(config.getini("norecursedirs")),
+               # the records and the selection depend on the marker definitions, that may live outside of the
+               # fingerprinted files (a plugin, a helper package, the ini file)
+               markers=[[m.marker_id, m.has_arg, m.not_filtering_skips_marked, m.filtering_skips_unmarked]
+                        for m in markers],
+               inifile=[inipath, Fingerprints.stat(inipath)] if inipath is not None else None)
+    # an index written while pytest deselects items (`-k`, `-m`...) only contains the remaining items
+    for opt in ("keyword", "markexpr", "deselect"):
+        key[opt] = getattr(config.option, opt, None) or None
+    for opt in ("ignore", "ignore_glob"):
+        try:
+            key[opt] = config.getoption(opt) or []
+        except ValueError:
+            # older pytest: no such option
+            key[opt] = []
+    return key
+
+
+def get_item_record(markers, all_marks):
+    # type: (...) -> Dict[str, List]
+    """
+    Return the record to store in the index for an item, from its marks.
+
+    :param markers: all EasyMarkers
+    :param all_marks: the dictionary {marker_id: [marks]} of the item, see `MarksReader.read_marks`
+    :return: a dictionary {marker_id: [values, is_agnostic]} containing the markers for which the item has marks
+    :raises UnindexableValue: if a mark value is not a str, int, float, bool or None
+    """
+    record = dict()
+    for marker in markers:
+        marks = all_marks.get(marker.marker_id)
+        if marks:
+            values, is_agnostic = marker.parse_marks(marks)
+            for v in values:
+                if not isinstance(v, _INDEXABLE_TYPES):
+                    raise UnindexableValue(v)
+            record[marker.marker_id] = [values, is_agnostic]
+    return record
+
+
+class Fingerprints(object):
+    """Computes the fingerprints of files and directories, with a cache for conftest files"""
+    __slots__ = 'rootdir', 'python_files', 'norecursedirs', '_conftests'
+
+    def __init__(self, rootdir, key):
+        self.rootdir = rootdir
+        self.python_files = key['python_files']
+        self.norecursedirs = key['norecursedirs']
+        self._conftests = dict()
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+    def dir(self, dir_path):
+        """
+        Return the fingerprint of a directory: the sorted names of the test files, conftest files and sub-directories
+        that it contains. Other files (reports, coverage data...) can change without invalidating the index.
+        """
+        names = []
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            return None
+        for entry in entries:
+            name = entry.name
+            if entry.is_dir():
+                if name != "__pycache__" and not any(fnmatch(name, p) for p in self.norecursedirs):
+                    names.append(name + "/")
+            elif name == "conftest.py" or any(fnmatch(name, p) for p in self.python_files):
+                names.append(name)
+        return sorted(names)
+
+    def dirs_up(self, dir_path):
+        """Yield `dir_path` and all its parents up to the rootdir (or the file system root)"""
+        d = dir_path
+        while True:
+            yield d
+            parent = os.path.dirname(d)
+            if d == self.rootdir or parent == d:
+                return
+            d = parent
+
+    def conftests(self, dir_path):
+        """Return the fingerprints of the conftest files in `dir_path` and its parents"""
+        try:
+            return self._conftests[dir_path]
+        except KeyError:
+            fps = [self.stat(os.path.join(d, "conftest.py")) for d in self.dirs_up(dir_path)]
+            self._conftests[dir_path] = fps
+            return fps
+
+    def file(self, file_path):
+        """Return the fingerprint of a test file: its own one, and the ones of its conftest files"""
+        return [self.stat(file_path), self.conftests(os.path.dirname(file_path))]
+
+
+def write_index(index_path,      # type: str
+                key,             # type: List
+                rootdir,         # type: str
+                records_by_file  # type: Dict[str, Iterable[Tuple[str, Dict]]]
+                ):
+    """
+    Writes the index file.
+
+    :param index_path: the path of the index file
+    :param key: the collection key, see `get_collection_key`. It must be json-serializable.
+    :param rootdir: the rootdir. Paths are stored relative to it
+    :param records_by_file: a dictionary {test file path: [(nodeid, record)]}, see `get_item_record`
+    :return:
+    """
+    fps = Fingerprints(rootdir, key)
+    toc_files = dict()
+    toc_dirs = dict()
+    chunks = []
+    offset = 0
+    for file_path, records in records_by_file.items():
+        data = "".join("%s\t%s\n" % (nodeid, json.dumps(record, separators=(',', ':')))
+                       for nodeid, record in records).encode("utf-8")
+        toc_files[os.path.relpath(file_path, rootdir)] = [fps.file(file_path), offset, len(data)]
+        chunks.append(data)
+        offset += len(data)
+        for d in fps.dirs_up(os.path.dirname(file_path)):
+            rel_dir = os.path.relpath(d, rootdir)
+            if rel_dir not in toc_dirs:
+                toc_dirs[rel_dir] = fps.dir(d)
+
+    toc = json.dumps(dict(key=key, dirs=toc_dirs, files=toc_files), separators=(',', ':')).encode("utf-8")
+
+    # write atomically so that concurrent readers never see a partial file
+    tmp_path = "%s.%s.tmp" % (index_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(toc)
+        f.write(b"\n")
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, index_path)
+
+
+class MarksIndex(object):
+    """
+    A marks index read from disk. Use `MarksIndex.load` to create it.
+    """
+    __slots__ = 'rootdir', 'key', 'dirs', 'files', '_mmap', '_data_start'
+
+    def __init__(self, rootdir, toc, mm, data_start):
+        self.rootdir = rootdir
+        self.key = toc['key']
+        self.dirs = toc['dirs']
+        self.files = toc['files']
+        self._mmap = mm
+        self._data_start = data_start
+
+    @classmethod
+    def load(cls, index_path, rootdir):
+        # type: (...) -> Optional[MarksIndex]
+        """
+        Loads the index at `index_path`.
+
+        :return: the index or None if there is no valid index at this path
+        """
+        try:
+            with open(index_path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # no file, or empty file
+            return None
+
+        try:
+            if mm[:len(_MAGIC)] != _MAGIC:
+                raise ValueError("not an index")
+            toc_end = mm.find(b"\n", len(_MAGIC))
+            toc = json.loads(mm[len(_MAGIC):toc_end].decode("utf-8"))
+        except ValueError:
+            mm.close()
+            return None
+
+        return cls(rootdir, toc, mm, toc_end + 1)
+
+    def close(self):
+        self._mmap.close()
+
+    def is_fresh(self, key):
+        """
+        Returns True if this index was produced with the same collection `key` (so with the same marker definitions
+        and configuration file), and if no test file, conftest or directory has changed since then.
+        """
+        if self.key != key:
+            return False
+        fps = Fingerprints(self.rootdir, key)
+        for rel_dir, fp in self.dirs.items():
+            if fps.dir(os.path.join(self.rootdir, rel_dir)) != fp:
+                return False
+        for rel_file, (fp, _, _) in self.files.items():
+            if fps.file(os.path.join(self.rootdir, rel_file)) != fp:
+                return False
+        return True
+
+    def iter_records(self, rel_file):
+        """
+        Yields all (nodeid, record) of test file `rel_file` (relative to rootdir). Records are dictionaries
+        {marker_id: [values, is_agnostic]}.
+        """
+        _, offset, length = self.files[rel_file]
+        start = self._data_start + offset
+        for line in self._mmap[start:start + length].decode("utf-8").splitlines():
+            nodeid, record = line.split("\t", 1)
+            yield nodeid, json.loads(record)
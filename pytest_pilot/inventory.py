@@ -0,0 +1,121 @@
+"""
+The marker values inventory, for the `--pilot-inventory` option: for each EasyMarker, the values that collected items
+are marked with and their item counts, computed in a single pass over the collected items.
+"""
+import json
+
+try:  # python 3.5+
+    from typing import Iterable, List
+except ImportError:
+    pass
+
+from .pytest_marks import EasyMarker
+from .selection import MarksReader
+
+
+class MarkerInventory(object):
+    """
+    The inventory of a single EasyMarker.
+    """
+    __slots__ = 'marker', 'counts', 'nb_agnostic', 'nb_unmarked'
+
+    def __init__(self,
+                 marker  # type: EasyMarker
+                 ):
+        self.marker = marker
+        # a list of [value, count] by order of appearance (values may not be hashable)
+        self.counts = []
+        self.nb_agnostic = 0
+        self.nb_unmarked = 0
+
+    def add(self, values, is_agnostic):
+        """Adds an item with marks `values`, see `EasyMarker.parse_marks`"""
+        if is_agnostic:
+            self.nb_agnostic += 1
+        if len(values) == 0:
+            if not is_agnostic:
+                self.nb_unmarked += 1
+            return
+
+        seen = []
+        for v in values:
+            if v in seen:
+                continue
+            seen.append(v)
+            for value_count in self.counts:
+                if value_count[0] == v:
+                    value_count[1] += 1
+                    break
+            else:
+                self.counts.append([v, 1])
+
+    @property
+    def unused_allowed_values(self):
+        """The allowed values that no collected item is marked with"""
+        if self.marker.allowed_values is None:
+            return []
+        used = [v for v, _ in self.counts]
+        return [v for v in self.marker.allowed_values if v not in used]
+
+    @property
+    def undeclared_values(self):
+        """The values that collected items are marked with, but that are not in the allowed values"""
+        if self.marker.allowed_values is None:
+            return []
+        return [v for v, _ in self.counts if v not in self.marker.allowed_values]
+
+    def to_dict(self):
+        marker = self.marker
+        return dict(option=marker.cmdoption_long,
+                    has_arg=marker.has_arg,
+                    allowed_values=list(marker.allowed_values) if marker.allowed_values is not None else None,
+                    declared_values=sorted(marker.used_values, key=repr),
+                    values=[dict(value=v, count=c) for v, c in self.counts],
+                    agnostic=self.nb_agnostic,
+                    unmarked=self.nb_unmarked,
+                    unused_allowed_values=self.unused_allowed_values,
+                    undeclared_values=self.undeclared_values)
+
+    def get_lines(self):
+        """Return the lines of the table describing this inventory"""
+        marker = self.marker
+        lines = ["%s (%s): %s unmarked, %s agnostic" % (marker.marker_id, marker.cmdoption_long, self.nb_unmarked,
+                                                        self.nb_agnostic)]
+        undeclared = self.undeclared_values
+        for v, c in self.counts:
+            lines.append("  %-20s %s%s" % (v if marker.has_arg else "(marked)", c,
+                                           "  (not an allowed value)" if v in undeclared else ""))
+        for v in self.unused_allowed_values:
+            lines.append("  %-20s 0  (allowed value with no test)" % (v,))
+        return lines
+
+
+def build_inventory(markers,  # type: Iterable[EasyMarker]
+                    reader,   # type: MarksReader
+                    items
+                    ):
+    # type: (...) -> List[MarkerInventory]
+    """
+    Creates the inventory of all `markers` on `items`, reading the marks of each item once.
+
+    :param markers: the EasyMarkers
+    :param reader: the `MarksReader` to use to read the marks of all markers on items
+    :param items: the collected pytest items
+    :return: a list of inventories, one per marker
+    """
+    inventories = [MarkerInventory(m) for m in markers]
+    for item in items:
+        all_marks = reader.read_marks(item)
+        for inventory in inventories:
+            inventory.add(*inventory.marker.parse_marks(all_marks.get(inventory.marker.marker_id, ())))
+    return inventories
+
+
+def write_inventory(path,         # type: str
+                    inventories,  # type: List[MarkerInventory]
+                    nb_items      # type: int
+                    ):
+    """Writes the inventory as json in `path`. Values that are not json-serializable are written with `repr`"""
+    with open(path, "w") as f:
+        json.dump(dict(items=nb_items, markers={inv.marker.marker_id: inv.to_dict() for inv in inventories}),
+                  f, indent=2, default=repr)
@@ -0,0 +1,303 @@
+"""
+The `--pilot-matrix <marker>` runner: tests are collected once in the main process, and then run once per value of the
+marker, each value in a child process forked after collection. Children share the imported modules and the collected
+tree with the main process (copy-on-write), so nothing is imported or collected again.
+
+Each child sends its test reports back to the main process through a pipe, one json message per line. The main process
+replays them through the usual pytest hooks, so that the terminal, junitxml, cache... plugins see all results.
+"""
+import json
+import os
+import selectors
+import sys
+import traceback
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, List, Optional, Tuple
+except ImportError:
+    pass
+
+from _pytest.config import UsageError
+from _pytest.reports import TestReport
+
+from .pytest_compat import stash_get, stash_set
+from .pytest_marks import EasyMarker
+
+
+# the title of the report section that tells which value a test was run with
+SECTION_TITLE = "pytest-pilot matrix"
+
+
+class PilotMatrix(object):
+    """
+    A parsed `--pilot-matrix` option. Use `parse_matrix` to create it.
+    """
+    __slots__ = 'marker', 'values', 'jobs'
+
+    def __init__(self,
+                 marker,  # type: EasyMarker
+                 values,  # type: Optional[Tuple]
+                 jobs     # type: int
+                 ):
+        self.marker = marker
+        self.values = values
+        self.jobs = jobs
+
+    def get_runs(self, items, reader):
+        # type: (...) -> List[Tuple[Any, List]]
+        """
+        Splits `items` into one run per value.
+
+        :param items: the pytest items, already selected by all other filters
+        :param reader: the `MarksReader` to use to read the marks of items
+        :return: a list of (value, items), in the order of the values
+        """
+        marker = self.marker
+        marker_id = marker.marker_id
+        parsed = [marker.parse_marks(reader.read_marks(item).get(marker_id, ())) for item in items]
+
+        values = self.values
+        if values is None:
+            # the values actually used, by order of appearance
+            values = []
+            for required_marks, _ in parsed:
+                for v in required_marks:
+                    if v not in values:
+                        values.append(v)
+
+        runs = []
+        for value in values:
+            decide = marker.compile_query(frozenset((value,)))
+            runs.append((value, [item for item, (required_marks, is_agnostic) in zip(items, parsed)
+                                 if decide is None or decide(item, required_marks, is_agnostic) is None]))
+        return runs
+
+    def __repr__(self):
+        return "PilotMatrix(%s=%r)" % (self.marker.marker_id, self.values)
+
+
+def parse_matrix(source,  # type: str
+                 markers,  # type: Iterable[EasyMarker]
+                 groups,   # type: Dict[str, Dict[str, Tuple]]
+                 jobs      # type: Optional[int]
+                 ):
+    # type: (...) -> PilotMatrix
+    """
+    Parses the `--pilot-matrix` option: `<marker_id>` to run all the `allowed_values` of the marker (or all values used
+    by the collected tests if there are no `allowed_values`), or `<marker_id>=<query>` to run the values of a query
+    such as `a,b` or `@staging`.
+
+    :param source: the option value
+    :param markers: the available markers
+    :param groups: the named groups of values of all markers, see `read_query_groups`
+    :param jobs: the maximum number of children running at the same time. `None` means the number of CPUs.
+    :return:
+    :raises UsageError: if the option is invalid
+    """
+    if not hasattr(os, "fork"):
+        raise UsageError("`--pilot-matrix` is only available on platforms supporting `os.fork`")
+
+    marker_id, _, query = source.partition("=")
+    marker_id = marker_id.strip()
+    markers_by_id = {m.marker_id: m for m in markers}
+    try:
+        marker = markers_by_id[marker_id]
+    except KeyError:
+        raise UsageError("Invalid `--pilot-matrix %s`: %r is not a known marker. Known markers are %s"
+                         % (source, marker_id, sorted(markers_by_id)))
+    if not marker.has_arg:
+        raise UsageError("Invalid `--pilot-matrix %s`: marker %r has no argument" % (source, marker_id))
+
+    if query:
+        try:
+            values = marker.parse_query(query, groups.get(marker_id))
+        except ValueError as e:
+            raise UsageError("Invalid `--pilot-matrix %s`: %s" % (source, e))
+        # preserve the order of the allowed values when possible
+        values = tuple(v for v in marker.allowed_values if v in values) if marker.allowed_values is not None \
+            else tuple(sorted(values, key=str))
+    else:
+        values = marker.allowed_values
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    elif jobs < 1:
+        raise UsageError("`--pilot-matrix-jobs` should be at least 1, found %s" % jobs)
+
+    return PilotMatrix(marker, values, jobs)
+
+
+class _ReportForwarder(object):
+    """A plugin registered in children, that sends the test reports to the main process"""
+
+    def __init__(self, config, out, marker_id, value):
+        self.config = config
+        self.out = out
+        # added to the sections (displayed with failures) and user properties (junitxml) of all reports
+        self.tag = (SECTION_TITLE, "%s=%s" % (marker_id, value))
+
+    def send(self, **msg):
+        self.out.write(json.dumps(msg) + "\n")
+        self.out.flush()
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        self.send(event="logstart", nodeid=nodeid, location=location)
+
+    def pytest_runtest_logreport(self, report):
+        report.sections.append(self.tag)
+        report.user_properties.append(self.tag)
+        self.send(event="logreport", report=self.config.hook.pytest_report_to_serializable(config=self.config,
+                                                                                           report=report))
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        self.send(event="logfinish", nodeid=nodeid, location=location)
+
+
+def _run_child(session, marker, value, items, fd):
+    """Runs `items` in a forked child, sending reports to the pipe `fd`. Returns the exit code of the child"""
+    # (selection imports this module)
+    from .selection import VALUES_KEY
+    out = os.fdopen(fd, "w")
+    try:
+        config = session.config
+        pluginmanager = config.pluginmanager
+        marker_id = marker.marker_id
+
+        # the tests see the value they run with, in the `easymarkers` fixture and in the option of the marker
+        setattr(config.option, marker.cmdoption_long[2:], value)
+        for item in items:
+            item_values = dict(stash_get(item, VALUES_KEY) or ())
+            item_values[marker_id] = value
+            stash_set(item, VALUES_KEY, item_values)
+
+        # the main process reports the results
+        terminalreporter = pluginmanager.get_plugin("terminalreporter")
+        if terminalreporter is not None:
+            pluginmanager.unregister(terminalreporter)
+        pluginmanager.register(_ReportForwarder(config, out, marker_id, value), "pytest-pilot-matrix")
+
+        # do not share the global capture temporary files with the other processes
+        capman = pluginmanager.get_plugin("capturemanager")
+        if capman is not None and capman.is_globally_capturing():
+            capman.stop_global_capturing()
+            capman.start_global_capturing()
+
+        for i, item in enumerate(items):
+            nextitem = items[i + 1] if i + 1 < len(items) else None
+            item.config.hook.pytest_runtest_protocol(item=item, nextitem=nextitem)
+            if session.shouldfail or session.shouldstop:
+                break
+        return 0
+    except BaseException:
+        out.write(json.dumps(dict(event="error", message=traceback.format_exc())) + "\n")
+        return 1
+    finally:
+        out.flush()
+
+
+class _Child(object):
+    """A running child, as seen from the main process"""
+    __slots__ = 'value', 'pid', 'fd', 'buffer', 'running', 'error'
+
+    def __init__(self, value, pid, fd):
+        self.value = value
+        self.pid = pid
+        self.fd = fd
+        self.buffer = b""
+        # the (nodeid, location) of the item being run, if any
+        self.running = None
+        # the error message sent by the child, if any
+        self.error = None
+
+
+def run_matrix(session,
+               matrix,  # type: PilotMatrix
+               runs     # type: List[Tuple[Any, List]]
+               ):
+    # type: (...) -> List[Tuple[Any, str]]
+    """
+    Runs each of the `runs` in a forked child, with at most `matrix.jobs` children at the same time, and replays their
+    reports in the main process. If a child dies while running a test, a failed report is created for this test.
+
+    :param session: the pytest session
+    :param matrix: the matrix
+    :param runs: the list of (value, items) to run, see `PilotMatrix.get_runs`
+    :return: the list of (value, message) for the children that did not terminate normally outside of a test
+    """
+    config = session.config
+    hook = config.hook
+    marker_id = matrix.marker.marker_id
+
+    def handle(child, line):
+        msg = json.loads(line.decode("utf-8"))
+        event = msg["event"]
+        if event == "logreport":
+            hook.pytest_runtest_logreport(report=hook.pytest_report_from_serializable(config=config,
+                                                                                      data=msg["report"]))
+        elif event == "logstart":
+            child.running = (msg["nodeid"], tuple(msg["location"]))
+            hook.pytest_runtest_logstart(nodeid=msg["nodeid"], location=child.running[1])
+        elif event == "logfinish":
+            child.running = None
+            hook.pytest_runtest_logfinish(nodeid=msg["nodeid"], location=tuple(msg["location"]))
+        else:
+            child.error = msg["message"]
+
+    def handle_end(child, exitcode):
+        if child.running is None:
+            return [(child.value, child.error or "exit code %s" % exitcode)]
+        # the child died while running a test
+        nodeid, location = child.running
+        tag = (SECTION_TITLE, "%s=%s" % (marker_id, child.value))
+        report = TestReport(nodeid, location, {}, "failed",
+                            "pytest-pilot: the child process running %s=%s terminated with exit code %s while "
+                            "running this test" % (marker_id, child.value, exitcode),
+                            "call", sections=[tag], user_properties=[tag])
+        hook.pytest_runtest_logreport(report=report)
+        hook.pytest_runtest_logfinish(nodeid=nodeid, location=location)
+        return []
+
+    pending = [run for run in runs if len(run[1]) > 0]
+    crashes = []
+    selector = selectors.DefaultSelector()
+    try:
+        while pending or selector.get_map():
+            # start as many children as allowed
+            while pending and len(selector.get_map()) < matrix.jobs:
+                value, items = pending.pop(0)
+                read_fd, write_fd = os.pipe()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    # child
+                    os.close(read_fd)
+                    code = 1
+                    try:
+                        code = _run_child(session, matrix.marker, value, items, write_fd)
+                    finally:
+                        os._exit(code)
+                os.close(write_fd)
+                selector.register(read_fd, selectors.EVENT_READ, _Child(value, pid, read_fd))
+
+            # process the messages received
+            for key, _ in selector.select():
+                child = key.data
+                data = os.read(child.fd, 65536)
+                if data:
+                    child.buffer += data
+                    *lines, child.buffer = child.buffer.split(b"\n")
+                    for line in lines:
+                        handle(child, line)
+                else:
+                    # end of the child
+                    selector.unregister(child.fd)
+                    os.close(child.fd)
+                    _, status = os.waitpid(child.pid, 0)
+                    exitcode = os.waitstatus_to_exitcode(status)
+                    if exitcode != 0:
+                        crashes += handle_end(child, exitcode)
+    finally:
+        selector.close()
+
+    return crashes
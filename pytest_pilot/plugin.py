@@ -2,12 +2,18 @@
 See https://docs.pytest.org/en/latest/writing_plugins.html
 and https://docs.pytest.org/en/latest/_modules/_pytest/hookspec.html
 """
+import os
+import sys
+from fnmatch import fnmatch
+
 import pytest
 
 
 # ------------ declare a new hook that users should implement
-from pytest_pilot import EasyMarker
-from pytest_pilot.pytest_marks import set_verbosity_level
+# Note: this module is loaded in every pytest process (including all pytest-xdist workers), even when no EasyMarker is
+# used. Only lightweight modules are imported here, the others are imported in the hooks when they are needed.
+from pytest_pilot.pytest_compat import get_cache_dir, get_node_path, get_rootdir
+from pytest_pilot.session import PilotSession, get_pilot_session, set_pilot_session
 
 
 def pytest_addhooks(pluginmanager):
@@ -28,7 +34,7 @@ def pytest_addhooks(pluginmanager):
     method(new_hooks)
 
 
-all_markers = None
+# Note: the state of each run is stored in a `PilotSession` attached to the config, see `get_pilot_session`
 
 
 def pytest_addoption(parser):
@@ -38,6 +44,151 @@ def pytest_addoption(parser):
                                                                  "will skip tests based on markers, instead of "
                                                                  "deselecting them."
     )
+    parser.addoption(
+        "--pilot-prune", action="store_true", default=False, help="pilot-prune: when this flag is used, test "
+                                                                  "functions and classes that are marked (or in a "
+                                                                  "marked module or class) and would all be "
+                                                                  "deselected because the corresponding option is not "
+                                                                  "set, are not collected at all. Parametrized tests "
+                                                                  "are not generated for parameters that would be "
+                                                                  "deselected. They do not appear in the deselected "
+                                                                  "count, their number is reported separately."
+    )
+    parser.addoption(
+        "--pilot-prescan", action="store_true", default=False, help="pilot-prescan: when this flag is used, test "
+                                                                    "modules are first parsed without being imported. "
+                                                                    "Modules whose tests are all marked with a marker "
+                                                                    "whose option is not set are not imported nor "
+                                                                    "collected at all. Modules that can not be fully "
+                                                                    "understood statically are collected normally. "
+                                                                    "The results are cached until modules change."
+    )
+    parser.addini(
+        "pilot_groups", type="linelist", help="pilot_groups: named groups of marker values, that can be used in "
+                                              "queries with `--<option>=@<group>`. One group per line, with the form "
+                                              "`<marker_id>.<group> = <value>, <value>...`"
+    )
+    parser.addini(
+        "pilot_markers", type="linelist", help="pilot_markers: markers declared without python code, one per line "
+                                               "with the form `<marker_id> = <mode>; <argument> = <value>...` where "
+                                               "the arguments are the ones of EasyMarker, for example "
+                                               "`envid = hard_filter; allowed_values = a, b; cmdoption_short = E`"
+    )
+    parser.addoption(
+        "--pilot-expr", action="store", metavar="EXPR", help="pilot-expr: only run tests whose marks match the "
+                                                             "boolean expression EXPR, for example "
+                                                             "\"envid in {a, b} and not slow or flavour == 'red'\". "
+                                                             "The markers used in EXPR are only filtered by EXPR: "
+                                                             "their own options can not be used."
+    )
+    parser.addoption(
+        "--pilot-inventory", action="store_true", default=False, help="pilot-inventory: when this flag is used, tests "
+                                                                      "are not run. Instead, for each marker, the "
+                                                                      "values that collected tests are marked with "
+                                                                      "are reported with their number of tests. It "
+                                                                      "is also written as json in the pytest cache, "
+                                                                      "or in the file set with "
+                                                                      "--pilot-inventory-json."
+    )
+    parser.addoption(
+        "--pilot-inventory-json", action="store", metavar="PATH", help="pilot-inventory-json: the path of the json "
+                                                                       "file where --pilot-inventory writes the "
+                                                                       "inventory."
+    )
+    parser.addoption(
+        "--pilot-matrix", action="store", metavar="MARKER", help="pilot-matrix: collect the tests once, and run them "
+                                                                 "once for each value of MARKER, each time in a "
+                                                                 "child process forked after collection. MARKER can "
+                                                                 "be a marker id, to use all its allowed values (or "
+                                                                 "all the values used by tests), or "
+                                                                 "<marker_id>=<values> to use some values only, for "
+                                                                 "example `envid=a,b`."
+    )
+    parser.addoption(
+        "--pilot-matrix-jobs", action="store", type=int, metavar="N", help="pilot-matrix-jobs: the maximum number of "
+                                                                           "values run in parallel by "
+                                                                           "--pilot-matrix. Defaults to the number "
+                                                                           "of CPUs."
+    )
+    parser.addoption(
+        "--pilot-what-if", action="append", metavar="MARKER", help="pilot-what-if: when this option is used, tests are "
+                                                                   "not run. Instead, the number of tests that would "
+                                                                   "be selected is reported for all the combinations "
+                                                                   "of the options of the MARKERs, from a single "
+                                                                   "collection (or from the marks index). MARKER is a "
+                                                                   "marker id, to use the option not set and set to "
+                                                                   "each value, or <marker_id>=<query>|<query>..., "
+                                                                   "for example `envid=a|b|a,b`. This option can be "
+                                                                   "used several times."
+    )
+    parser.addoption(
+        "--pilot-profile", action="store_true", default=False, help="pilot-profile: when this flag is used, the time "
+                                                                    "spent in the hooks and fixture of pytest-pilot, "
+                                                                    "and in the evaluation of each marker, is "
+                                                                    "reported in the terminal summary."
+    )
+    parser.addoption(
+        "--pilot-profile-json", action="store", metavar="PATH", help="pilot-profile-json: the path of a json file "
+                                                                     "where --pilot-profile also writes its results."
+    )
+    parser.addoption(
+        "--pilot-threads", action="store", type=int, metavar="N", help="pilot-threads: the number of threads used to "
+                                                                       "evaluate the markers on collected tests. "
+                                                                       "This is only useful for very large numbers "
+                                                                       "of tests, on a free-threaded python. Defaults "
+                                                                       "to 1."
+    )
+    parser.addoption(
+        "--pilot-failed-first", action="store_true", default=False, help="pilot-failed-first: when this flag is "
+                                                                         "used, the tests that failed recently are "
+                                                                         "run first, followed by the tests marked "
+                                                                         "with the marker values that failed "
+                                                                         "recently. The failure history is stored in "
+                                                                         "the pytest cache."
+    )
+    parser.addoption(
+        "--pilot-shard", action="store", metavar="I/N", help="pilot-shard: split the selected tests into N shards "
+                                                             "of similar durations, and only run shard I (from 1 to "
+                                                             "N). The durations of tests are recorded in the pytest "
+                                                             "cache. All shards compute the same split, as long as "
+                                                             "they use the same recorded durations."
+    )
+    parser.addoption(
+        "--pilot-durations-file", action="store", metavar="PATH", help="pilot-durations-file: with --pilot-shard, "
+                                                                       "read and record the durations of tests in "
+                                                                       "this json file instead of the pytest cache. "
+                                                                       "Use the same file on all shards so that "
+                                                                       "they compute the same split."
+    )
+    parser.addoption(
+        "--pilot-group", action="store", metavar="MARKERS", help="pilot-group: run the selected tests grouped by the "
+                                                                 "values of the MARKERS (comma-separated marker ids, "
+                                                                 "for example `envid,flavour`), keeping their order "
+                                                                 "within each group, so that the fixtures that depend "
+                                                                 "on these values are set up less often."
+    )
+    parser.addoption(
+        "--pilot-concurrency", action="append", metavar="LIMIT", help="pilot-concurrency: with pytest-xdist, the "
+                                                                      "maximum number of tests marked with some "
+                                                                      "values that run at the same time on all "
+                                                                      "workers. LIMIT is <marker_id>:<values>=<n>, "
+                                                                      "for example `envid:hw-lab=2`. A worker "
+                                                                      "waits before running such a test while the "
+                                                                      "limit is reached. This option can be used "
+                                                                      "several times."
+    )
+    parser.addoption(
+        "--pilot-index", action="store_true", default=False, help="pilot-index: when this flag is used, the marks of "
+                                                                  "all collected tests are stored in an index in the "
+                                                                  "pytest cache, for use by --pilot-plan."
+    )
+    parser.addoption(
+        "--pilot-plan", action="store_true", default=False, help="pilot-plan: when this flag is used, tests are not "
+                                                                 "run. Instead, the tests that would be selected with "
+                                                                 "the current options are reported. If the marks "
+                                                                 "index is up to date, test files are not even "
+                                                                 "collected."
+    )
 
 
 # Note: we can not use the pytest_addoption(parser) hook because it is called before reading the users' conftest.py
@@ -52,17 +203,44 @@ def pytest_load_initial_conftests(early_config, parser, args):
     # first let the loading happen
     yield
 
-    # then call the extra hook to know what the user wants
+    if getattr(early_config.known_args_namespace, "pilot_profile", False):
+        from pytest_pilot.profiling import PilotProfile
+        profile = PilotProfile()
+        with profile.timing("pytest_load_initial_conftests"):
+            _register_markers(early_config, parser, profile)
+    else:
+        _register_markers(early_config, parser, None)
+
+
+def _register_markers(early_config, parser, profile):
+    """
+    Gets the markers to use from the `pytest_pilot_markers` hook, adds their options, and attaches the `PilotSession`
+    of this run to the config.
+    """
+    # call the extra hook to know what the user wants
     results = early_config.pluginmanager.hook.pytest_pilot_markers()
     nb_plugin_that_answered_with_a_non_none = len(results)
 
-    global all_markers
     assert nb_plugin_that_answered_with_a_non_none < 2, "should not happen since our hook has first_results == True"
     if nb_plugin_that_answered_with_a_non_none == 0:
         # default behaviour: register all markers created by users
-        all_markers = EasyMarker.list_all()
+        # (if the module defining EasyMarker was never imported, no marker was created)
+        pytest_marks = sys.modules.get("pytest_pilot.pytest_marks")
+        all_markers = pytest_marks.EasyMarker.list_all() if pytest_marks is not None else []
+
+        # and the ones declared in the configuration file
+        if len(early_config.getini("pilot_markers")) > 0:
+            from pytest_pilot.pytest_marks import read_declared_markers
+            declared_markers = read_declared_markers(early_config)
+            declared_ids = set(m.marker_id for m in declared_markers)
+            for marker in all_markers:
+                if marker.marker_id in declared_ids:
+                    raise ValueError("Error registering <%s>: a marker with the same id is declared in the "
+                                     "`pilot_markers` ini option" % marker)
+            all_markers = declared_markers + all_markers
     else:
-        all_markers = results[0]
+        all_markers = list(results[0])
+    set_pilot_session(early_config, PilotSession(all_markers, profile))
 
     # existing options
     existing_opts = vars(early_config.option)
@@ -99,58 +277,625 @@ def pytest_load_initial_conftests(early_config, parser, args):
                              "Caught: %r" % (marker, e))
 
 
+def _uses_pilot_options(config):
+    """Return True if one of the options of pytest-pilot itself (not of the markers) is set"""
+    return any(value for name, value in vars(config.option).items() if name.startswith("pilot_"))
+
+
 def pytest_configure(config):
+    pilot = get_pilot_session(config)
+    if len(pilot.markers) == 0 and not _uses_pilot_options(config):
+        # nothing to do in this run: there is no plan, and all hooks return right away
+        return
+
+    from pytest_pilot.prescan import ModuleScanner, PrescanCache
+    from pytest_pilot.pytest_marks import logger, set_verbosity_level
+    from pytest_pilot.selection import SelectionPlan
+
     # register our additional markers in the help
-    global all_markers
-    for marker in all_markers:
+    for marker in pilot.markers:
         config.addinivalue_line("markers", marker.markhelp)
 
     # detect if we are in verbose mode
     verbositylevel = config.getoption('verbose')
+    pilot.logger_level = logger.level
     set_verbosity_level(verbositylevel)
 
+    # resolve the queries once for the whole session
+    profile = pilot.profile
+    if profile is not None:
+        with profile.timing("pytest_configure"):
+            plan = SelectionPlan(pilot.markers, config)
+        plan.profile = profile
+    else:
+        plan = SelectionPlan(pilot.markers, config)
+    pilot.plan = plan
+
+    # the static pre-scan is useless with --doctest-modules, since all modules are imported anyway
+    if len(plan.prescan_marker_ids) > 0 and not config.getoption("doctestmodules", False):
+        scanner = ModuleScanner(plan.markers, config.getini("python_functions"), config.getini("python_classes"))
+        pilot.prescan_cache = PrescanCache(scanner, config, get_rootdir(config))
+
+    if config.getoption("--pilot-failed-first"):
+        from pytest_pilot.history import FailureHistory
+        pilot.history = FailureHistory.load(config)
+        config.pluginmanager.register(pilot.history, "pytest-pilot-history")
+
+    shard_source = config.getoption("--pilot-shard")
+    if shard_source is not None:
+        from pytest_pilot.sharding import ItemDurations, parse_shard
+        pilot.shard = parse_shard(shard_source)
+        pilot.durations = ItemDurations.load(config, config.getoption("--pilot-durations-file"))
+        config.pluginmanager.register(pilot.durations, "pytest-pilot-durations")
+
+    group_source = config.getoption("--pilot-group")
+    if group_source is not None:
+        from pytest_pilot.grouping import parse_group
+        pilot.group_markers = parse_group(group_source, plan.markers)
+
+    concurrency_sources = config.getoption("--pilot-concurrency")
+    if concurrency_sources:
+        from pytest_pilot.concurrency import CONCURRENCY_KEY, ConcurrencyLocks, parse_concurrency
+        from pytest_pilot.pytest_marks import read_query_groups
+        pilot.concurrency_limits = parse_concurrency(concurrency_sources, plan.markers, read_query_groups(config))
+        workerinput = getattr(config, "workerinput", dict())
+        if CONCURRENCY_KEY in workerinput:
+            # (pytest-xdist worker) without xdist there is a single test running at a time, nothing to do
+            config.pluginmanager.register(ConcurrencyLocks(pilot.concurrency_limits, workerinput[CONCURRENCY_KEY],
+                                                           workerinput["workerid"], plan.reader),
+                                          "pytest-pilot-concurrency")
+
+
+def pytest_unconfigure(config):
+    """
+    Restores the level of the logger, so that it does not leak to other runs in the same process, and removes the lock
+    files of --pilot-concurrency.
+    """
+    pilot = get_pilot_session(config)
+    if pilot is not None and pilot.logger_level is not None:
+        from pytest_pilot.pytest_marks import logger
+        logger.setLevel(pilot.logger_level)
+    if pilot is not None and pilot.concurrency_dir is not None:
+        import shutil
+        shutil.rmtree(pilot.concurrency_dir, ignore_errors=True)
+
 
-def pytest_collection_modifyitems(items, config):
+def _is_prescanned(path, config):
     """
-    Deselects all that were usually skipped by marker CLI config, except if --pilot-skip option is used.
-    Same as _pytest.markdeselect_by_mark(items, config)
+    Return True if the static pre-scan proves that all tests in the file at `path` would be deselected. This only
+    happens with the --pilot-prescan option.
+    """
+    pilot = get_pilot_session(config)
+    prescan_cache = pilot.prescan_cache
+    if prescan_cache is None:
+        return False
+    name = os.path.basename(path)
+    if not name.endswith(".py") or name in ("conftest.py", "__init__.py") \
+            or not any(fnmatch(name, p) for p in config.getini("python_files")) or not os.path.isfile(path):
+        return False
+
+    units = prescan_cache.get_units(path)
+    # note: a module without tests is collected normally, it may generate tests in other ways
+    plan = pilot.plan
+    if not units or not all(plan.prescan_marker_ids.intersection(unit) for unit in units):
+        return False
+
+    plan.nb_prescanned += 1
+    plan.pruned_paths.add(path)
+    return True
+
+
+if hasattr(pytest, "version_tuple"):
+    # pytest 7+
+    def pytest_ignore_collect(collection_path, config):
+        """Ignores the test modules that the static pre-scan proves to be entirely deselected"""
+        return True if _is_prescanned(str(collection_path), config) else None
+else:
+    def pytest_ignore_collect(path, config):
+        """Ignores the test modules that the static pre-scan proves to be entirely deselected"""
+        return True if _is_prescanned(str(path), config) else None
+
+
+def pytest_sessionfinish(session):
+    """Stores the results of the static pre-scan, the failure history and the durations in the pytest cache"""
+    config = session.config
+    pilot = get_pilot_session(config)
+    if pilot.prescan_cache is not None:
+        pilot.prescan_cache.save()
+    if pilot.history is not None or pilot.durations is not None:
+        from pytest_pilot.dist import is_xdist_worker
+        if not is_xdist_worker(config):
+            # (on xdist, the controller receives the reports of all workers)
+            if pilot.history is not None:
+                pilot.history.save(config)
+            if pilot.durations is not None:
+                pilot.durations.save(config)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pycollect_makeitem(collector, name, obj):
+    """
+    Prunes test functions and classes when we know in advance that all the items that they would generate would be
+    deselected. This only happens with the --pilot-prune option.
+    """
+    plan = get_pilot_session(collector.config).plan
+    if plan is not None and len(plan.pruning_filters) > 0 \
+            and (collector.istestfunction(obj, name) or collector.istestclass(obj, name)):
+        reason = plan.get_pruning_reason(collector, obj)
+        if reason is not None:
+            plan.nb_pruned += 1
+            plan.pruned_paths.add(get_node_path(collector))
+            return []
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_generate_tests(metafunc):
     """
+    Prunes the parametrized tests that would be deselected, before the items are created. This only happens with the
+    --pilot-prune option.
+    """
+    # first let all parametrization happen
+    yield
 
-    # Detect if we are in skip mode instead of deselect mode
-    should_skip = config.getoption("--pilot-skip")
+    plan = get_pilot_session(metafunc.config).plan
+    if plan is not None and plan.prune_params:
+        nb_pruned = plan.prune_calls(metafunc)
+        if nb_pruned > 0:
+            plan.nb_pruned_params += nb_pruned
+            plan.pruned_paths.add(get_node_path(metafunc.definition))
+
+
+def pytest_report_collectionfinish(config, items):
+    """Reports the number of test functions, classes and parameters pruned during collection"""
+    pilot = get_pilot_session(config)
+    plan = pilot.plan
+    if plan is None:
+        return []
+    lines = []
+    if plan.nb_prescanned > 0:
+        lines.append("pytest-pilot: %s test module(s) not imported since the pre-scan found no test to run in them"
+                     % plan.nb_prescanned)
+    if plan.nb_pruned > 0:
+        lines.append("pytest-pilot: %s test function(s) or class(es) pruned during collection" % plan.nb_pruned)
+    if plan.nb_pruned_params > 0:
+        lines.append("pytest-pilot: %s parametrized test(s) pruned during collection" % plan.nb_pruned_params)
+    if pilot.index_message is not None:
+        lines.append(pilot.index_message)
+    if pilot.shard_message is not None:
+        lines.append(pilot.shard_message)
+    if pilot.group_message is not None:
+        lines.append(pilot.group_message)
+    return lines
+
+
+def _get_index_path(config):
+    """Return the path of the marks index file, or None if the cache is disabled"""
+    from pytest_pilot.index import INDEX_FILE_NAME
+    cache_dir = get_cache_dir(config, "pytest-pilot")
+    return os.path.join(cache_dir, INDEX_FILE_NAME) if cache_dir is not None else None
+
+
+def _write_index(config, items):
+    """Writes the marks index for `items`. Returns a message describing what happened"""
+    from pytest_pilot.index import UnindexableValue, get_collection_key, get_item_record, write_index
+    plan = get_pilot_session(config).plan
+    if len(plan.pruned_paths) > 0:
+        return "pytest-pilot: marks index not written since some tests were pruned (--pilot-prune or --pilot-prescan)"
+
+    index_path = _get_index_path(config)
+    if index_path is None:
+        return "pytest-pilot: marks index not written since the cache is disabled"
+
+    records_by_file = dict()
+    for item in items:
+        try:
+            record = get_item_record(plan.markers, plan.reader.read_marks(item))
+        except UnindexableValue as e:
+            return "pytest-pilot: marks index not written since %s has a mark value that can not be stored in the " \
+                   "index: %r" % (item.nodeid, e.args[0])
+        file_path = get_node_path(item)
+        try:
+            records_by_file[file_path].append((item.nodeid, record))
+        except KeyError:
+            records_by_file[file_path] = [(item.nodeid, record)]
 
-    if not should_skip:
-        # Deselect all tests that should not run.
-        remaining = []
-        deselected = []
+    write_index(index_path, get_collection_key(config, plan.markers), get_rootdir(config), records_by_file)
+    return "pytest-pilot: marks index written for %s item(s)" % len(items)
 
-        global all_markers
-        for item in items:
-            for marker in all_markers:
-                if marker.is_not_compliant(item):
-                    deselected.append(item)
-                    break
-            else:
-                remaining.append(item)
 
-        assert len(remaining) + len(deselected) == len(items)
-        if deselected:
-            config.hook.pytest_deselected(items=deselected)
-            items[:] = remaining
+def _read_fresh_index(config):
+    """
+    Reads the marks index, if it is up to date with the files, the marker definitions and the configuration file.
+
+    :return: a list of (file, nodeid, record) for all items, or None if there is no fresh index
+    """
+    from pytest_pilot.index import MarksIndex, get_collection_key
+    index_path = _get_index_path(config)
+    if index_path is None:
+        return None
+    index = MarksIndex.load(index_path, get_rootdir(config))
+    if index is None:
+        return None
+
+    try:
+        if not index.is_fresh(get_collection_key(config, get_pilot_session(config).plan.markers)):
+            return None
+        records = []
+        for rel_file in index.files:
+            for nodeid, record in index.iter_records(rel_file):
+                records.append((rel_file, nodeid, record))
+    finally:
+        index.close()
+    return records
+
+
+def _evaluate_what_if(pilot, source, rows):
+    """
+    Evaluates the --pilot-what-if grid on all items.
+
+    :param pilot: the `PilotSession`
+    :param source: a description of where the marks come from
+    :param rows: a list of (nodeid, {marker_id: (values, is_agnostic)}) for all items
+    """
+    from pytest_pilot.whatif import MarksTable, to_bitset
+    plan = pilot.plan
+    table = MarksTable.create(plan.markers, rows)
+    grid_ids = plan.what_if.marker_ids
+    base_queries = {f.marker.marker_id: f.query for f in plan.active_filters if f.marker.marker_id not in grid_ids}
+    base = None
+    if plan.expr is not None:
+        base = to_bitset((i for i, (_, parsed_marks) in enumerate(rows) if plan.expr.matches(parsed_marks)), len(rows))
+    pilot.what_if_report = (source, table, plan.what_if.evaluate(table, base_queries, base))
+
+
+# the pytest options that deselect items: the marks index can not be used instead of collecting when they are set
+_DESELECTING_OPTIONS = ("keyword", "markexpr", "deselect")
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection(session):
+    """
+    With --pilot-plan and --pilot-what-if, if the marks index is up to date, computes the plan or evaluates the
+    configurations from the index and skips collection. This is not possible when pytest deselects items (`-k`, `-m`,
+    `--deselect`), since the index does not know which items they deselect.
+    """
+    config = session.config
+    pilot = get_pilot_session(config)
+    plan = pilot.plan
+    if plan is None:
+        return None
+    plan_mode = config.getoption("--pilot-plan")
+    if not plan_mode and plan.what_if is None:
+        return None
+
+    if any(getattr(config.option, name, None) for name in _DESELECTING_OPTIONS):
+        # the index does not know which items these options deselect: collect
+        return None
+
+    records = _read_fresh_index(config)
+    if records is None:
+        return None
+
+    if plan_mode:
+        pilot.plan_report = ("marks index", [(rel_file, nodeid,
+                                              plan.get_non_compliance_from_record(nodeid, record) is None)
+                                             for rel_file, nodeid, record in records])
+    if plan.what_if is not None:
+        _evaluate_what_if(pilot, "marks index", [(nodeid, record) for _, nodeid, record in records])
+    session.items = []
+    session.testscollected = len(records)
+    return True
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_setupnodes(config, specs):
+    """
+    (pytest-xdist controller) If the marks index is up to date, computes the selection once for all workers. The index
+    is not used if the marker definitions or the configuration file changed since it was written, since the workers
+    would then receive a selection made with stale marker modes.
+    """
+    pilot = get_pilot_session(config)
+    plan = pilot.plan
+    if plan is None or plan.is_trivial or config.getoption("--pilot-plan"):
+        return
+    records = _read_fresh_index(config)
+    if records is not None:
+        from pytest_pilot.dist import encode_selection
+        pilot.selection_payload = encode_selection((rel_file, nodeid,
+                                                    plan.get_non_compliance_from_record(nodeid, record) is None)
+                                                   for rel_file, nodeid, record in records)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    """
+    (pytest-xdist controller) Ships the selection to the worker, if it was computed, and the directory of the lock files
+    used to enforce the concurrency limits.
+    """
+    pilot = get_pilot_session(node.config)
+    if pilot.selection_payload is not None:
+        from pytest_pilot.dist import SELECTION_KEY
+        node.workerinput[SELECTION_KEY] = pilot.selection_payload
+    if pilot.concurrency_limits:
+        from pytest_pilot.concurrency import CONCURRENCY_KEY
+        if pilot.concurrency_dir is None:
+            import tempfile
+            pilot.concurrency_dir = tempfile.mkdtemp(prefix="pytest-pilot-")
+        node.workerinput[CONCURRENCY_KEY] = pilot.concurrency_dir
+
+
+@pytest.hookimpl(optionalhook=True, tryfirst=True)
+def pytest_xdist_make_scheduler(config, log):
+    """
+    (pytest-xdist controller) With --pilot-concurrency and the `load` distribution, returns a scheduler that holds back
+    the limited items while their limits are reached, instead of sending them to workers that would wait for them.
+    """
+    pilot = get_pilot_session(config)
+    if not pilot.concurrency_limits or config.getvalue("dist") != "load":
+        return None
+    from pytest_pilot.scheduling import LimitedLoadScheduling
+    return LimitedLoadScheduling(config, log, pilot.concurrency_limits, pilot.concurrency_dir)
+
+
+def _select(config, items):
+    """
+    Splits `items` into the compliant and non-compliant ones, using the selection shipped by the pytest-xdist
+    controller if available.
+    """
+    from pytest_pilot.dist import SELECTION_KEY, decode_selection, is_xdist_worker
+    from pytest_pilot.pytest_marks import logger
+    plan = get_pilot_session(config).plan
+    payload = config.workerinput.get(SELECTION_KEY) if is_xdist_worker(config) else None
+    if payload is not None:
+        selected_nodeids = decode_selection(payload, (item.nodeid for item in items))
+        if selected_nodeids is not None:
+            return plan.select_from(items, selected_nodeids)
+        logger.info("[pytest-pilot] the collection of this worker is not the one of the marks index used by the "
+                    "controller, items are evaluated locally")
+    return plan.select(items)
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(items, config):
+    """
+    Deselects all that were usually skipped by marker CLI config, except if --pilot-skip option is used.
+    Same as _pytest.markdeselect_by_mark(items, config)
+    Marked items are also duplicated once per value for the markers queried with 'all' (`--<option>=all`).
+
+    This runs after the other plugins (`-k`, `-m`...), so that the plan and the other reports only contain the items
+    that they did not deselect.
+    """
+    pilot = get_pilot_session(config)
+    if pilot.plan is None:
+        return
+    profile = pilot.profile
+    if profile is not None:
+        profile.nb_items += len(items)
+        with profile.timing("pytest_collection_modifyitems"):
+            _modify_items(pilot, items, config)
+    else:
+        _modify_items(pilot, items, config)
+
+
+def _modify_items(pilot, items, config):
+    from pytest_pilot.dist import is_first_process
+    plan = pilot.plan
+    plan_mode = config.getoption("--pilot-plan")
+    if (plan_mode or config.getoption("--pilot-index")) and is_first_process(config):
+        # (on xdist, the controller does not collect: the first worker takes care of it)
+        pilot.index_message = _write_index(config, items)
+
+    if config.getoption("--pilot-inventory"):
+        json_path = config.getoption("--pilot-inventory-json")
+        if json_path is None:
+            cache_dir = get_cache_dir(config, "pytest-pilot")
+            json_path = os.path.join(cache_dir, "inventory.json") if cache_dir is not None else None
+        from pytest_pilot.inventory import build_inventory, write_inventory
+        inventories = build_inventory(plan.markers, plan.reader, items)
+        if json_path is not None:
+            write_inventory(json_path, inventories, len(items))
+        pilot.inventory_report = (inventories, len(items), json_path)
+
+    if plan.what_if is not None:
+        rows = []
+        for item in items:
+            all_marks = plan.reader.read_marks(item)
+            rows.append((item.nodeid, {m.marker_id: m.parse_marks(all_marks.get(m.marker_id, ()))
+                                       for m in plan.markers}))
+        _evaluate_what_if(pilot, "collection", rows)
+
+    remaining, deselected = _select(config, items)
+
+    if plan_mode:
+        rootdir = get_rootdir(config)
+        entries = [(os.path.relpath(get_node_path(item), rootdir), item.nodeid, plan.get_decision(item) is None)
+                   for item in items]
+        pilot.plan_report = ("collection", entries)
+
+    if plan.skip_mode:
+        # do not deselect: non-compliant items will be skipped in `pytest_runtest_setup`
+        remaining, deselected = items, []
+
+    # with `--<option>=all`, compliant marked items are run once per value
+    remaining = plan.expand(remaining)
+
+    if pilot.history is not None:
+        # the items and marker values that failed recently first
+        remaining = pilot.history.prioritize(remaining, plan.markers, plan.reader)
+
+    if pilot.shard is not None:
+        # only the items of our shard are kept
+        from pytest_pilot.sharding import partition
+        index, count = pilot.shard
+        costs = pilot.durations.get_costs(remaining, plan.markers, plan.reader)
+        nb_unknown = pilot.durations.count_unknown(remaining)
+        shards, totals = partition(costs, count)
+        deselected += [item for item, s in zip(remaining, shards) if s != index - 1]
+        remaining = [item for item, s in zip(remaining, shards) if s == index - 1]
+        pilot.shard_message = "pytest-pilot: shard %s/%s runs %s of %s selected item(s), estimated duration %.2fs " \
+                              "of %.2fs" % (index, count, len(remaining), len(shards), totals[index - 1], sum(totals))
+        if nb_unknown > 0:
+            # the durations of these items are estimated from the other ones: shards that read different durations
+            # would not estimate them the same way
+            pilot.shard_message += "\npytest-pilot: warning: %s of %s selected item(s) have no recorded duration, " \
+                                   "other shards may compute a different split if they do not read the same " \
+                                   "durations (see --pilot-durations-file)" % (nb_unknown, len(shards))
+
+    if pilot.group_markers is not None:
+        # the items with the same marker values together
+        from pytest_pilot.grouping import count_setups, count_value_changes, group_items
+        group_markers = pilot.group_markers
+        nb_changes_before = count_value_changes(remaining, group_markers, plan.reader)
+        nb_setups_before = count_setups(remaining)
+        remaining = group_items(remaining, group_markers, plan.reader)
+        pilot.group_message = "pytest-pilot: tests grouped by %s, %s value change(s) instead of %s, %s higher-scoped " \
+                              "fixture setup(s) instead of %s" \
+                              % (",".join(m.marker_id for m in group_markers),
+                                 count_value_changes(remaining, group_markers, plan.reader), nb_changes_before,
+                                 count_setups(remaining), nb_setups_before)
+
+    if plan.matrix is not None:
+        # the items that would not run with any of the values are deselected
+        matrix_runs = pilot.matrix_runs = plan.matrix.get_runs(remaining, plan.reader)
+        selected_ids = set(id(item) for _, run_items in matrix_runs for item in run_items)
+        deselected += [item for item in remaining if id(item) not in selected_ids]
+        remaining = [item for item in remaining if id(item) in selected_ids]
+
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+    items[:] = remaining
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtestloop(session):
+    """
+    With --pilot-plan, --pilot-inventory and --pilot-what-if, tests are not run. With --pilot-matrix, they are run in
+    forked children, once for each value.
+    """
+    config = session.config
+    if config.getoption("--pilot-plan") or config.getoption("--pilot-inventory") \
+            or config.getoption("--pilot-what-if"):
+        return True
+
+    pilot = get_pilot_session(config)
+    matrix_runs = pilot.matrix_runs
+    if matrix_runs is None:
+        return None
+
+    # same as the default implementation
+    if session.testsfailed and not config.option.continue_on_collection_errors:
+        raise session.Interrupted("%d error%s during collection"
+                                  % (session.testsfailed, "s" if session.testsfailed != 1 else ""))
+    if config.option.collectonly:
+        return True
+
+    matrix = pilot.plan.matrix
+    marker_id = matrix.marker.marker_id
+    terminalreporter = config.pluginmanager.get_plugin("terminalreporter")
+    if terminalreporter is not None:
+        terminalreporter.write_line("pytest-pilot matrix: %s"
+                                    % ", ".join("%s=%s (%s items)" % (marker_id, value, len(run_items))
+                                                for value, run_items in matrix_runs))
+
+    from pytest_pilot.matrix import run_matrix
+    pilot.matrix_crashes = run_matrix(session, matrix, matrix_runs)
+    session.testsfailed += len(pilot.matrix_crashes)
+    return True
+
+
+def pytest_terminal_summary(terminalreporter):
+    """
+    With --pilot-plan, reports the tests that would be selected. With --pilot-inventory, reports the inventory. With
+    --pilot-matrix, reports the crashed runs. With --pilot-what-if, reports the selection of each configuration. With
+    --pilot-profile, reports the time spent in pytest-pilot.
+    """
+    pilot = get_pilot_session(terminalreporter.config)
+    if pilot.plan is None:
+        return
+    if pilot.inventory_report is not None:
+        inventories, nb_items, json_path = pilot.inventory_report
+        terminalreporter.section("pytest-pilot inventory")
+        for inventory in inventories:
+            for line in inventory.get_lines():
+                terminalreporter.write_line(line)
+        terminalreporter.write_line("total: %s collected item(s)%s"
+                                    % (nb_items, " (json written to %s)" % json_path if json_path else ""))
+
+    if pilot.matrix_crashes:
+        terminalreporter.section("pytest-pilot matrix", red=True)
+        for value, message in pilot.matrix_crashes:
+            terminalreporter.write_line("%s=%s did not terminate normally: %s"
+                                        % (pilot.plan.matrix.marker.marker_id, value, message))
+
+    profile = pilot.profile
+    if profile is not None:
+        json_path = terminalreporter.config.getoption("--pilot-profile-json")
+        if json_path is not None:
+            profile.write(json_path)
+        terminalreporter.section("pytest-pilot profile")
+        for line in profile.get_lines():
+            terminalreporter.write_line(line)
+        if json_path is not None:
+            terminalreporter.write_line("json written to %s" % json_path)
+
+    if pilot.what_if_report is not None:
+        from pytest_pilot.whatif import count_bits
+        source, table, results = pilot.what_if_report
+        terminalreporter.section("pytest-pilot what-if")
+        verbose = terminalreporter.config.getoption("verbose") > 0
+        for configuration, selected in results:
+            terminalreporter.write_line("%s: %s selected" % (configuration, count_bits(selected)))
+            if verbose:
+                for nodeid in table.get_nodeids(selected):
+                    terminalreporter.write_line("  %s" % nodeid)
+        terminalreporter.write_line("total: %s configuration(s) evaluated on %s item(s) (from the %s)"
+                                    % (len(results), len(table.nodeids), source))
+
+    if pilot.plan_report is None:
+        return
+
+    source, entries = pilot.plan_report
+    counts = dict()
+    for file, _, is_selected in entries:
+        try:
+            file_counts = counts[file]
+        except KeyError:
+            file_counts = counts[file] = [0, 0]
+        file_counts[0 if is_selected else 1] += 1
+
+    terminalreporter.section("pytest-pilot plan")
+    for file, (nb_selected, nb_deselected) in counts.items():
+        terminalreporter.write_line("%s: %s selected, %s deselected" % (file, nb_selected, nb_deselected))
+    if terminalreporter.config.getoption("verbose") > 0:
+        for _, nodeid, is_selected in entries:
+            if is_selected:
+                terminalreporter.write_line(nodeid)
+    nb_selected = sum(c[0] for c in counts.values())
+    terminalreporter.write_line("total: %s selected, %s deselected (from the %s)"
+                                % (nb_selected, len(entries) - nb_selected, source))
 
 
 def pytest_runtest_setup(item):
     """
     Dynamically skips tests that can not be run on the current environment.
     Note: if items have been deselected in `pytest_collection_modifyitems` because of a commandline option,
-    this hook will not run at all for them.
+    this hook will not run at all for them. For the others, the decision taken during collection is reused.
 
     :param item:
     :return:
     """
-    global all_markers
-    for marker in all_markers:
-        marker.skip_if_not_compliant(item)
+    pilot = get_pilot_session(item.config)
+    plan = pilot.plan
+    if plan is None or plan.is_trivial:
+        return
+    profile = pilot.profile
+    if profile is not None:
+        with profile.timing("pytest_runtest_setup"):
+            reason = plan.get_decision(item)
+    else:
+        reason = plan.get_decision(item)
+    if reason is not None:
+        pytest.skip(str(reason))
 
 
 class EasyMarkersCurrentValues(object):
@@ -170,14 +915,15 @@ def easymarkers(request):
     """A fixture containing all EasyMarker related CLI option current values
 
     You can list all key-value pairs with `vars(easymarkers)` and access each
-    value using attribute access: `easymarkers.<option>`.
+    value using attribute access: `easymarkers.<option>`. With `--<option>=all`,
+    the value is the one that the test runs with.
     """
 
-    global all_markers
-    all_markers_dct = dict()
-    for marker in all_markers:
-        marker_name = marker.cmdoption_long[2:]
-        m_filter = request.config.getoption(marker_name)
-        all_markers_dct[marker_name] = m_filter
-
-    return EasyMarkersCurrentValues(**all_markers_dct)
+    pilot = get_pilot_session(request.config)
+    if pilot.plan is None:
+        return EasyMarkersCurrentValues()
+    profile = pilot.profile
+    if profile is not None:
+        with profile.timing("easymarkers fixture"):
+            return EasyMarkersCurrentValues(**pilot.plan.get_queries(request.node))
+    return EasyMarkersCurrentValues(**pilot.plan.get_queries(request.node))
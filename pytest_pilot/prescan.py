@@ -0,0 +1,359 @@
+"""
+A static pre-scan of test modules, for the `--pilot-prescan` option: test modules are parsed with `ast` (without being
+imported), and the EasyMarker marks of their tests are found from
+
+ - the module-level `pytestmark`,
+ - the class decorators and class-level `pytestmark`,
+ - the function and method decorators.
+
+Decorators are resolved from the names imported by the module, but only through modules that are already imported
+(for example a `conftest.py`): nothing is imported by the pre-scan. A mark only counts if it was resolved to one of the
+registered EasyMarkers. Anything that can not be resolved (star imports, tests defined conditionally or imported from
+other modules...) makes the module "unknown", and it is imported and collected normally. This is also the case of any
+module-level statement other than imports, definitions, docstrings and assignments to plain names, since function calls
+or assignments such as `globals()['test_x'] = f` can define tests.
+
+The result for a module is a list of "units" (test functions, or test classes when their tests can not be known
+statically), each unit being the set of ids of the markers it has at least one non-agnostic mark of.
+"""
+import ast
+import os
+import sys
+from fnmatch import fnmatch
+
+try:  # python 3.5+
+    from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+except ImportError:
+    pass
+
+from _pytest.mark import MarkDecorator, MarkGenerator
+
+from .index import Fingerprints
+from .pytest_marks import EasyMarker, _AGNOSTIC
+
+
+# the key of the pre-scan results in the pytest cache
+CACHE_KEY = "pytest-pilot/prescan"
+
+# the result of a failed name resolution
+_UNRESOLVED = object()
+
+_FUNCTION_DEFS = (ast.FunctionDef, ast.AsyncFunctionDef)
+_ASSIGNS = (ast.Assign, ast.AnnAssign, ast.AugAssign)
+
+
+class _Unknown(Exception):
+    """Raised when a module can not be fully understood statically"""
+
+
+def _matches_prefix_or_glob(name, patterns):
+    """Same as pytest's `PyCollector._matches_prefix_or_glob_option`"""
+    for pattern in patterns:
+        if name.startswith(pattern):
+            return True
+        elif ("*" in pattern or "?" in pattern or "[" in pattern) and fnmatch(name, pattern):
+            return True
+    return False
+
+
+def _get_targets(stmt):
+    """Return the names bound by an assignment statement"""
+    targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+    return [node.id for target in targets for node in ast.walk(target) if isinstance(node, ast.Name)]
+
+
+def _is_plain_target(target):
+    """Return True if the assignment target `target` only binds names (`a`, `a, *b`...)"""
+    if isinstance(target, (ast.Tuple, ast.List)):
+        return all(_is_plain_target(elt) for elt in target.elts)
+    if isinstance(target, ast.Starred):
+        return _is_plain_target(target.value)
+    return isinstance(target, ast.Name)
+
+
+def _is_plain_assign(stmt):
+    """Return True if `stmt` is an assignment statement that only binds names"""
+    if not isinstance(stmt, _ASSIGNS):
+        return False
+    targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+    return all(_is_plain_target(target) for target in targets)
+
+
+def _is_docstring(stmt):
+    """Return True if `stmt` is a string expression statement, such as a docstring"""
+    if not isinstance(stmt, ast.Expr):
+        return False
+    value = stmt.value
+    try:
+        # python 3.8+
+        return isinstance(value, ast.Constant) and isinstance(value.value, str)
+    except AttributeError:
+        return isinstance(value, ast.Str)
+
+
+class ModuleScanner(object):
+    """
+    Scans test modules statically, see module docstring.
+    """
+    __slots__ = 'markers', 'python_functions', 'python_classes'
+
+    def __init__(self,
+                 markers,           # type: Iterable[EasyMarker]
+                 python_functions,  # type: List[str]
+                 python_classes     # type: List[str]
+                 ):
+        self.markers = tuple(markers)
+        self.python_functions = python_functions
+        self.python_classes = python_classes
+
+    def scan(self, source, filename="<unknown>"):
+        # type: (...) -> Optional[List[FrozenSet[str]]]
+        """
+        Scans the source code of a test module.
+
+        :param source: the source code
+        :param filename: the file name, for error messages
+        :return: the list of units of the module (see module docstring), or None if the module can not be understood
+            statically.
+        """
+        try:
+            tree = ast.parse(source, filename)
+            return self._scan_module(tree)
+        except (SyntaxError, ValueError, _Unknown):
+            return None
+
+    def _is_test_function(self, name):
+        return _matches_prefix_or_glob(name, self.python_functions)
+
+    def _is_test_class(self, name):
+        return _matches_prefix_or_glob(name, self.python_classes)
+
+    def _scan_module(self, tree):
+        # local name -> (module name, attribute name or None)
+        imports = dict()
+        module_marks = frozenset()
+        units = []
+        for stmt in tree.body:
+            if isinstance(stmt, ast.Import):
+                for alias in stmt.names:
+                    if alias.asname is not None:
+                        self._bind(imports, alias.asname, (alias.name, None))
+                    else:
+                        top = alias.name.split('.')[0]
+                        self._bind(imports, top, (top, None))
+
+            elif isinstance(stmt, ast.ImportFrom):
+                for alias in stmt.names:
+                    if alias.name == '*':
+                        raise _Unknown()
+                    # note: relative imports are not resolved
+                    self._bind(imports, alias.asname or alias.name,
+                               (stmt.module, alias.name) if stmt.level == 0 else None)
+
+            elif isinstance(stmt, _FUNCTION_DEFS):
+                if self._is_test_function(stmt.name):
+                    units.append(self._get_marks(stmt.decorator_list, imports))
+                imports.pop(stmt.name, None)
+
+            elif isinstance(stmt, ast.ClassDef):
+                units += self._scan_class(stmt, imports)
+                imports.pop(stmt.name, None)
+
+            elif _is_plain_assign(stmt):
+                for name in _get_targets(stmt):
+                    if name == 'pytestmark':
+                        module_marks = self._get_pytestmark(stmt, imports)
+                    else:
+                        self._bind(imports, name, None)
+
+            elif not _is_docstring(stmt):
+                # anything else may define tests: function calls (`setattr(sys.modules[__name__], 'test_x', f)`),
+                # assignments to subscripts or attributes (`globals()['test_x'] = f`), compound statements...
+                raise _Unknown()
+
+        return [module_marks | unit for unit in units]
+
+    def _bind(self, imports, name, target):
+        """Binds `name` to the import `target`, or unbinds it if `target` is None"""
+        if self._is_test_function(name) or self._is_test_class(name):
+            # a test defined in another module, or dynamically
+            raise _Unknown()
+        if target is None:
+            imports.pop(name, None)
+        else:
+            imports[name] = target
+
+    def _scan_class(self, stmt, imports):
+        """Return the units of a class definition"""
+        has_bases = stmt.keywords or any(not (isinstance(b, ast.Name) and b.id == 'object') for b in stmt.bases)
+        if not has_bases and not self._is_test_class(stmt.name):
+            return []
+
+        class_marks = self._get_marks(stmt.decorator_list, imports)
+        for body_stmt in stmt.body:
+            if isinstance(body_stmt, _ASSIGNS) and 'pytestmark' in _get_targets(body_stmt):
+                class_marks |= self._get_pytestmark(body_stmt, imports)
+
+        if has_bases:
+            # inherited tests, unittest.TestCase subclass...: all tests of the class are a single unit
+            return [class_marks]
+
+        units = []
+        for body_stmt in stmt.body:
+            if isinstance(body_stmt, _FUNCTION_DEFS):
+                if self._is_test_function(body_stmt.name):
+                    units.append(class_marks | self._get_marks(body_stmt.decorator_list, imports))
+            elif isinstance(body_stmt, ast.ClassDef):
+                units += [class_marks | unit for unit in self._scan_class(body_stmt, imports)]
+            elif _is_plain_assign(body_stmt):
+                if any(self._is_test_function(name) for name in _get_targets(body_stmt)):
+                    raise _Unknown()
+            elif not (_is_docstring(body_stmt) or isinstance(body_stmt, ast.Pass)):
+                raise _Unknown()
+        return units
+
+    def _get_pytestmark(self, stmt, imports):
+        """Return the marks of a `pytestmark = <mark or list of marks>` statement"""
+        value = stmt.value
+        if value is None:
+            return frozenset()
+        elif isinstance(value, (ast.List, ast.Tuple)):
+            return self._get_marks(value.elts, imports)
+        else:
+            return self._get_marks([value], imports)
+
+    def _get_marks(self, nodes, imports):
+        # type: (...) -> FrozenSet[str]
+        """Return the set of ids of the markers that have at least one non-agnostic mark in the expressions `nodes`"""
+        marker_ids = set()
+        for node in nodes:
+            marker_id = self._get_marker_id(node, imports)
+            if marker_id is not None:
+                marker_ids.add(marker_id)
+        return frozenset(marker_ids)
+
+    def _get_marker_id(self, node, imports):
+        """Return the marker id if `node` is a non-agnostic mark of one of our markers, or None"""
+        if isinstance(node, ast.Call):
+            func, has_args = node.func, len(node.args) > 0
+        else:
+            func, has_args = node, None
+        obj = self._resolve(func, imports)
+
+        if isinstance(obj, EasyMarker):
+            if not any(obj is m for m in self.markers):
+                return None
+            if obj.has_arg:
+                # @marker(value). Note: @marker without value is not a valid mark
+                return obj.marker_id if has_args else None
+            else:
+                # @marker or @marker()
+                return obj.marker_id if not has_args else None
+
+        elif isinstance(obj, MarkDecorator):
+            # @pytest.mark.<marker_id>(...), or @<marker>.agnostic
+            mark = obj.mark
+            marker = self._get_marker(mark.name)
+            if marker is None:
+                return None
+            args = mark.args if has_args is None else (True,) if has_args else ()
+            if len(args) > 0 and args[0] is _AGNOSTIC:
+                return None
+            return marker.marker_id if len(args) > 0 or not marker.has_arg else None
+
+        return None
+
+    def _get_marker(self, marker_id):
+        for m in self.markers:
+            if m.marker_id == marker_id:
+                return m
+        return None
+
+    def _resolve(self, node, imports):
+        """
+        Returns the object that `node` (a name or attribute) refers to, using only modules that are already imported.
+        Only attributes of modules, of `pytest.mark` and of EasyMarkers are resolved.
+        """
+        if isinstance(node, ast.Name):
+            target = imports.get(node.id)
+            if target is None:
+                return _UNRESOLVED
+            module_name, attr = target
+            module = sys.modules.get(module_name)
+            if module is None:
+                return _UNRESOLVED
+            return module if attr is None else getattr(module, attr, _UNRESOLVED)
+
+        elif isinstance(node, ast.Attribute):
+            base = self._resolve(node.value, imports)
+            if base is _UNRESOLVED:
+                return _UNRESOLVED
+            elif isinstance(base, EasyMarker):
+                # note: we do not use `getattr` since `.agnostic` may issue a warning
+                return base.get_mark_decorator(agnostic=True) if node.attr == 'agnostic' else _UNRESOLVED
+            elif isinstance(base, MarkGenerator):
+                # only our (registered) markers, to avoid unknown marks warnings or errors
+                return getattr(base, node.attr) if self._get_marker(node.attr) is not None else _UNRESOLVED
+            elif type(base) is type(sys):
+                return getattr(base, node.attr, _UNRESOLVED)
+
+        return _UNRESOLVED
+
+
+class PrescanCache(object):
+    """
+    The pre-scan results of all test modules, stored in the pytest cache. The result of a module is reused as long as
+    the module and its conftest files are unchanged (modification time and size).
+    """
+    __slots__ = 'scanner', 'config', 'rootdir', 'fingerprints', 'entries', 'signature', 'dirty'
+
+    def __init__(self,
+                 scanner,  # type: ModuleScanner
+                 config,
+                 rootdir   # type: str
+                 ):
+        self.scanner = scanner
+        self.config = config
+        self.rootdir = rootdir
+        self.fingerprints = Fingerprints(rootdir, dict(python_files=config.getini("python_files"),
+                                                       norecursedirs=config.getini("norecursedirs")))
+        # the results depend on the markers and on the names of tests
+        self.signature = [[m.marker_id, m.has_arg] for m in scanner.markers] \
+            + [list(scanner.python_functions), list(scanner.python_classes)]
+        cache = getattr(config, 'cache', None)
+        data = cache.get(CACHE_KEY, None) if cache is not None else None
+        if data is not None and data.get('signature') == self.signature:
+            self.entries = data['modules']
+        else:
+            self.entries = dict()
+        self.dirty = False
+
+    def get_units(self, path):
+        # type: (str) -> Optional[List[FrozenSet[str]]]
+        """Return the units of the test module at `path`, see `ModuleScanner.scan`"""
+        rel_path = os.path.relpath(path, self.rootdir)
+        fingerprint = self.fingerprints.file(path)
+        try:
+            entry_fingerprint, units = self.entries[rel_path]
+        except KeyError:
+            pass
+        else:
+            if entry_fingerprint == fingerprint:
+                return [frozenset(unit) for unit in units] if units is not None else None
+
+        try:
+            with open(path, "rb") as f:
+                source = f.read()
+        except OSError:
+            return None
+        units = self.scanner.scan(source, path)
+        self.entries[rel_path] = [fingerprint, [sorted(unit) for unit in units] if units is not None else None]
+        self.dirty = True
+        return units
+
+    def save(self):
+        """Stores the results in the pytest cache, if they changed"""
+        cache = getattr(self.config, 'cache', None)
+        if self.dirty and cache is not None:
+            cache.set(CACHE_KEY, dict(signature=self.signature, modules=self.entries))
+            self.dirty = False
@@ -0,0 +1,78 @@
+"""
+The `--pilot-profile` option: measures the time spent in the hooks and fixture of pytest-pilot, and in the evaluation
+of each EasyMarker on items. When the option is not used, no `PilotProfile` is created and nothing is measured.
+"""
+import json
+from contextlib import contextmanager
+from timeit import default_timer
+
+try:  # python 3.5+
+    from typing import Dict, List
+except ImportError:
+    pass
+
+
+class PilotProfile(object):
+    """
+    The measures of the current session.
+    """
+    __slots__ = 'phases', 'markers', 'nb_items', 'nb_evaluations'
+
+    def __init__(self):
+        # {phase name: [nb calls, total time]} by order of first call
+        self.phases = dict()
+        # {marker id: [nb evaluations, total time]}
+        self.markers = dict()
+        self.nb_items = 0
+        self.nb_evaluations = 0
+
+    def add_phase(self, name, duration):
+        try:
+            phase = self.phases[name]
+        except KeyError:
+            self.phases[name] = [1, duration]
+        else:
+            phase[0] += 1
+            phase[1] += duration
+
+    @contextmanager
+    def timing(self, name):
+        """A context manager measuring the time spent in phase `name`"""
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add_phase(name, default_timer() - start)
+
+    def add_evaluation(self, marker_id, duration):
+        """Records the evaluation of marker `marker_id` on an item"""
+        self.nb_evaluations += 1
+        try:
+            counts = self.markers[marker_id]
+        except KeyError:
+            self.markers[marker_id] = [1, duration]
+        else:
+            counts[0] += 1
+            counts[1] += duration
+
+    def to_dict(self):
+        return dict(items=self.nb_items,
+                    evaluations=self.nb_evaluations,
+                    phases={name: dict(calls=calls, seconds=seconds) for name, (calls, seconds) in self.phases.items()},
+                    markers={marker_id: dict(evaluations=nb, seconds=seconds)
+                             for marker_id, (nb, seconds) in self.markers.items()})
+
+    def get_lines(self):
+        # type: (...) -> List[str]
+        """Return the lines of the profile report"""
+        lines = ["%-40s %8s call(s) %10.6fs" % (name, calls, seconds)
+                 for name, (calls, seconds) in self.phases.items()]
+        lines.append("%s item(s), %s (item, marker) evaluation(s)" % (self.nb_items, self.nb_evaluations))
+        for marker_id, (nb, seconds) in sorted(self.markers.items(), key=lambda e: -e[1][1]):
+            lines.append("  %-38s %8s eval(s) %10.6fs" % (marker_id, nb, seconds))
+        return lines
+
+    def write(self, path):
+        """Writes the profile as json in `path`"""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
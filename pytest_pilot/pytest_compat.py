@@ -75,6 +75,37 @@ def apply_mark_to(marker, on, is_pytest_param=True):
                 return pytest_param(on, marks=(marker,))
 
 
+def new_mark_decorator(cls, mark):
+    """Create a `MarkDecorator` of class `cls` (a subclass) for `mark`, without the private class warning"""
+    try:
+        # pytest 7+ warns when MarkDecorator is created directly
+        return cls(mark, _ispytest=True)
+    except TypeError:
+        return cls(mark)
+
+
+try:
+    from _pytest.mark.structures import Mark
+except ImportError:
+    # older pytest
+    Mark = None
+
+
+def new_mark(name):
+    """
+    Create a pytest `Mark` named `name`, without arguments, or return None if this is not possible with this version
+    of pytest. Contrary to `getattr(pytest.mark, name)`, this does not issue an unknown mark warning, so that the
+    warning filters do not have to be modified (which is not thread-safe).
+    """
+    if Mark is None:
+        return None
+    try:
+        # pytest 7+ warns when Mark is created directly
+        return Mark(name, (), {}, _ispytest=True)
+    except TypeError:
+        return Mark(name, (), {})
+
+
 def itermarkers(item, name):
     try:
         # newer pytest: markers with the same name can coexist
@@ -92,3 +123,100 @@ try:
     from _pytest.warning_types import PytestUnknownMarkWarning
 except ImportError:
     PytestUnknownMarkWarning = UserWarning
+
+
+try:
+    # pytest 7+
+    from pytest import StashKey
+
+    def new_stash_key():
+        return StashKey()
+
+    def stash_get(node, key, default=None):
+        return node.stash.get(key, default)
+
+    def stash_set(node, key, value):
+        node.stash[key] = value
+
+except ImportError:
+    try:
+        # pytest 5.4 and 6
+        from _pytest.store import StoreKey
+
+        def new_stash_key():
+            return StoreKey()
+
+        def stash_get(node, key, default=None):
+            return node._store.get(key, default)
+
+        def stash_set(node, key, value):
+            node._store[key] = value
+
+    except ImportError:
+        # older pytest: use a plain attribute on the node
+        def new_stash_key():
+            return "_pytest_pilot_%s" % id(object())
+
+        def stash_get(node, key, default=None):
+            return getattr(node, key, default)
+
+        def stash_set(node, key, value):
+            setattr(node, key, value)
+
+
+def get_cache_dir(config, name):
+    """Return the path (str) of the `name` directory in the pytest cache, or None if the cache plugin is disabled"""
+    cache = getattr(config, 'cache', None)
+    if cache is None:
+        return None
+    try:
+        # pytest 7+
+        return str(cache.mkdir(name))
+    except AttributeError:
+        return str(cache.makedir(name))
+
+
+def get_node_path(node):
+    """Return the path (str) of the file where `node` is defined"""
+    try:
+        # pytest 7+
+        return str(node.path)
+    except AttributeError:
+        return str(node.fspath)
+
+
+def get_rootdir(config):
+    """Return the rootdir (str) of the pytest session"""
+    try:
+        # pytest 6.1+
+        return str(config.rootpath)
+    except AttributeError:
+        return str(config.rootdir)
+
+
+def get_inipath(config):
+    """Return the path (str) of the configuration file of the pytest session, or None if there is none"""
+    try:
+        # pytest 6.1+
+        inipath = config.inipath
+    except AttributeError:
+        inipath = config.inifile
+    return str(inipath) if inipath else None
+
+
+def copy_function_item(item, name):
+    """
+    Return a new pytest `Function` item for the same test function and parametrization (callspec) as `item`, but with
+    a different `name`. The fixture information is shared with `item`.
+    """
+    kwargs = dict(name=name, originalname=item.originalname, fixtureinfo=item._fixtureinfo)
+    callspec = getattr(item, 'callspec', None)
+    if callspec is not None:
+        kwargs['callspec'] = callspec
+    try:
+        # pytest 5.4+
+        from_parent = type(item).from_parent
+    except AttributeError:
+        return type(item)(parent=item.parent, **kwargs)
+    else:
+        return from_parent(item.parent, **kwargs)
@@ -1,6 +1,9 @@
 from inspect import isfunction, isclass
 
+import logging
+import threading
 import warnings
+from collections import OrderedDict
 import pytest
 
 try:  # python 3.5+
@@ -9,17 +12,88 @@ except ImportError:
     pass
 
 from _pytest.mark import MarkDecorator
-from .pytest_compat import itermarkers, apply_mark_to, PytestUnknownMarkWarning
+from .pytest_compat import itermarkers, apply_mark_to, new_mark, new_mark_decorator, PytestUnknownMarkWarning
 
 
-info_mode = False
-debug_mode = False
+logger = logging.getLogger("pytest_pilot")
+
+# the separator of the values in a query, for example `--envid=a,b`
+QUERY_SEP = ','
+# the prefix of named groups of values in a query, for example `--envid=@staging`
+GROUP_PREFIX = '@'
+# the name of the ini option where groups are defined
+GROUPS_INI = 'pilot_groups'
+# the name of the ini option where markers can be declared, see `read_declared_markers`
+MARKERS_INI = 'pilot_markers'
+# the separator of the fields of a marker declaration, for example `envid = hard_filter; allowed_values = a, b`
+FIELDS_SEP = ';'
+# the query selecting all values, for example `--envid=all`
+ALL_VALUES_QUERY = 'all'
 
 
 def set_verbosity_level(pytest_config_verbositylevel):
-    global info_mode, debug_mode
-    info_mode = pytest_config_verbositylevel >= 3  # -vv
-    debug_mode = pytest_config_verbositylevel >= 4  # -vvv
+    """Sets the level of the `pytest_pilot` logger according to pytest verbosity. Below -vv, it is left untouched"""
+    if pytest_config_verbositylevel >= 4:  # -vvv
+        logger.setLevel(logging.DEBUG)
+    elif pytest_config_verbositylevel >= 3:  # -vv
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.NOTSET)
+
+
+def parse_query_groups(lines):
+    """
+    Parses the named groups of values defined in the `pilot_groups` ini option. Each line should have the form
+    `<marker_id>.<group> = <value>, <value>, ...`.
+
+    :param lines: the lines of the ini option
+    :return: a dictionary {marker_id: {group: tuple of values}}
+    :raises ValueError: if a line is not valid
+    """
+    groups = dict()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            name, values = line.split('=', 1)
+            marker_id, group = name.strip().split('.', 1)
+        except ValueError:
+            raise ValueError("Invalid line %r in ini option %r: it should have the form "
+                             "`<marker_id>.<group> = <value>, <value>...`" % (line, GROUPS_INI))
+        values = tuple(v.strip() for v in values.split(QUERY_SEP) if v.strip())
+        groups.setdefault(marker_id, dict())[group.strip()] = values
+    return groups
+
+
+def read_query_groups(config):
+    """
+    Returns the named groups of values defined in the `pilot_groups` ini option of `config`.
+
+    :param config: the pytest config
+    :return: a dictionary {marker_id: {group: tuple of values}}
+    :raises ValueError: if the ini option is not valid
+    """
+    try:
+        lines = config.getini(GROUPS_INI)
+    except ValueError:
+        # ini option not registered (pytest-pilot plugin not active)
+        return dict()
+    return parse_query_groups(lines)
+
+
+def _matches_any(query_values, required_marks):
+    """Return True if at least one of the `required_marks` is in the frozenset `query_values`"""
+    try:
+        return not query_values.isdisjoint(required_marks)
+    except TypeError:
+        # unhashable mark value
+        return any(v in required_marks for v in query_values)
+
+
+# with older pytest, the unknown mark warning has to be silenced when creating marks: at least do it in one thread at a
+# time (this is not needed with recent pytest, see `new_mark`)
+_legacy_creation_lock = threading.Lock()
 
 
 class EasyMarkerDecorator(MarkDecorator):
@@ -28,26 +102,94 @@ class EasyMarkerDecorator(MarkDecorator):
     """
     @classmethod
     def create_with_name(cls, name):
-        # create a pytest.mark.<name>, and copy its internal mark
-        _md = getattr(pytest.mark, name)
+        # create the mark directly when possible: this is thread-safe and issues no unknown mark warning
+        mark = new_mark(name)
+        if mark is not None:
+            return new_mark_decorator(cls, mark)
+
+        # older pytest: create a pytest.mark.<name>, and copy its internal mark
+        with _legacy_creation_lock, warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=PytestUnknownMarkWarning)
+            _md = getattr(pytest.mark, name)
         try:
             mark = _md.mark
         except AttributeError:
             # happens in pytest 2, to maybe move in compat in the future
             mark = _md.markname
-        return cls(mark)
+        return new_mark_decorator(cls, mark)
+
+    def with_args(self, *args, **kwargs):
+        """ Same as `MarkDecorator.with_args` but returns an `EasyMarkerDecorator`, so that `.param` is available """
+        return new_mark_decorator(type(self), super(EasyMarkerDecorator, self).with_args(*args, **kwargs).mark)
 
     def param(self, *values):
         """ Convenience shortcut for `pytest.param(*values, marks=self)` """
         return pytest.param(*values, marks=self)
 
 
-class _Agnostic:
-    """A special symbol used internally"""
+class _Agnostic(object):
+    """A special symbol used internally. It is a singleton: its only instance is `_AGNOSTIC`"""
+    __slots__ = ()
+
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+        return cls._instance
+
+    def __reduce__(self):
+        return _Agnostic, ()
+
     def __repr__(self):
         return "agnostic"
 
 
+_AGNOSTIC = _Agnostic()
+
+
+class NonComplianceReason(object):
+    """
+    The reason why an item is not compliant with a marker query. The message is only rendered when `str()` is called,
+    so that deselecting an item costs no string formatting.
+    """
+    __slots__ = 'template', 'args'
+
+    def __init__(self, template, *args):
+        self.template = template
+        self.args = args
+
+    def __str__(self):
+        return self.template % self.args
+
+    def __repr__(self):
+        return "NonComplianceReason(%r)" % str(self)
+
+
+class _MarkerRegistry(object):
+    """
+    The registry of all EasyMarkers created, by marker id. A marker created with the id of a registered marker replaces
+    it (for example when a conftest file is imported again by a new in-process pytest run), so that the registry does
+    not grow across runs.
+    """
+    __slots__ = '_markers', '_lock'
+
+    def __init__(self):
+        # marker_id -> marker, by order of first registration
+        self._markers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, marker):
+        with self._lock:
+            self._markers[marker.marker_id] = marker
+
+    def list_all(self):
+        # type: (...) -> List[EasyMarker]
+        """Return all the registered markers"""
+        with self._lock:
+            return list(self._markers.values())
+
+
 class EasyMarker(MarkDecorator):
     """
     A pair of marker + commandline option for pytest. See constructor for details
@@ -57,9 +199,10 @@ class EasyMarker(MarkDecorator):
                 'has_arg', 'allowed_values', 'used_values', \
                 'cmdoption_short', 'cmdoption_long',  \
                 'not_filtering_skips_marked', 'filtering_skips_unmarked', \
-                'cmdhelp', 'markhelp'
+                'cmdhelp', 'markhelp', \
+                '_base_decorator', '_decorators'
 
-    _all_markers = []
+    _registry = _MarkerRegistry()
 
     def __init__(self,
                  marker_id,             # type: str
@@ -71,6 +214,7 @@ class EasyMarker(MarkDecorator):
                  cmdoption_long=None,   # type: str
                  cmdhelp=None,          # type: str
                  markhelp=None,         # type: str
+                 register=True,         # type: bool
                  ):
         """
         Creates a pair of marker + commandline option for pytest. Marker instances can be used
@@ -114,6 +258,9 @@ class EasyMarker(MarkDecorator):
             will result in the option `'--env'`). `None` (default) will use `marker_id` for the long command option.
         :param cmdhelp: the help message displayed when `pytest --help` is called
         :param markhelp: the help message displayed when `pytest --markers` is called
+        :param register: if `True` (default), the marker is listed in `EasyMarker.list_all()` so that its command
+            option is added to pytest, and it replaces the listed marker with the same `marker_id` if any. The markers
+            declared in the `pilot_markers` ini option are created with `False`.
         """
 
         # mode validation
@@ -192,11 +339,16 @@ class EasyMarker(MarkDecorator):
         self.markhelp = markhelp if markhelp is not None else self._get_default_markhelp()
 
         # register the marker so that we can list them all in `list_all()`
-        EasyMarker._all_markers.append(self)
+        if register:
+            EasyMarker._registry.register(self)
 
-        # prepare to collect the list of values actually used
+        # the set of values used to create marks with this marker, see `get_mark_decorator`
         self.used_values = set()
 
+        # the mark decorators are created lazily and then shared, see `get_mark_decorator`
+        self._base_decorator = None
+        self._decorators = dict()
+
     @property
     def mark(self):
         # called by pytest when    pytest.param(<argvalue>, marks=<self>)
@@ -301,15 +453,28 @@ class EasyMarker(MarkDecorator):
         dynamically create @pytest.mark.<marker_id>(mark_value)
         and remembers the set of all used values
 
+        Decorators are interned: the same (immutable) decorator, and therefore the same pytest `Mark`, is returned
+        for the same arguments.
+
         :param mark_value:
         :return:
         """
+        # note: we include the types in the key so that for example 1 and True do not share the same decorator
+        key = (agnostic, mark_values, tuple(type(v) for v in mark_values))
+        try:
+            return self._decorators[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable value: do not intern
+            key = None
+
         nbargs = len(mark_values)
         if agnostic:
             # we expect no args
             if nbargs > 0:
                 raise ValueError("This marker '%s.agnostic' accepts no arguments" % self.marker_id)
-            mark_value = (_Agnostic(),)
+            mark_values = (_AGNOSTIC,)
         elif not self.has_arg:
             # we expect no args
             if nbargs > 0:
@@ -323,16 +488,26 @@ class EasyMarker(MarkDecorator):
                                  % (self.marker_id, nbargs, mark_values))
             else:
                 # single value:
-                # TODO self.used_values.add(mark_value[0]) but sometimes it received a MarkDecorator
                 if self.allowed_values is not None:
                     if mark_values[0] not in self.allowed_values:
                         raise ValueError("%r is not allowed for marker %r. Allowed values are %r"
                                          % (mark_values[0], self.marker_id, self.allowed_values))
-
-        # create it
-        with warnings.catch_warnings():
-            warnings.filterwarnings('ignore', category=PytestUnknownMarkWarning)
-            return EasyMarkerDecorator.create_with_name(self.marker_id)(*mark_values)
+                # remember it (only once, since the decorator is interned below)
+                try:
+                    self.used_values.add(mark_values[0])
+                except TypeError:
+                    # unhashable value
+                    pass
+
+        # create it. Note: this may happen concurrently in several threads, the first stored decorator wins
+        base_decorator = self._base_decorator
+        if base_decorator is None:
+            base_decorator = self._base_decorator = EasyMarkerDecorator.create_with_name(self.marker_id)
+        md = base_decorator.with_args(*mark_values) if nbargs > 0 or agnostic else base_decorator
+
+        if key is not None:
+            md = self._decorators.setdefault(key, md)
+        return md
 
     def apply_to_param_value(self, param_value, *args):
         """
@@ -353,17 +528,184 @@ class EasyMarker(MarkDecorator):
         :return:
         """
         # todo read item.callspec.params ?
-        marks = []
+        return self.parse_marks(itermarkers(item, name=self.marker_id))
+
+    def parse_marks(self, marks):
+        """
+        Helper function to convert pytest marks of this marker into the list of values marked, and whether the
+        agnostic mark is present.
+
+        :param marks: an iterable of pytest `Mark` with name `self.marker_id`
+        :return: a tuple (values, is_agnostic)
+        """
+        values = []
         is_agnostic = False
-        for mark in itermarkers(item, name=self.marker_id):
-            try:
-                if isinstance(mark.args[0], _Agnostic):
-                    is_agnostic = True
-                    continue
-            except:  # noqa  # IndexError or any other error happening during isinstance
-                pass
-            marks.append(mark.args[0] if self.has_arg else True)
-        return marks, is_agnostic
+        for mark in marks:
+            args = mark.args
+            if len(args) > 0 and args[0] is _AGNOSTIC:
+                is_agnostic = True
+                continue
+            values.append(mark.args[0] if self.has_arg else True)
+        return values, is_agnostic
+
+    def get_query(self, config):
+        """
+        Returns the current value of the filtering commandline option associated with this marker.
+
+        :param config: the pytest config
+        :return: the option value, or None if it can not be read
+        """
+        try:
+            return config.getoption(self.cmdoption_long[2:])
+        except ValueError:
+            # ValueError: no option named 'a' can happen sometimes/ in some versions
+            return None
+        except AttributeError:
+            # AttributeError: 'Namespace' object has no attribute 'a' can happen sometimes/ in some versions
+            return None
+
+    def is_no_query(self, query):
+        """Return True if `query` means that the filtering commandline option was not used"""
+        return query is None if self.has_arg else query is False
+
+    def is_all_query(self, query):
+        """
+        Return True if `query` selects all values, for example `--envid=all`. This is not the case if 'all' is one of
+        the `allowed_values`.
+        """
+        return self.has_arg and query == ALL_VALUES_QUERY \
+            and (self.allowed_values is None or ALL_VALUES_QUERY not in self.allowed_values)
+
+    def parse_query(self, query, groups=None):
+        """
+        Parses a filtering query into the set of values that it selects. A query can be a single value, several
+        comma-separated values (`a,b,c`) and/or named groups of values (`@staging`).
+
+        :param query: the filtering query (the value of the commandline option). A set, list or tuple of values is
+            also accepted.
+        :param groups: an optional dictionary {group: values} of the named groups defined for this marker
+        :return: a frozenset of values, or `query` itself if this marker has no argument or if the option was not used
+        :raises ValueError: if a group is unknown, or if a value is not in `allowed_values`
+        """
+        if not self.has_arg or self.is_no_query(query):
+            return query
+
+        if isinstance(query, str):
+            values = []
+            for v in query.split(QUERY_SEP):
+                v = v.strip()
+                if v.startswith(GROUP_PREFIX):
+                    try:
+                        values.extend(groups[v[len(GROUP_PREFIX):]])
+                    except (KeyError, TypeError):
+                        raise ValueError("Unknown group %r for marker %r. Groups can be defined in the %r ini option, "
+                                         "with lines such as `%s.<group> = <value>, <value>`. Known groups are %r"
+                                         % (v, self.marker_id, GROUPS_INI, self.marker_id, sorted(groups or ())))
+                elif len(v) > 0:
+                    values.append(v)
+        elif isinstance(query, (set, frozenset, list, tuple)):
+            values = query
+        else:
+            values = (query,)
+
+        if len(values) == 0:
+            raise ValueError("Empty query %r for marker %r" % (query, self.marker_id))
+
+        if self.allowed_values is not None:
+            for v in values:
+                if v not in self.allowed_values:
+                    raise ValueError("%r is not allowed for marker %r. Allowed values are %r"
+                                     % (v, self.marker_id, self.allowed_values))
+
+        return frozenset(values)
+
+    def compile_query(self, query, groups=None):
+        """
+        Creates the decision function corresponding to `query`, so that the query and the mode flags of this marker
+        are only interpreted once. The returned function has signature `decide(item, required_marks, is_agnostic)`
+        where `required_marks, is_agnostic` are the results of `read_marks(item)`. It returns a `NonComplianceReason`
+        explaining why the item is not compliant, or None if the item is compliant.
+
+        :param query: the filtering query (the value of the commandline option), see `parse_query`
+        :param groups: an optional dictionary {group: values} of the named groups defined for this marker
+        :return: the decision function, or None if no item can be non-compliant with this query.
+        :raises ValueError: if the query is not valid, see `parse_query`
+        """
+        marker_id, cmdoption_long, has_arg = self.marker_id, self.cmdoption_long, self.has_arg
+
+        if self.is_no_query(query):
+            # /1/ no query: we run without CLI option filter
+            if not self.not_filtering_skips_marked:
+                # (b) keep all tests
+                logger.info("[pytest-pilot] [marker %s] option '%s' was not used, all items can run",
+                            marker_id, cmdoption_long)
+                return None
+
+            def decide(item, required_marks, is_agnostic):
+                # (a) skip all tests that have marks
+                if len(required_marks) > 0:
+                    if has_arg:
+                        if len(required_marks) == 1:
+                            return NonComplianceReason("This test requires %r=%r. Run `pytest %s=%s` to activate it.",
+                                                       marker_id, required_marks[0], cmdoption_long, required_marks[0])
+                        else:
+                            return NonComplianceReason("This test requires %r in %r. Run `pytest %s=<arg>` to "
+                                                       "activate it.", marker_id, required_marks, cmdoption_long)
+                    else:
+                        return NonComplianceReason("This test requires %r. Run `pytest %s` to activate it.",
+                                                   marker_id, cmdoption_long)
+                elif logger.isEnabledFor(logging.INFO):
+                    logger.info("[pytest-pilot] %s [marker %s] item has no marks and option '%s' was not used, item "
+                                "can run", item, marker_id, cmdoption_long)
+                return None
+
+        else:
+            # /2/ query = we run with a CLI option filter, for example `pytest --envid=a` or `pytest --blue`.
+            if not has_arg and not self.filtering_skips_unmarked:
+                # marked items match the query, and unmarked items are kept
+                logger.info("[pytest-pilot] [marker %s] option '%s' was used, all items can run",
+                            marker_id, cmdoption_long)
+                return None
+
+            filtering_skips_unmarked = self.filtering_skips_unmarked
+            # note: with the 'all' query, any mark matches
+            query_values = None if self.is_all_query(query) else self.parse_query(query, groups)
+
+            def decide(item, required_marks, is_agnostic):
+                if len(required_marks) > 0:
+                    # -- current test has at least 1 mark of this type: if the mark has an arg, check that it matches.
+                    # NOTE: ONE MATCH IS ENOUGH to avoid being skipped ! (this is an OR, not an AND)
+                    if has_arg and query_values is not None and not _matches_any(query_values, required_marks):
+                        if len(required_marks) == 1:
+                            return NonComplianceReason("This test requires %r=%r. Currently `%s=%s` so it is skipped.",
+                                                       marker_id, required_marks[0], cmdoption_long, query)
+                        else:
+                            return NonComplianceReason("This test requires %r in %r. Currently `%s=%s` so it is "
+                                                       "skipped.", marker_id, required_marks, cmdoption_long, query)
+                    elif logger.isEnabledFor(logging.INFO):
+                        # match: the test has the right mark
+                        logger.info("[pytest-pilot] %s [marker %s] item marks %r matches query filter '%s', it can run",
+                                    item, marker_id, required_marks, query)
+                else:
+                    # -- the test does not have this mark.
+                    if is_agnostic:
+                        if logger.isEnabledFor(logging.INFO):
+                            logger.info("[pytest-pilot] %s [marker %s] item has an 'agnostic' mark, it can run",
+                                        item, marker_id)
+                    elif filtering_skips_unmarked:
+                        # (a) skip all tests that have no marks
+                        if has_arg:
+                            return NonComplianceReason("This test does not have mark '%s', and pytest was run with "
+                                                       "`%s=%s` so it is skipped.", marker_id, cmdoption_long, query)
+                        else:
+                            return NonComplianceReason("This test does not have mark '%s', and pytest was run with "
+                                                       "`%s` so it is skipped.", marker_id, cmdoption_long)
+                    elif logger.isEnabledFor(logging.INFO):
+                        # (b) keep all tests that have no marks
+                        logger.info("[pytest-pilot] %s [marker %s] item has no marks, it can run", item, marker_id)
+                return None
+
+        return decide
 
     def is_not_compliant(self, item, query=None):
         """
@@ -376,11 +718,10 @@ class EasyMarker(MarkDecorator):
         """
         is_not_compliant = False
 
-        def _skip(msg):
+        def _skip(reason):
             nonlocal is_not_compliant
 
-            if debug_mode:
-                print(msg)
+            logger.debug("%s", reason)
             is_not_compliant = True
 
         self._do_if_not_compliant(_skip, item=item, query=query)
@@ -396,91 +737,95 @@ class EasyMarker(MarkDecorator):
         :param query: if None, the current options from item.config is used
         :return:
         """
-        self._do_if_not_compliant(pytest.skip, item=item, query=query)
+        def _skip(reason):
+            pytest.skip(str(reason))
 
-    def _do_if_not_compliant(self, func, item, query=None):
+        self._do_if_not_compliant(_skip, item=item, query=query)
 
-        logprefix = "[pytest-pilot] %s [marker %s] " % (item, self.marker_id)
+    def _do_if_not_compliant(self, func, item, query=None):
 
-        if debug_mode:
-            print('%s checking if item should be skipped according to options' % logprefix)
+        logger.debug("[pytest-pilot] %s [marker %s] checking if item should be skipped according to options",
+                     item, self.marker_id)
 
         if query is None:
             # usage in pytest
-            try:
-                query = item.config.getoption(self.cmdoption_long[2:])
-                if debug_mode:
-                    print("%s filtering query option '%s' is currently '%s'" % (logprefix, self.cmdoption_long, query))
-            except ValueError:
-                # ValueError: no option named 'a' can happen sometimes/ in some versions
-                pass
-            except AttributeError:
-                # AttributeError: 'Namespace' object has no attribute 'a' can happen sometimes/ in some versions
-                pass
-
-        required_marks, is_agnostic = self.read_marks(item)
-        no_query = query is None if self.has_arg else query is False
-
-        if no_query:
-            # /1/ no query: we run without CLI option filter
-            if self.not_filtering_skips_marked:
-                # (a) skip all tests that have marks
-                if len(required_marks) > 0:
-                    if self.has_arg:
-                        if len(required_marks) == 1:
-                            func("This test requires %r=%r. Run `pytest %s=%s` to activate it."
-                                        % (self.marker_id, required_marks[0], self.cmdoption_long, required_marks[0]))
-                        else:
-                            func("This test requires %r in %r. Run `pytest %s=<arg>` to activate it."
-                                        % (self.marker_id, required_marks, self.cmdoption_long))
-                    else:
-                        func("This test requires %r. Run `pytest %s` to activate it."
-                                    % (self.marker_id, self.cmdoption_long))
-                else:
-                    if info_mode:
-                        print("%s item has no marks and option '%s' was not used, item can run"
-                              % (logprefix, self.cmdoption_long))
-            else:
-                # (b) keep all tests
-                if info_mode:
-                    print("%s option '%s' was not used, all items can run" % (logprefix, self.cmdoption_long))
+            query = self.get_query(item.config)
+            logger.debug("[pytest-pilot] %s [marker %s] filtering query option '%s' is currently '%s'",
+                         item, self.marker_id, self.cmdoption_long, query)
 
-        else:
-            # /2/ query = we run with a CLI option filter, for example `pytest --envid=a` or `pytest --blue`.
-            if len(required_marks) > 0:
-                # -- current test has at least 1 mark of this type: if the mark has an arg, check that it matches query.
-                # NOTE: ONE MATCH IS ENOUGH to avoid being skipped ! (this is an OR, not an AND)
-                if self.has_arg and query not in required_marks:
-                    if len(required_marks) == 1:
-                        func("This test requires %r=%r. Currently `%s=%s` so it is skipped."
-                                    % (self.marker_id, required_marks[0], self.cmdoption_long, query))
-                    else:
-                        func("This test requires %r in %r. Currently `%s=%s` so it is skipped."
-                                    % (self.marker_id, required_marks[0], self.cmdoption_long, query))
-                else:
-                    # match: the test has the right mark
-                    if info_mode:
-                        print("%s item marks %r matches query filter '%s', it can run"
-                              % (logprefix, required_marks, query))
-            else:
-                # -- the test does not have this mark.
-                if is_agnostic:
-                    if info_mode:
-                        print("%s item has an 'agnostic' mark, it can run" % (logprefix, ))
-                elif self.filtering_skips_unmarked:
-                    # (a) skip all tests that have no marks
-                    if self.has_arg:
-                        func("This test does not have mark '%s', and pytest was run with `%s=%s` so it is "
-                                    "skipped." % (self.marker_id, self.cmdoption_long, query))
-                    else:
-                        func("This test does not have mark '%s', and pytest was run with `%s` so it is "
-                                    "skipped." % (self.marker_id, self.cmdoption_long))
-                else:
-                    # (b) keep all tests that have no marks
-                    if info_mode:
-                        print("%s item has no marks, it can run" % (logprefix, ))
+        decide = self.compile_query(query, read_query_groups(item.config).get(self.marker_id))
+        if decide is not None:
+            required_marks, is_agnostic = self.read_marks(item)
+            reason = decide(item, required_marks, is_agnostic)
+            if reason is not None:
+                func(reason)
 
     @classmethod
     def list_all(cls):
         # type: (...) -> List[EasyMarker]
-        return cls._all_markers
+        """Return all the markers created, without duplicate marker ids"""
+        return cls._registry.list_all()
+
+
+# the names of the `EasyMarker` arguments that can be set in a marker declaration, see `parse_marker_declarations`
+_DECLARATION_FIELDS = ('full_name', 'has_arg', 'allowed_values', 'cmdoption_short', 'cmdoption_long', 'cmdhelp',
+                       'markhelp')
+_TRUE_STRINGS = ('true', 'yes', 'on', '1')
+_FALSE_STRINGS = ('false', 'no', 'off', '0')
+
+
+def parse_marker_declarations(lines):
+    # type: (...) -> List[EasyMarker]
+    """
+    Creates the markers declared in the `pilot_markers` ini option. Each line should have the form
+    `<marker_id> = <mode>; <argument> = <value>; ...` where the optional arguments are the ones of `EasyMarker`
+    (`full_name`, `has_arg`, `allowed_values`, `cmdoption_short`, `cmdoption_long`, `cmdhelp` and `markhelp`).
+    `has_arg` is `true` or `false`, and `allowed_values` is a comma-separated list of values.
+
+    The markers are not registered in `EasyMarker.list_all()`: they belong to the configuration file.
+
+    :param lines: the lines of the ini option
+    :return: the list of declared markers
+    :raises ValueError: if a line is not valid
+    """
+    markers = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            marker_id, fields = line.split('=', 1)
+            fields = fields.split(FIELDS_SEP)
+            kwargs = dict(mode=fields[0].strip())
+            for field in fields[1:]:
+                if not field.strip():
+                    continue
+                name, value = field.split('=', 1)
+                name, value = name.strip(), value.strip()
+                if name not in _DECLARATION_FIELDS:
+                    raise ValueError("unknown argument %r, supported arguments are %s" % (name, _DECLARATION_FIELDS))
+                if name == 'has_arg':
+                    if value.lower() not in _TRUE_STRINGS + _FALSE_STRINGS:
+                        raise ValueError("`has_arg` should be `true` or `false`, found %r" % value)
+                    value = value.lower() in _TRUE_STRINGS
+                elif name == 'allowed_values':
+                    value = tuple(v.strip() for v in value.split(QUERY_SEP) if v.strip())
+                kwargs[name] = value
+            marker = EasyMarker(marker_id.strip(), register=False, **kwargs)
+        except ValueError as e:
+            raise ValueError("Invalid line %r in ini option %r: it should have the form "
+                             "`<marker_id> = <mode>; <argument> = <value>...`. %s" % (line, MARKERS_INI, e))
+        markers.append(marker)
+    return markers
+
+
+def read_declared_markers(config):
+    # type: (...) -> List[EasyMarker]
+    """
+    Returns the markers declared in the `pilot_markers` ini option of `config`.
+
+    :param config: the pytest config
+    :return: the list of declared markers
+    :raises ValueError: if the ini option is not valid
+    """
+    return parse_marker_declarations(config.getini(MARKERS_INI))
@@ -0,0 +1,127 @@
+"""
+The pytest-xdist scheduler used with `--pilot-concurrency` and the `load` distribution (the default of `-n`). This
+module imports pytest-xdist, it is only imported by the `pytest_xdist_make_scheduler` hook.
+
+It distributes the items like the `load` scheduler of pytest-xdist, except that a limited item is only sent to a worker
+if fewer than `n` workers have pending items of each of its limits, or if this worker already has some (a worker runs
+its items one at a time). Otherwise the item is held back, and the next items that can be sent are sent instead, so that
+the queue of a worker never waits behind a limited item. Held back items are sent as soon as a worker completes the last
+pending item of their limits.
+
+A pytest-xdist worker only runs an item once it has received the next one (or once it is shut down): if no worker has
+more than one pending item, nothing runs anymore. If all the remaining items are then held back (this can only happen
+with items that have several limits), the first one is sent anyway, and the lock files of the workers enforce the
+limits, see `concurrency.py`.
+"""
+import json
+import os
+
+try:  # python 3.5+
+    from typing import Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+from xdist.scheduler import LoadScheduling
+
+from .concurrency import ITEMS_FILE_NAME, ConcurrencyLimit
+
+
+class LimitedLoadScheduling(LoadScheduling):
+    """
+    The `load` scheduler of pytest-xdist, holding back the limited items while their limits are reached. See module
+    docstring.
+    """
+
+    def __init__(self,
+                 config,
+                 log,
+                 limits,    # type: List[ConcurrencyLimit]
+                 directory  # type: str
+                 ):
+        super(LimitedLoadScheduling, self).__init__(config, log)
+        self.limits = limits
+        # the directory where workers write the limits of their items
+        self.directory = directory
+        # the indices of the limits of each item of the collection, read when the first collection is received
+        self.item_limits = None  # type: Optional[List[Tuple[int, ...]]]
+        # for each limit, the number of pending items of this limit on each node {node: count}
+        self.holders = [dict() for _ in limits]  # type: List[Dict]
+
+    def add_node_collection(self, node, collection):
+        super(LimitedLoadScheduling, self).add_node_collection(node, collection)
+        if self.item_limits is None and node in self.node2collection:
+            with open(os.path.join(self.directory, ITEMS_FILE_NAME % node.gateway.id)) as f:
+                limits_by_nodeid = json.load(f)
+            self.item_limits = [tuple(limits_by_nodeid.get(nodeid, ())) for nodeid in collection]
+
+    def can_send(self, node, item_index):
+        """Return True if the item at `item_index` can be sent to `node` without exceeding its limits"""
+        for i in self.item_limits[item_index]:
+            holders = self.holders[i]
+            if node not in holders and len(holders) >= self.limits[i].limit:
+                return False
+        return True
+
+    def _hold(self, node, item_index):
+        for i in self.item_limits[item_index]:
+            holders = self.holders[i]
+            holders[node] = holders.get(node, 0) + 1
+
+    def _release(self, node, item_index):
+        for i in self.item_limits[item_index]:
+            holders = self.holders[i]
+            if holders[node] == 1:
+                del holders[node]
+            else:
+                holders[node] -= 1
+
+    def _send_tests(self, node, num):
+        # the first `num` pending items that can be sent. The other ones stay pending, in order
+        to_send = []
+        held_back = []
+        for position, item_index in enumerate(self.pending):
+            if len(to_send) == num:
+                held_back += self.pending[position:]
+                break
+            if self.can_send(node, item_index):
+                self._hold(node, item_index)
+                to_send.append(item_index)
+            else:
+                held_back.append(item_index)
+        if to_send:
+            self.pending[:] = held_back
+            self.node2pending[node].extend(to_send)
+            node.send_runtest_some(to_send)
+
+    def _unblock(self):
+        """Sends items to the nodes left without enough items to run, see module docstring"""
+        for node in self.nodes:
+            if len(self.node2pending[node]) < 2:
+                self.check_schedule(node)
+        if self.pending and all(len(pending) < 2 for pending in self.node2pending.values()):
+            # nothing runs anymore: the first held back item is sent anyway, preferably to a node waiting for its
+            # next item
+            nodes = [node for node in self.nodes if not node.shutting_down]
+            if nodes:
+                node = max(nodes, key=lambda n: len(self.node2pending[n]))
+                item_index = self.pending.pop(0)
+                self._hold(node, item_index)
+                self.node2pending[node].append(item_index)
+                node.send_runtest_some([item_index])
+
+    def schedule(self):
+        super(LimitedLoadScheduling, self).schedule()
+        if self.collection:
+            self._unblock()
+
+    def mark_test_complete(self, node, item_index, duration=0):
+        self._release(node, item_index)
+        super(LimitedLoadScheduling, self).mark_test_complete(node, item_index, duration)
+        # the items held back by this node can now be sent to the other nodes
+        self._unblock()
+
+    def remove_node(self, node):
+        # (the pending items of a crashed node are scheduled again)
+        for holders in self.holders:
+            holders.pop(node, None)
+        return super(LimitedLoadScheduling, self).remove_node(node)
@@ -0,0 +1,514 @@
+from timeit import default_timer
+
+try:  # python 3.5+
+    from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+except ImportError:
+    pass
+
+from _pytest.config import UsageError
+
+from .expr import compile_expression
+from .matrix import parse_matrix
+from .whatif import parse_what_if
+from .pytest_compat import copy_function_item, itermarkers, new_stash_key, stash_get, stash_set
+from .pytest_marks import EasyMarker, NonComplianceReason, logger, read_query_groups
+
+
+# the key used to store the decision taken for each item during collection
+DECISION_KEY = new_stash_key()
+
+# the value returned by `stash_get` when an item was not evaluated during collection
+_NOT_EVALUATED = object()
+
+# the key used to store the marker values {marker_id: value} of the items created by `SelectionPlan.expand`, and of
+# the items run by a `--pilot-matrix` child
+VALUES_KEY = new_stash_key()
+
+# the key used to cache the marks of parent nodes and their own parents, see `MarksReader`
+CHAIN_MARKS_KEY = new_stash_key()
+
+# with --pilot-threads, below this number of items per thread the items are evaluated in the main thread
+_MIN_ITEMS_PER_THREAD = 500
+
+
+class MarkerFilter(object):
+    """
+    The filter associated with an EasyMarker for the current session: the resolved query, the mode flags, and the
+    decision function compiled from them with `EasyMarker.compile_query`.
+    """
+    __slots__ = 'marker', 'query', 'not_filtering_skips_marked', 'filtering_skips_unmarked', 'decide', \
+                'prunes_marked', 'expands'
+
+    def __init__(self,
+                 marker,      # type: EasyMarker
+                 query,       # type: Any
+                 groups=None  # type: Dict[str, Tuple]
+                 ):
+        self.marker = marker
+        self.query = query
+        self.not_filtering_skips_marked = marker.not_filtering_skips_marked
+        self.filtering_skips_unmarked = marker.filtering_skips_unmarked
+        self.decide = marker.compile_query(query, groups)
+        # when the option is not used and marked items are skipped, an item is non-compliant as soon as one of its
+        # parents is marked, whatever its own marks: whole subtrees can be pruned.
+        self.prunes_marked = marker.is_no_query(query) and self.not_filtering_skips_marked
+        # with the 'all' query, marked items are run once per value
+        self.expands = marker.is_all_query(query)
+
+    @property
+    def can_deselect(self):
+        """Return True if at least one item can be non-compliant with this filter"""
+        return self.decide is not None
+
+    def __repr__(self):
+        return "MarkerFilter(%s=%r)" % (self.marker.marker_id, self.query)
+
+
+class MarksReader(object):
+    """
+    Reads the marks of several EasyMarkers on an item in a single traversal of its node chain, instead of one
+    traversal per marker. The marks contributed by the parent nodes (class, module, package...) are cached on these
+    nodes, so that sibling items (for example parametrized ones) only have to read their own marks.
+    """
+    __slots__ = 'markers', 'marker_ids'
+
+    def __init__(self,
+                 markers  # type: Iterable[EasyMarker]
+                 ):
+        self.markers = tuple(markers)
+        self.marker_ids = frozenset(m.marker_id for m in self.markers)
+
+    def _filter_marks(self, marks, res=None):
+        """Return a dictionary {marker_id: [marks]} of the `marks` of the markers we are interested in"""
+        if res is None:
+            res = dict()
+        marker_ids = self.marker_ids
+        for mark in marks:
+            name = mark.name
+            if name in marker_ids:
+                try:
+                    res[name].append(mark)
+                except KeyError:
+                    res[name] = [mark]
+        return res
+
+    def _merge_with_parent(self, own_marks, node):
+        """Merge `own_marks` with the marks of the parents of `node`, nearest first (same order as `iter_markers`)"""
+        parent = node.parent
+        if parent is None:
+            return own_marks
+        parent_marks = self._get_chain_marks(parent)
+        if not parent_marks:
+            return own_marks
+        elif not own_marks:
+            return parent_marks
+        else:
+            merged = dict(parent_marks)
+            for name, marks in own_marks.items():
+                merged[name] = marks + parent_marks.get(name, [])
+            return merged
+
+    def _get_chain_marks(self, node):
+        """Return the marks of `node` and its parents. The result is cached on `node`."""
+        chain_marks = stash_get(node, CHAIN_MARKS_KEY)
+        if chain_marks is None:
+            chain_marks = self._merge_with_parent(self._filter_marks(node.own_markers), node)
+            stash_set(node, CHAIN_MARKS_KEY, chain_marks)
+        return chain_marks
+
+    def read_chain_marks(self, node):
+        """
+        Return a dictionary {marker_id: [marks]} containing the marks of all markers on `node` and its parents. The
+        result is cached on `node`, so this should only be used on collectors.
+
+        :param node: the pytest collector
+        :return:
+        """
+        return self._get_chain_marks(node)
+
+    def read_marks(self, item):
+        """
+        Return a dictionary {marker_id: [marks]} containing the marks of all markers on `item`, in the same order as
+        `item.iter_markers(marker_id)`. The item's own marks are not cached since they include its callspec marks.
+
+        :param item: the pytest item
+        :return:
+        """
+        try:
+            own_markers = item.own_markers
+        except AttributeError:
+            # older pytest: no node-level marks, read them one marker at a time
+            return {m.marker_id: list(itermarkers(item, m.marker_id)) for m in self.markers}
+        return self._merge_with_parent(self._filter_marks(own_markers), item)
+
+    def read_callspec_marks(self, definition, callspec):
+        """
+        Return a dictionary {marker_id: [marks]} containing the marks of all markers on the item that will be created
+        for `callspec` from the function `definition`, in the same order as `item.iter_markers(marker_id)`.
+
+        :param definition: the function definition (`metafunc.definition`)
+        :param callspec: one of the callspecs generated by parametrization on `definition`
+        :return:
+        """
+        own_marks = self._filter_marks(callspec.marks, res=self._filter_marks(definition.own_markers))
+        return self._merge_with_parent(own_marks, definition)
+
+
+class SelectionPlan(object):
+    """
+    The selection plan of the session: it is built once in `pytest_configure` from the commandline options, and then
+    used to evaluate all items during collection and setup.
+    """
+    __slots__ = 'markers', 'filters', 'active_filters', 'expanding_filters', 'expr', 'matrix', 'what_if', 'reader', \
+                'skip_mode', 'pruning_filters', 'prune_params', 'prescan_marker_ids', \
+                'nb_pruned', 'nb_pruned_params', 'nb_prescanned', 'pruned_paths', 'profile', 'threads'
+
+    def __init__(self,
+                 markers,    # type: Iterable[EasyMarker]
+                 config,
+                 ):
+        self.markers = tuple(markers)
+        try:
+            groups = read_query_groups(config)
+            self.filters = tuple(MarkerFilter(marker, marker.get_query(config), groups.get(marker.marker_id))
+                                 for marker in self.markers)
+        except ValueError as e:
+            raise UsageError("pytest-pilot: %s" % e)
+
+        # the --pilot-expr expression, that replaces the filters of the markers it uses
+        expr_source = config.getoption("--pilot-expr")
+        if expr_source is not None:
+            self.expr = compile_expression(expr_source, self.markers)
+            for f in self.filters:
+                if f.marker.marker_id in self.expr.marker_ids and not f.marker.is_no_query(f.query):
+                    raise UsageError("`%s` can not be used together with `--pilot-expr %s` since this expression "
+                                     "uses marker %r" % (f.marker.cmdoption_long, expr_source, f.marker.marker_id))
+            expr_marker_ids = self.expr.marker_ids
+        else:
+            self.expr = None
+            expr_marker_ids = ()
+
+        # the --pilot-matrix marker, whose filter is applied separately for each value, in forked children
+        matrix_source = config.getoption("--pilot-matrix")
+        if matrix_source is not None:
+            self.matrix = parse_matrix(matrix_source, self.markers, groups, config.getoption("--pilot-matrix-jobs"))
+            matrix_marker_id = self.matrix.marker.marker_id
+            for f in self.filters:
+                if f.marker.marker_id == matrix_marker_id and not f.marker.is_no_query(f.query):
+                    raise UsageError("`%s` can not be used together with `--pilot-matrix %s`"
+                                     % (f.marker.cmdoption_long, matrix_source))
+            if matrix_marker_id in expr_marker_ids:
+                raise UsageError("`--pilot-expr %s` can not use marker %r since it is used in `--pilot-matrix %s`"
+                                 % (expr_source, matrix_marker_id, matrix_source))
+            if config.getoption("--pilot-skip"):
+                raise UsageError("`--pilot-skip` can not be used together with `--pilot-matrix`")
+        else:
+            self.matrix = None
+            matrix_marker_id = None
+
+        # the --pilot-what-if grid of configurations, evaluated instead of running tests
+        what_if_sources = config.getoption("--pilot-what-if")
+        if what_if_sources:
+            self.what_if = parse_what_if(what_if_sources, self.markers, groups)
+            for marker_id in self.what_if.marker_ids:
+                if marker_id in expr_marker_ids:
+                    raise UsageError("`--pilot-expr %s` can not use marker %r since it is used in `--pilot-what-if`"
+                                     % (expr_source, marker_id))
+        else:
+            self.what_if = None
+
+        # only the filters that can deselect something need to be evaluated on items
+        self.active_filters = tuple(f for f in self.filters if f.can_deselect and f.marker.marker_id != matrix_marker_id
+                                    and f.marker.marker_id not in expr_marker_ids)
+        self.expanding_filters = tuple(f for f in self.filters if f.expands)
+        # note: the reader reads the marks of all markers, for example to build the marks index
+        self.reader = MarksReader(self.markers)
+        self.skip_mode = config.getoption("--pilot-skip")
+
+        # pruning during collection, only in deselect mode and if option is set
+        # note: with --pilot-what-if, all items are needed
+        prune = not self.skip_mode and self.what_if is None and config.getoption("--pilot-prune")
+        # - filters able to prune whole subtrees
+        self.pruning_filters = tuple(f for f in self.active_filters if f.prunes_marked) if prune else ()
+        self.nb_pruned = 0
+        # - parametrization
+        self.prune_params = prune and not self.is_trivial
+        self.nb_pruned_params = 0
+        # - static pre-scan of test modules: the ids of the markers whose marks make a test deselected, whatever its
+        #   other marks
+        prescan = not self.skip_mode and self.what_if is None and config.getoption("--pilot-prescan")
+        self.prescan_marker_ids = frozenset(f.marker.marker_id for f in self.active_filters if f.prunes_marked) \
+            if prescan else frozenset()
+        self.nb_prescanned = 0
+        # the test files where at least a test was pruned
+        self.pruned_paths = set()
+        # the `PilotProfile` recording the evaluations of markers, with --pilot-profile
+        self.profile = None
+        # the number of threads evaluating items in `select`
+        threads = config.getoption("--pilot-threads")
+        if threads is not None and threads < 1:
+            raise UsageError("`--pilot-threads` should be at least 1, found %s" % threads)
+        self.threads = threads or 1
+
+    @property
+    def is_trivial(self):
+        """Return True if no item can be non-compliant with this plan, so that items do not need to be evaluated"""
+        return len(self.active_filters) == 0 and self.expr is None
+
+    def get_queries(self, item=None):
+        """
+        Return a dictionary of all current queries, by option name. If `item` runs with a given value of some markers
+        (items created by `expand`, or run by a `--pilot-matrix` child), their queries are replaced with this value.
+        """
+        queries = {f.marker.cmdoption_long[2:]: f.query for f in self.filters}
+        if item is not None:
+            values = stash_get(item, VALUES_KEY)
+            if values is not None:
+                for f in self.filters:
+                    try:
+                        queries[f.marker.cmdoption_long[2:]] = values[f.marker.marker_id]
+                    except KeyError:
+                        pass
+        return queries
+
+    def get_non_compliance(self, item):
+        # type: (...) -> Optional[NonComplianceReason]
+        """
+        Evaluates the active filters on `item` and returns the reason why it is not compliant with the first
+        non-compliant one, or None if item is compliant with all filters. The reason is only rendered with `str()`.
+
+        :param item: the pytest item
+        :return:
+        """
+        return self._get_non_compliance(item, self.reader.read_marks(item))
+
+    def _get_non_compliance(self, node, all_marks):
+        """Same as `get_non_compliance` but with the marks already read"""
+        if self.profile is not None:
+            return self._get_non_compliance_profiled(node, all_marks)
+
+        for f in self.active_filters:
+            required_marks, is_agnostic = f.marker.parse_marks(all_marks.get(f.marker.marker_id, ()))
+            reason = f.decide(node, required_marks, is_agnostic)
+            if reason is not None:
+                return reason
+
+        if self.expr is not None:
+            parsed_marks = {m.marker_id: m.parse_marks(all_marks.get(m.marker_id, ())) for m in self.expr.markers}
+            if not self.expr.matches(parsed_marks):
+                return self._get_expr_reason()
+        return None
+
+    def _get_non_compliance_profiled(self, node, all_marks):
+        """Same as `_get_non_compliance` but records the time spent evaluating each marker in the profile"""
+        profile = self.profile
+        for f in self.active_filters:
+            start = default_timer()
+            required_marks, is_agnostic = f.marker.parse_marks(all_marks.get(f.marker.marker_id, ()))
+            reason = f.decide(node, required_marks, is_agnostic)
+            profile.add_evaluation(f.marker.marker_id, default_timer() - start)
+            if reason is not None:
+                return reason
+
+        if self.expr is not None:
+            start = default_timer()
+            parsed_marks = {m.marker_id: m.parse_marks(all_marks.get(m.marker_id, ())) for m in self.expr.markers}
+            matches = self.expr.matches(parsed_marks)
+            profile.add_evaluation("--pilot-expr", default_timer() - start)
+            if not matches:
+                return self._get_expr_reason()
+        return None
+
+    def _get_expr_reason(self):
+        return NonComplianceReason("This test does not match `--pilot-expr %s`.", self.expr.source)
+
+    def get_non_compliance_from_record(self, nodeid, record):
+        # type: (...) -> Optional[NonComplianceReason]
+        """
+        Same as `get_non_compliance` but for an item read from the marks index.
+
+        :param nodeid: the item node id
+        :param record: the item record, a dictionary {marker_id: [values, is_agnostic]}
+        :return:
+        """
+        for f in self.active_filters:
+            required_marks, is_agnostic = record.get(f.marker.marker_id, ((), False))
+            reason = f.decide(nodeid, required_marks, is_agnostic)
+            if reason is not None:
+                return reason
+
+        if self.expr is not None and not self.expr.matches(record):
+            return self._get_expr_reason()
+        return None
+
+    def prune_calls(self, metafunc):
+        """
+        Removes the parametrization calls of `metafunc` that would generate non-compliant items, so that these items
+        are never created. If all calls are non-compliant, the first one is kept so that pytest does not generate a
+        non-parametrized item instead: it will be deselected as usual.
+
+        :param metafunc: the pytest `Metafunc` after all parametrization has been done
+        :return: the number of calls removed
+        """
+        calls = metafunc._calls
+        if len(calls) == 0:
+            return 0
+
+        definition = metafunc.definition
+        kept = [c for c in calls
+                if self._get_non_compliance(definition, self.reader.read_callspec_marks(definition, c)) is None]
+        if len(kept) == 0:
+            kept = calls[:1]
+
+        nb_removed = len(calls) - len(kept)
+        if nb_removed > 0:
+            metafunc._calls = kept
+        return nb_removed
+
+    def get_pruning_reason(self, collector, obj):
+        # type: (...) -> Optional[NonComplianceReason]
+        """
+        Returns a reason if all items that `collector` would generate for `obj` (a test function or class) are known
+        to be non-compliant from the marks of `obj` and of `collector` and its parents, so that `obj` does not need to
+        be collected. Returns None otherwise.
+
+        :param collector: the pytest collector (module or class) containing `obj`
+        :param obj: the test function or class
+        :return:
+        """
+        if len(self.pruning_filters) == 0:
+            return None
+
+        chain_marks = self.reader.read_chain_marks(collector)
+        obj_marks = getattr(obj, 'pytestmark', ())
+        if not isinstance(obj_marks, (list, tuple)):
+            obj_marks = (obj_marks,)
+        obj_marks = [getattr(m, 'mark', m) for m in obj_marks]
+
+        for f in self.pruning_filters:
+            marker_id = f.marker.marker_id
+            marks = [m for m in obj_marks if m.name == marker_id] + chain_marks.get(marker_id, [])
+            required_marks, is_agnostic = f.marker.parse_marks(marks)
+            if len(required_marks) > 0:
+                return f.decide(collector, required_marks, is_agnostic)
+        return None
+
+    def get_decision(self, item):
+        # type: (...) -> Optional[NonComplianceReason]
+        """
+        Returns the decision taken for `item` during collection by `select`. Items that were not evaluated then (for
+        example items added by other plugins afterwards) are evaluated now.
+
+        :param item: the pytest item
+        :return: the reason why item is not compliant, or None if item is compliant.
+        """
+        reason = stash_get(item, DECISION_KEY, _NOT_EVALUATED)
+        if reason is _NOT_EVALUATED:
+            reason = self.get_non_compliance(item)
+        return reason
+
+    def expand(self, items):
+        # type: (...) -> List
+        """
+        For markers queried with 'all' (for example `--envid=all`), replaces each marked item with one item per value
+        marked, with the value in its id (`test_foo[envid=a]`). Unmarked items, and items that are not test functions,
+        are kept as is.
+
+        :param items: a list of pytest items. Non-compliant items (in skip mode) are kept as is.
+        :return: the new list of items
+        """
+        for f in self.expanding_filters:
+            marker = f.marker
+            marker_id = marker.marker_id
+            expanded = []
+            for item in items:
+                required_marks, _ = marker.parse_marks(self.reader.read_marks(item).get(marker_id, ()))
+                # (marks are read nearest first: reverse them to create the items in the order of declaration)
+                values = []
+                for v in reversed(required_marks):
+                    if v not in values:
+                        values.append(v)
+                if len(values) == 0 or not hasattr(item, 'originalname') or self.get_decision(item) is not None:
+                    expanded.append(item)
+                    continue
+
+                item_values = stash_get(item, VALUES_KEY) or dict()
+                for v in values:
+                    tag = "%s=%s" % (marker_id, v)
+                    name = "%s-%s]" % (item.name[:-1], tag) if item.name.endswith("]") else "%s[%s]" % (item.name, tag)
+                    new_item = copy_function_item(item, name)
+                    stash_set(new_item, DECISION_KEY, None)
+                    new_values = dict(item_values)
+                    new_values[marker_id] = v
+                    stash_set(new_item, VALUES_KEY, new_values)
+                    expanded.append(new_item)
+            items = expanded
+        return items
+
+    def select_from(self, items, selected_nodeids):
+        # type: (...) -> Tuple[List, List]
+        """
+        Same as `select` but the selection was already computed, for example on the pytest-xdist controller. Selected
+        items are remembered as compliant. The reason why the other items are not compliant is only evaluated if
+        `get_decision` is called on them.
+
+        :param items: a list of pytest items
+        :param selected_nodeids: the set of node ids of the selected items
+        :return: a tuple (compliant, non_compliant)
+        """
+        compliant = []
+        non_compliant = []
+        for item in items:
+            if item.nodeid in selected_nodeids:
+                stash_set(item, DECISION_KEY, None)
+                compliant.append(item)
+            else:
+                non_compliant.append(item)
+        return compliant, non_compliant
+
+    def select(self, items):
+        # type: (...) -> Tuple[List, List]
+        """
+        Splits `items` into the compliant and non-compliant ones. The decision is remembered for each item, so that it
+        can be retrieved later with `get_decision`.
+
+        :param items: a list of pytest items
+        :return: a tuple (compliant, non_compliant)
+        """
+        if self.is_trivial:
+            # fast path
+            return items, []
+
+        # note: the profile is not thread-safe
+        if self.threads > 1 and self.profile is None and len(items) >= self.threads * _MIN_ITEMS_PER_THREAD:
+            reasons = self._evaluate_in_threads(items)
+        else:
+            reasons = map(self.get_non_compliance, items)
+
+        compliant = []
+        non_compliant = []
+        for item, reason in zip(items, reasons):
+            stash_set(item, DECISION_KEY, reason)
+            if reason is None:
+                compliant.append(item)
+            else:
+                logger.debug("%s", reason)
+                non_compliant.append(item)
+        return compliant, non_compliant
+
+    def _evaluate_in_threads(self, items):
+        # type: (...) -> List[Optional[NonComplianceReason]]
+        """
+        Evaluates `items` with a pool of `self.threads` threads. Each thread evaluates a contiguous chunk of items, so
+        that sibling items share the marks cached on their parents.
+
+        :param items: a list of pytest items
+        :return: the list of the reasons why each item is not compliant (None for compliant ones)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        chunk_size = -(-len(items) // self.threads)
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            results = list(executor.map(lambda chunk: [self.get_non_compliance(item) for item in chunk], chunks))
+        return [reason for chunk_reasons in results for reason in chunk_reasons]
@@ -0,0 +1,87 @@
+"""
+The state of pytest-pilot for a pytest run. It is attached to the pytest `config` instead of being stored in module
+globals, so that several runs in the same process (for example with `pytester`) do not share anything.
+"""
+try:  # python 3.5+
+    from typing import List, Optional, TYPE_CHECKING
+    if TYPE_CHECKING:
+        # note: not imported at runtime, this module is imported by the plugin even when pytest-pilot is not used
+        from .concurrency import ConcurrencyLimit
+        from .history import FailureHistory
+        from .profiling import PilotProfile
+        from .sharding import ItemDurations
+        from .prescan import PrescanCache
+        from .pytest_marks import EasyMarker
+        from .selection import SelectionPlan
+except ImportError:
+    pass
+
+from .pytest_compat import new_stash_key, stash_get, stash_set
+
+
+# the key of the `PilotSession` in the stash of the pytest config
+_SESSION_KEY = new_stash_key()
+
+
+class PilotSession(object):
+    """
+    The state of pytest-pilot for a pytest run.
+    """
+    __slots__ = 'markers', 'profile', 'plan', 'logger_level', 'index_message', 'plan_report', 'selection_payload', \
+                'inventory_report', 'matrix_runs', 'matrix_crashes', 'prescan_cache', 'what_if_report', 'history', \
+                'shard', 'durations', 'shard_message', 'concurrency_limits', 'concurrency_dir', 'group_markers', \
+                'group_message'
+
+    def __init__(self,
+                 markers,      # type: List[EasyMarker]
+                 profile=None  # type: Optional[PilotProfile]
+                 ):
+        self.markers = markers
+        # when --pilot-profile is used: the `PilotProfile` of the run
+        self.profile = profile
+        # the selection plan, created in `pytest_configure`. None if pytest-pilot is not used in this run (no markers
+        # and no pytest-pilot option): in that case all hooks return right away.
+        self.plan = None  # type: Optional[SelectionPlan]
+        # the level of the `pytest_pilot` logger before the run, restored at the end
+        self.logger_level = None
+        # a message about the marks index, reported after collection
+        self.index_message = None
+        # when --pilot-plan is used: a tuple (source, [(file, nodeid, is_selected)])
+        self.plan_report = None
+        # on the pytest-xdist controller: the selection shipped to workers, see `dist.encode_selection`
+        self.selection_payload = None
+        # when --pilot-inventory is used: a tuple ([MarkerInventory], nb_items, json_path)
+        self.inventory_report = None
+        # when --pilot-matrix is used: the list of (value, items) to run, and the (value, message) of the runs that
+        # crashed
+        self.matrix_runs = None
+        self.matrix_crashes = None
+        # when --pilot-prescan is used: the cached results of the static pre-scan of test modules
+        self.prescan_cache = None  # type: Optional[PrescanCache]
+        # when --pilot-what-if is used: a tuple (source, MarksTable, [(configuration, bitset of selected items)])
+        self.what_if_report = None
+        # when --pilot-failed-first is used: the failure history of tests
+        self.history = None  # type: Optional[FailureHistory]
+        # when --pilot-shard is used: the (index, count) of the shard, the recorded durations of items, and a message
+        # describing the shard, reported after collection
+        self.shard = None
+        self.durations = None  # type: Optional[ItemDurations]
+        self.shard_message = None
+        # when --pilot-concurrency is used: the limits, and on the pytest-xdist controller the temporary directory of
+        # the lock files shared with the workers
+        self.concurrency_limits = None  # type: Optional[List[ConcurrencyLimit]]
+        self.concurrency_dir = None
+        # when --pilot-group is used: the markers to group the items by, and the line reporting the fixture setups
+        self.group_markers = None  # type: Optional[List[EasyMarker]]
+        self.group_message = None
+
+
+def get_pilot_session(config):
+    # type: (...) -> PilotSession
+    """Return the `PilotSession` attached to `config`"""
+    return stash_get(config, _SESSION_KEY)
+
+
+def set_pilot_session(config, pilot_session):
+    """Attaches `pilot_session` to `config`"""
+    stash_set(config, _SESSION_KEY, pilot_session)
@@ -0,0 +1,193 @@
+"""
+The `--pilot-shard=i/n` option: the selected items are split into `n` shards of similar durations, and only the items
+of shard `i` are run. Each shard computes the same partition on its own, so that shards can run on different machines.
+
+The duration of each item is the one recorded by previous runs (setup, call and teardown), in the pytest cache or in
+the json file of the `--pilot-durations-file` option. The duration of an item that was never run is estimated from the
+items marked with the same marker values (for example all `@slow` items), or else from all items with a recorded
+duration. Items are then assigned to shards with the greedy "longest processing time" algorithm: by decreasing
+duration, each item goes to the shard with the smallest total. Ties are broken by the collection order and by the shard
+index, so that the partition only depends on the collected items and on the recorded durations.
+
+Shards running on different machines only compute the same partition if they read the same durations. The pytest
+cache of each machine is usually not the same, so a durations file shared by all shards (for example stored with the
+tests, or an artifact of a previous CI run) should be used. When some selected items have no recorded duration, the
+shards are warned that their partitions may differ.
+"""
+import heapq
+import json
+import os
+
+try:  # python 3.5+
+    from typing import Dict, Iterable, List, Optional, Tuple
+except ImportError:
+    pass
+
+from _pytest.config import UsageError
+
+from .history import get_value_keys
+from .pytest_marks import EasyMarker
+from .selection import MarksReader
+
+
+# the key of the durations in the pytest cache
+CACHE_KEY = "pytest-pilot/durations"
+
+# the duration of items when there is no recorded duration at all
+DEFAULT_DURATION = 1.
+
+
+def parse_shard(source):
+    # type: (str) -> Tuple[int, int]
+    """
+    Parses the `--pilot-shard` option.
+
+    :param source: the option value, `<i>/<n>` where `1 <= i <= n`
+    :return: a tuple (i, n)
+    :raises UsageError: if the option is invalid
+    """
+    try:
+        index, count = (int(s) for s in source.split('/'))
+    except ValueError:
+        raise UsageError("Invalid `--pilot-shard %s`: it should have the form `<i>/<n>`, for example `1/4`" % source)
+    if count < 1 or not 1 <= index <= count:
+        raise UsageError("Invalid `--pilot-shard %s`: the shard index should be between 1 and the number of shards"
+                         % source)
+    return index, count
+
+
+class ItemDurations(object):
+    """
+    The durations of items recorded in the pytest cache. Use `ItemDurations.load` to create it. It is registered as a
+    pytest plugin to record the durations of the items run.
+    """
+    __slots__ = 'durations', 'new_durations', 'path'
+
+    def __init__(self,
+                 durations,  # type: Dict[str, float]
+                 path=None   # type: Optional[str]
+                 ):
+        self.durations = durations
+        # the durations of the items run in this session
+        self.new_durations = dict()
+        # the json file of the durations, or None to use the pytest cache
+        self.path = path
+
+    @classmethod
+    def load(cls, config, path=None):
+        # type: (...) -> ItemDurations
+        """
+        Reads the durations from the json file at `path` if provided, or else from the pytest cache of `config`, if
+        any.
+
+        :raises UsageError: if the file exists but does not contain durations
+        """
+        if path is None:
+            cache = getattr(config, 'cache', None)
+            durations = cache.get(CACHE_KEY, None) if cache is not None else None
+            return cls(durations if isinstance(durations, dict) else dict())
+
+        try:
+            with open(path) as f:
+                durations = json.load(f)
+        except FileNotFoundError:
+            # the first run
+            durations = dict()
+        except (OSError, ValueError) as e:
+            raise UsageError("Invalid `--pilot-durations-file %s`: %s" % (path, e))
+        if not isinstance(durations, dict):
+            raise UsageError("Invalid `--pilot-durations-file %s`: it should contain a json object {nodeid: duration}"
+                             % path)
+        return cls(durations, path)
+
+    def count_unknown(self, items):
+        # type: (...) -> int
+        """Return the number of `items` without a recorded duration"""
+        durations = self.durations
+        return sum(1 for item in items if item.nodeid not in durations)
+
+    def get_costs(self,
+                  items,    # type: List
+                  markers,  # type: Iterable[EasyMarker]
+                  reader    # type: MarksReader
+                  ):
+        # type: (...) -> List[float]
+        """
+        Return the estimated duration of each of `items`, see module docstring.
+
+        :param items: the items
+        :param markers: the markers
+        :param reader: the `MarksReader` to use to read the marks of items
+        :return:
+        """
+        markers = tuple(markers)
+        durations = self.durations
+        costs = [durations.get(item.nodeid) for item in items]
+        if all(c is not None for c in costs):
+            return costs
+
+        # the average duration of the items of each marker value, and of all items
+        value_keys = [get_value_keys(markers, reader, item) for item in items]
+        totals = dict()
+        for keys, cost in zip(value_keys, costs):
+            if cost is None:
+                continue
+            for key in keys:
+                try:
+                    total = totals[key]
+                except KeyError:
+                    total = totals[key] = [0., 0]
+                total[0] += cost
+                total[1] += 1
+        known = [c for c in costs if c is not None]
+        default = sum(known) / len(known) if known else DEFAULT_DURATION
+
+        for i, (keys, cost) in enumerate(zip(value_keys, costs)):
+            if cost is None:
+                averages = [totals[k][0] / totals[k][1] for k in keys if k in totals]
+                costs[i] = max(averages) if averages else default
+        return costs
+
+    def pytest_runtest_logreport(self, report):
+        """Records the duration of each phase of the items run"""
+        self.new_durations[report.nodeid] = self.new_durations.get(report.nodeid, 0.) + report.duration
+
+    def save(self, config):
+        """
+        Stores the durations of the items run in this session with the other ones, in the json file if any, or else in
+        the pytest cache.
+        """
+        if len(self.new_durations) == 0:
+            return
+        self.durations.update(self.new_durations)
+        if self.path is not None:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.durations, f, indent=0, sort_keys=True)
+            os.replace(self.path + ".tmp", self.path)
+            return
+        cache = getattr(config, 'cache', None)
+        if cache is not None:
+            cache.set(CACHE_KEY, self.durations)
+
+
+def partition(costs,  # type: List[float]
+              count   # type: int
+              ):
+    # type: (...) -> Tuple[List[int], List[float]]
+    """
+    Splits items into `count` shards with the greedy "longest processing time" algorithm.
+
+    :param costs: the duration of each item
+    :param count: the number of shards
+    :return: a tuple (shard index of each item (starting at 0), total duration of each shard)
+    """
+    shards = [0] * len(costs)
+    totals = [0.] * count
+    # (total, shard index)
+    heap = [(0., s) for s in range(count)]
+    for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        total, s = heapq.heappop(heap)
+        shards[i] = s
+        totals[s] = total + costs[i]
+        heapq.heappush(heap, (totals[s], s))
+    return shards, totals
@@ -4,10 +4,16 @@ except ModuleNotFoundError:
     from distutils.version import LooseVersion
 
 from os.path import dirname, join, pardir
+import json
+import logging
+import os
+import sys
 
 import pytest
 from textwrap import dedent
 
+from pytest_pilot import EasyMarker
+
 CASES_DIR = join(dirname(__file__), pardir, 'test_cases')
 
 
@@ -47,6 +53,47 @@ def test_ensure_pytest_pilot_installed(testdir):
     result.stdout.fnmatch_lines(expected_lines)
 
 
+def test_import_time(testdir):
+    """
+    The plugin is loaded in every pytest process (and every xdist worker): importing it should be fast, so it should not
+    import the heavy modules. The bound on the import time of its own modules is loose (about 100 times the usual time)
+    so that it does not depend on the load of the machine.
+    """
+
+    result = testdir.run(sys.executable, '-X', 'importtime', '-c', 'import pytest; import pytest_pilot.plugin')
+    assert result.ret == 0
+
+    # lines are `import time: <self us> | <cumulative us> | <indented module name>`, children before their parent
+    imported = []
+    self_times = []
+    for line in result.errlines:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            # the header line
+            continue
+        if name.strip() == "pytest" and not name.startswith("  "):
+            # the modules imported by pytest are not the plugin's
+            imported = []
+            self_times = []
+        else:
+            imported.append(name.strip())
+            self_times.append((name.strip(), int(self_us)))
+
+    for heavy_module in ("pytest_pilot.pytest_marks", "pytest_pilot.selection", "pytest_pilot.index",
+                         "pytest_pilot.matrix", "setuptools_scm"):
+        assert heavy_module not in imported
+
+    pilot_us = sum(us for name, us in self_times if name == "pytest_pilot" or name.startswith("pytest_pilot."))
+    assert pilot_us < 100000, "importing pytest_pilot.plugin took %sus" % pilot_us
+
+    # the lazy attributes of the package
+    import pytest_pilot
+    assert isinstance(pytest_pilot.__version__, str)
+    assert pytest_pilot.EasyMarker is EasyMarker
+
+
 def test_basic_markers_help(testdir):
     """Creates two markers and check that pytest --markers returns correct help on those """
 
@@ -145,6 +192,52 @@ def test_basic_run_queries(testdir, cmdoptions, results, skip_opt):
     result.assert_outcomes(**results)
 
 
+def test_trivial_plan(testdir):
+    """checks that markers are not evaluated at all when no item can be deselected, with the same results"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='hard_filter')
+                                flavour = EasyMarker('flavour', mode='soft_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              from conftest import envid, flavour
+
+                              @envid('a')
+                              def test_a():
+                                  pass
+
+                              @envid('b')
+                              @flavour('red')
+                              def test_b_red():
+                                  pass
+
+                              @envid.agnostic
+                              def test_agnostic():
+                                  pass
+
+                              def test_unmarked():
+                                  pass
+                              """))
+
+    def get_outcomes(result):
+        return sorted(line.split()[:2] for line in result.stdout.lines if "::test_" in line)
+
+    # no option: the markers of these modes can not deselect anything
+    result = testdir.runpytest(testdir.tmpdir, '-v', '--pilot-profile')
+    result.assert_outcomes(passed=4)
+    result.stdout.fnmatch_lines(["4 item(s), 0 (item, marker) evaluation(s)"])
+    fast_outcomes = get_outcomes(result)
+
+    # an expression that selects everything, but that has to be evaluated on each item
+    result = testdir.runpytest(testdir.tmpdir, '-v', '--pilot-profile', '--pilot-expr', 'envid or not envid')
+    result.assert_outcomes(passed=4)
+    result.stdout.fnmatch_lines(["4 item(s), * (item, marker) evaluation(s)"])
+    result.stdout.no_fnmatch_line("* 0 (item, marker) evaluation(s)")
+    assert get_outcomes(result) == fast_outcomes
+
+
 def test_nameconflict(testdir):
     """tests that a name conflict raises an exception"""
 
@@ -174,3 +267,1330 @@ def test_nameconflict_short(testdir):
                    "and decorator '@pytest.mark.a(<a>)'>: a command with this long or short name already " \
                    "exists. Caught: ValueError('lowercase shortoptions reserved'"
     assert expected_str in '\n'.join(result.stderr.lines)
+
+
+def test_unreferenced_marker(testdir):
+    """checks that a marker that is not kept in a variable is still registered"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                EasyMarker('slow', has_arg=False, mode='extender')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+
+                              @pytest.mark.slow
+                              def test_slow():
+                                  pass
+
+                              def test_unmarked():
+                                  pass
+                              """))
+
+    result = testdir.runpytest_subprocess(testdir.tmpdir, '--slow')
+    result.assert_outcomes(passed=2)
+
+
+def test_inprocess_runs(testdir):
+    """checks that several in-process runs do not accumulate markers nor share state"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                """))
+    testdir.makepyfile(dedent("""
+                              from conftest import envid
+
+                              @envid('a')
+                              def test_a(easymarkers):
+                                  assert easymarkers.envid == 'a'
+
+                              def test_unmarked():
+                                  pass
+                              """))
+
+    level = logging.getLogger("pytest_pilot").level
+    for _ in range(3):
+        # note: the conftest is imported again by each run, creating a new `envid` marker
+        result = testdir.runpytest_inprocess(testdir.tmpdir, '--envid=a', '-vvv')
+        result.assert_outcomes(passed=1, deselected=1)
+        assert [m.marker_id for m in EasyMarker.list_all()].count('envid') == 1
+        assert logging.getLogger("pytest_pilot").level == level
+
+
+def test_declared_markers(testdir):
+    """checks that markers can be declared in the ini file, without any conftest"""
+
+    testdir.makeini(dedent("""
+                           [pytest]
+                           pilot_markers =
+                               platform = hard_filter; allowed_values = a, b; cmdoption_short = E; cmdoption_long = env
+                               slow = silos; has_arg = false; cmdhelp = run the slow tests
+                           """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+
+                              @pytest.mark.platform('a')
+                              def test_a(easymarkers):
+                                  assert easymarkers.env == 'a'
+
+                              @pytest.mark.platform('b')
+                              def test_b():
+                                  pass
+
+                              @pytest.mark.slow
+                              def test_slow():
+                                  pass
+
+                              def test_unmarked():
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--help')
+    result.stdout.fnmatch_lines(["*-E NAME, --env=NAME*", "*--slow*run the slow tests*"])
+    result = testdir.runpytest(testdir.tmpdir, '--markers')
+    result.stdout.fnmatch_lines(["@pytest.mark.platform(value): mark test to run *both* when -E/--env ('platform' "
+                                 "option) is set to <value>*",
+                                 "@pytest.mark.slow: mark test to run *only* when --slow ('slow' option) is set."])
+
+    for _ in range(2):
+        result = testdir.runpytest_inprocess(testdir.tmpdir, '-E', 'a')
+        result.assert_outcomes(passed=1, deselected=3)
+    result = testdir.runpytest(testdir.tmpdir, '--slow')
+    result.assert_outcomes(passed=1, deselected=3)
+
+    # declared markers are not listed with the markers created in python
+    assert 'platform' not in [m.marker_id for m in EasyMarker.list_all()]
+
+    # a marker created in python with the id of a declared marker
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                platform = EasyMarker('platform', mode='silos')
+                                """))
+    result = testdir.runpytest_subprocess(testdir.tmpdir)
+    result.stderr.fnmatch_lines(["*ValueError: Error registering <*'platform'*>: a marker with the same id is declared "
+                                 "in the `pilot_markers` ini option*"])
+    testdir.tmpdir.join('conftest.py').remove()
+
+    testdir.makeini(dedent("""
+                           [pytest]
+                           pilot_markers =
+                               platform = hard_filter; allowed = a
+                           """))
+    result = testdir.runpytest(testdir.tmpdir)
+    result.stderr.fnmatch_lines(["*ValueError: Invalid line 'platform = hard_filter; allowed = a' in ini option "
+                                 "'pilot_markers'*unknown argument 'allowed'*"])
+
+
+def test_setup_decisions(testdir):
+    """
+    checks that pytest_runtest_setup reuses the decisions taken during collection, and evaluates the items added
+    afterwards by other plugins
+    """
+
+    testdir.makeconftest(dedent("""
+                                import pytest
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+
+                                @pytest.hookimpl(hookwrapper=True)
+                                def pytest_collection_modifyitems(items):
+                                    # the `late` items are only added after all the other implementations
+                                    late = [item for item in items if item.name.startswith('test_late')]
+                                    items[:] = [item for item in items if item not in late]
+                                    yield
+                                    items.extend(late)
+                                """))
+    testdir.makepyfile(dedent("""
+                              from conftest import envid
+
+                              @envid('a')
+                              def test_a():
+                                  pass
+
+                              @envid('b')
+                              def test_b():
+                                  pass
+
+                              @envid('a')
+                              def test_late_a():
+                                  pass
+
+                              @envid('b')
+                              def test_late_b():
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '-v', '--envid=a', '--pilot-profile')
+    result.assert_outcomes(passed=2, skipped=1, deselected=1)
+    result.stdout.fnmatch_lines(["*::test_a PASSED*",
+                                 "*::test_late_a PASSED*",
+                                 "*::test_late_b SKIPPED*"])
+    # the 2 items seen during collection are evaluated once, and the 2 late ones during setup
+    result.stdout.fnmatch_lines(["*pytest-pilot profile*",
+                                 "pytest_collection_modifyitems * 1 call(s)*",
+                                 "pytest_runtest_setup * 3 call(s)*",
+                                 "2 item(s), 4 (item, marker) evaluation(s)"])
+
+
+def test_skip_reasons(testdir):
+    """checks that the reasons are correctly rendered when tests are skipped"""
+
+    case_folder = join(CASES_DIR, 'basic')
+    testdir.makeconftest(get_conftest(case_folder))
+    testdir.makepyfile(get_file(case_folder, 'test_basic.py'))
+    make_file(testdir, case_folder, '__init__.py')  # required for the "import from ." to work
+
+    result = testdir.runpytest(testdir.tmpdir, '-rs', '--pilot-skip', '--envid=env1')
+    result.assert_outcomes(passed=5, skipped=2)
+    result.stdout.fnmatch_lines([
+        "*This test requires 'silo'. Run `pytest --silo` to activate it.",
+        "*This test requires 'envid'='env2'. Currently `--envid=env1` so it is skipped.",
+    ])
+
+
+def test_marks_on_parents(testdir):
+    """checks that marks set on modules and classes are combined with the marks of parametrized items"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                flavour = EasyMarker('flavour', mode='hard_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid, flavour
+
+                              pytestmark = envid('a')
+
+                              @flavour('red')
+                              class TestFoo:
+                                  @pytest.mark.parametrize('i', [0, pytest.param(1, marks=envid('b')),
+                                                                 pytest.param(2, marks=flavour('blue'))])
+                                  def test_foo(self, i):
+                                      pass
+
+                                  def test_bar(self):
+                                      pass
+
+                              def test_baz():
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--envid=a')
+    result.assert_outcomes(passed=5)
+    result = testdir.runpytest(testdir.tmpdir, '--envid=b')
+    result.assert_outcomes(passed=1)
+    result = testdir.runpytest(testdir.tmpdir, '--envid=a', '--flavour=red')
+    result.assert_outcomes(passed=4)
+    result = testdir.runpytest(testdir.tmpdir, '--envid=b', '--flavour=blue')
+    result.assert_outcomes()
+    result = testdir.runpytest(testdir.tmpdir)
+    result.assert_outcomes()
+
+
+def test_interned_marks(testdir):
+    """checks that mark decorators are shared, and that the agnostic and .param helpers work"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid, slow
+
+                              def test_interned():
+                                  assert envid('a') is envid('a')
+                                  assert envid('a').mark is envid('a').mark
+                                  assert envid(1) is not envid(True)
+                                  assert envid.agnostic is envid.agnostic
+                                  assert slow.mark is slow.mark
+
+                              @pytest.mark.parametrize('i', [0, envid('a').param(1), slow.param(2)])
+                              def test_param(i):
+                                  pass
+
+                              @envid.agnostic
+                              def test_agnostic():
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir)
+    result.assert_outcomes(passed=3)
+    result = testdir.runpytest(testdir.tmpdir, '--envid=a')
+    result.assert_outcomes(passed=2)
+
+
+def test_failed_first(testdir):
+    """checks that --pilot-failed-first runs the tests and marker values that failed recently first"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='hard_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import os
+                              from conftest import envid
+
+                              def test_unmarked():
+                                  pass
+
+                              @envid('a')
+                              def test_a():
+                                  pass
+
+                              @envid('b')
+                              def test_b1():
+                                  pass
+
+                              @envid('b')
+                              def test_b2():
+                                  assert os.path.exists('fixed')
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '-v', '--pilot-failed-first')
+    result.assert_outcomes(passed=3, failed=1)
+    result.stdout.fnmatch_lines(["*test_unmarked PASSED*", "*test_a PASSED*", "*test_b1 PASSED*", "*test_b2 FAILED*"])
+
+    testdir.makefile('', fixed='')
+    for _ in range(2):
+        result = testdir.runpytest(testdir.tmpdir, '-v', '--pilot-failed-first')
+        result.assert_outcomes(passed=4)
+        result.stdout.fnmatch_lines(["*test_b2 PASSED*", "*test_b1 PASSED*", "*test_unmarked PASSED*",
+                                     "*test_a PASSED*"])
+
+    # without the flag, the order is unchanged
+    result = testdir.runpytest(testdir.tmpdir, '-v')
+    result.stdout.fnmatch_lines(["*test_unmarked PASSED*", "*test_a PASSED*", "*test_b1 PASSED*", "*test_b2 PASSED*"])
+
+
+def test_shard(testdir):
+    """checks that --pilot-shard splits the selected tests into shards of similar durations"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                slow = EasyMarker('slow', has_arg=False, mode='hard_filter')
+                                """))
+    testdir.makepyfile(test_a=dedent("""
+                                     import time
+                                     from conftest import slow
+
+                                     @slow
+                                     def test_slow1():
+                                         time.sleep(0.2)
+
+                                     @slow
+                                     def test_slow2():
+                                         time.sleep(0.2)
+
+                                     def test_fast1():
+                                         pass
+
+                                     def test_fast2():
+                                         pass
+                                     """))
+
+    # a first run records the durations
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-shard=1/1')
+    result.assert_outcomes(passed=4)
+    result.stdout.fnmatch_lines(["pytest-pilot: shard 1/1 runs 4 of 4 selected item(s)*"])
+
+    # a new slow test, whose duration is estimated from the other slow tests
+    testdir.makepyfile(test_b=dedent("""
+                                     import time
+                                     from conftest import slow
+
+                                     @slow
+                                     def test_slow3():
+                                         time.sleep(0.2)
+                                     """))
+
+    # each shard starts from the same cache, as on different machines
+    cache_dir = testdir.tmpdir.join('.pytest_cache')
+    cache_dir.copy(testdir.tmpdir.join('cache_backup'))
+    nodeids = []
+    for shard in ('1/2', '2/2'):
+        cache_dir.remove()
+        testdir.tmpdir.join('cache_backup').copy(cache_dir)
+        result = testdir.runpytest(testdir.tmpdir, '-v', '--pilot-shard=%s' % shard)
+        outcomes = result.parseoutcomes()
+        assert outcomes['passed'] + outcomes['deselected'] == 5
+        # the duration of test_slow3 is estimated: shards with other durations could split differently
+        result.stdout.fnmatch_lines(["pytest-pilot: warning: 1 of 5 selected item(s) have no recorded duration*"])
+        shard_nodeids = [line.split()[0] for line in result.outlines if " PASSED" in line]
+        # the slow tests are not all in the same shard
+        assert 1 <= len([n for n in shard_nodeids if "slow" in n]) <= 2
+        nodeids += shard_nodeids
+    assert len(nodeids) == len(set(nodeids)) == 5
+
+    # the durations are recorded in a file shared by all shards
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-shard=1/1', '--pilot-durations-file=durations.json')
+    result.assert_outcomes(passed=5)
+    result.stdout.fnmatch_lines(["*5 of 5 selected item(s) have no recorded duration*"])
+    assert len(json.loads(testdir.tmpdir.join('durations.json').read())) == 5
+
+    # shards with different caches (the one of the previous runs and an empty one) compute the same split from the
+    # same file (each shard records the durations in its own copy, as on different machines)
+    durations_file = testdir.tmpdir.join('durations.json')
+    durations_file.copy(testdir.tmpdir.join('durations_backup.json'))
+    shard_nodeids = []
+    for cache in ('previous', 'empty'):
+        if cache == 'empty':
+            cache_dir.remove()
+        testdir.tmpdir.join('durations_backup.json').copy(durations_file)
+        result = testdir.runpytest(testdir.tmpdir, '-v', '--pilot-shard=1/2', '--pilot-durations-file=durations.json')
+        assert "have no recorded duration" not in result.stdout.str()
+        shard_nodeids.append(sorted(line.split()[0] for line in result.outlines if " PASSED" in line))
+    assert shard_nodeids[0] == shard_nodeids[1]
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-shard=3/2')
+    result.stderr.fnmatch_lines(["*Invalid `--pilot-shard 3/2`: the shard index should be between 1 and the number "
+                                 "of shards"])
+
+
+def test_threads(testdir):
+    """checks that marks can be created concurrently, and that --pilot-threads evaluates items in threads"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import warnings
+                              from concurrent.futures import ThreadPoolExecutor
+
+                              import pytest
+                              from conftest import envid
+
+                              def test_concurrent_creation():
+                                  filters = list(warnings.filters)
+                                  with ThreadPoolExecutor(8) as executor:
+                                      decorators = list(executor.map(lambda i: envid('v%s' % (i % 10)), range(1000)))
+                                  assert warnings.filters == filters
+                                  for d in decorators:
+                                      assert d is envid(d.mark.args[0])
+                                  assert {'v%s' % i for i in range(10)} <= envid.used_values
+
+                              @pytest.mark.parametrize('i', [envid('a').param(i) if i % 2 else i for i in range(2000)])
+                              def test_foo(i):
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-threads', '2')
+    result.assert_outcomes(passed=1001, deselected=1000)
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-threads', '2', '--envid=a', '-k', 'foo')
+    result.assert_outcomes(passed=1000, deselected=1001)
+
+
+def test_prune(testdir):
+    """checks that --pilot-prune prunes the marked modules, classes and functions when the option is not set"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                """))
+    testdir.makepyfile(test_a=dedent("""
+                                     from conftest import envid
+
+                                     pytestmark = envid('r')
+
+                                     def test_foo():
+                                         pass
+
+                                     class TestFoo:
+                                         def test_bar(self):
+                                             pass
+                                     """),
+                       test_b=dedent("""
+                                     import pytest
+                                     from conftest import slow
+
+                                     @slow
+                                     class TestFoo:
+                                         @pytest.mark.parametrize('i', range(10))
+                                         def test_bar(self, i):
+                                             pass
+
+                                     @slow
+                                     def test_slow():
+                                         pass
+
+                                     @pytest.mark.parametrize('i', [0, slow.param(1)])
+                                     def test_foo(i):
+                                         pass
+                                     """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-prune')
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["collected 1 item",
+                                 "pytest-pilot: 4 test function(s) or class(es) pruned during collection",
+                                 "pytest-pilot: 1 parametrized test(s) pruned during collection"])
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-prune', '--envid=r', '--slow')
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(["collected 5 items / 3 deselected / 2 selected",
+                                 "pytest-pilot: 10 parametrized test(s) pruned during collection"])
+
+
+def test_prune_params(testdir):
+    """checks that --pilot-prune prunes the parameters that would be deselected, with all kind of queries"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='hard_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid
+
+                              @pytest.mark.parametrize('i', [envid('a').param(0), envid('b').param(1), 2])
+                              @pytest.mark.parametrize('j', [envid('a').param(0), 1])
+                              def test_foo(i, j):
+                                  pass
+
+                              @pytest.mark.parametrize('i', [envid('c').param(0), envid('d').param(1)])
+                              def test_bar(i):
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-prune', '--envid=a')
+    result.assert_outcomes(passed=4)
+    result.stdout.fnmatch_lines(["collected 5 items / 1 deselected / 4 selected",
+                                 "pytest-pilot: 3 parametrized test(s) pruned during collection"])
+
+
+def test_prescan(testdir):
+    """checks that --pilot-prescan does not import the modules that only contain tests that would be deselected"""
+
+    def runpytest(*args):
+        # note: testdir.runpytest would create a new directory in testdir for each run, and run in-process
+        return testdir.run(sys.executable, '-m', 'pytest', '-s', *args)
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                """))
+    testdir.makepyfile(test_a=dedent("""
+                                     from conftest import envid
+
+                                     imported = print("importing test_a")
+                                     pytestmark = envid('r')
+
+                                     def test_foo():
+                                         pass
+
+                                     class TestFoo:
+                                         def test_bar(self):
+                                             pass
+                                     """),
+                       test_b=dedent("""
+                                     import pytest
+                                     from conftest import slow
+
+                                     imported = print("importing test_b")
+
+                                     @slow
+                                     def test_slow():
+                                         pass
+
+                                     @pytest.mark.envid('r')
+                                     def test_foo():
+                                         pass
+                                     """),
+                       test_c=dedent("""
+                                     from conftest import *
+
+                                     imported = print("importing test_c")
+
+                                     @envid('r')
+                                     def test_foo():
+                                         pass
+                                     """),
+                       test_d=dedent("""
+                                     from conftest import envid
+
+                                     imported = print("importing test_d")
+
+                                     @envid('r')
+                                     def test_foo():
+                                         pass
+
+                                     def test_bar():
+                                         pass
+                                     """),
+                       test_e=dedent("""
+                                     from conftest import envid
+
+                                     imported = print("importing test_e")
+
+                                     @envid('r')
+                                     def test_foo():
+                                         pass
+
+                                     def make_test():
+                                         def test():
+                                             pass
+                                         return test
+
+                                     globals()['test_dynamic'] = make_test()
+                                     """))
+
+    # note: the prints are assigned, since a module-level function call could define tests and makes the module unknown
+    for _ in range(2):
+        # the second time, the results of the pre-scan are read from the cache
+        result = runpytest('--pilot-prescan')
+        result.assert_outcomes(passed=2)
+        result.stdout.fnmatch_lines(["importing test_c", "importing test_d", "importing test_e",
+                                     "collected 5 items / 3 deselected / 2 selected",
+                                     "pytest-pilot: 2 test module(s) not imported since the pre-scan found no test to "
+                                     "run in them"])
+        result.stdout.no_fnmatch_line("importing test_a")
+        result.stdout.no_fnmatch_line("importing test_b")
+
+    result = runpytest('--pilot-prescan', '--envid=r', '--slow')
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines(["collected 9 items / 3 deselected / 6 selected"])
+    result.stdout.no_fnmatch_line("*not imported*")
+
+
+def test_plan_and_index(testdir):
+    """checks that --pilot-plan reports the selection, from the marks index when it is up to date"""
+
+    def runpytest(*args):
+        # note: testdir.runpytest would create a new directory in testdir for each run, invalidating the index
+        return testdir.run(sys.executable, '-m', 'pytest', *args)
+
+    # the marker is defined in a helper module, that is not a test file nor a conftest
+    marker_definition = dedent("""
+                               from pytest_pilot import EasyMarker
+
+                               envid = EasyMarker('envid', mode='%s')
+                               """)
+    testdir.makepyfile(envmarkers=marker_definition % 'silos')
+    testdir.makeconftest("from envmarkers import envid\n")
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid
+
+                              @pytest.mark.parametrize('i', [envid('a').param(0), envid('b').param(1), 2])
+                              def test_foo(i):
+                                  pass
+
+                              @envid.agnostic
+                              def test_bar():
+                                  pass
+                              """))
+
+    # no index yet: collection is used, and the index is written
+    result = runpytest('--pilot-plan', '--envid=a')
+    result.stdout.fnmatch_lines(["pytest-pilot: marks index written for 4 item(s)",
+                                 "*pytest-pilot plan*",
+                                 "test_plan_and_index.py: 2 selected, 2 deselected",
+                                 "total: 2 selected, 2 deselected (from the collection)"])
+    result.assert_outcomes()
+
+    # index is up to date: it is used
+    result = runpytest('-v', '--pilot-plan')
+    result.stdout.fnmatch_lines(["*pytest-pilot plan*",
+                                 "test_plan_and_index.py: 2 selected, 2 deselected",
+                                 "test_plan_and_index.py::test_foo[2]",
+                                 "test_plan_and_index.py::test_bar",
+                                 "total: 2 selected, 2 deselected (from the marks index)"])
+
+    # the index does not know about the deselection of `-k`: collection is used
+    result = runpytest('--pilot-plan', '-k', 'test_bar')
+    result.stdout.fnmatch_lines(["total: 1 selected, 0 deselected (from the collection)"])
+    # the index written by this run only contains the items selected by `-k`: it is not used without `-k`
+    result = runpytest('--pilot-plan')
+    result.stdout.fnmatch_lines(["total: 2 selected, 2 deselected (from the collection)"])
+
+    # a new test file: the index is not up to date anymore
+    testdir.makepyfile(test_other="def test_other():\n    pass\n")
+    result = runpytest('--pilot-plan', '--envid=b')
+    result.stdout.fnmatch_lines(["total: 2 selected, 3 deselected (from the collection)"])
+    result = runpytest('--pilot-plan', '--envid=b')
+    result.stdout.fnmatch_lines(["total: 2 selected, 3 deselected (from the marks index)"])
+
+    # the marker definition changes (unmarked items are not skipped anymore): the index is not up to date anymore
+    testdir.makepyfile(envmarkers=marker_definition % 'extender')
+    result = runpytest('--pilot-plan', '--envid=b')
+    result.stdout.fnmatch_lines(["total: 4 selected, 1 deselected (from the collection)"])
+    result = runpytest('--pilot-plan', '--envid=b')
+    result.stdout.fnmatch_lines(["total: 4 selected, 1 deselected (from the marks index)"])
+
+    # a new configuration file (that declares a marker): the index is not up to date anymore
+    testdir.makeini("[pytest]\npilot_markers =\n    flavour = silos\n")
+    result = runpytest('--pilot-plan', '--envid=b')
+    result.stdout.fnmatch_lines(["total: 4 selected, 1 deselected (from the collection)"])
+
+
+def test_xdist_shipped_selection(testdir):
+    """checks that under pytest-xdist the selection is computed from the marks index by the controller"""
+    pytest.importorskip("xdist")
+
+    def runpytest(*args):
+        # note: testdir.runpytest would create a new directory in testdir for each run, invalidating the index
+        return testdir.run(sys.executable, '-m', 'pytest', '-n', '2', *args)
+
+    # the marker is defined in a helper module, that is not a test file nor a conftest
+    marker_definition = dedent("""
+                               from pytest_pilot import EasyMarker
+
+                               envid = EasyMarker('envid', mode='%s')
+                               """)
+    testdir.makepyfile(envmarkers=marker_definition % 'silos')
+    testdir.makeconftest(dedent("""
+                                from envmarkers import envid
+
+                                def pytest_collection_finish(session):
+                                    # record whether the worker received the selection
+                                    workerinput = session.config.workerinput
+                                    with open("shipped_%s.txt" % workerinput["workerid"], "w") as f:
+                                        f.write(str("pytest_pilot_selection" in workerinput))
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid
+
+                              @pytest.mark.parametrize('i', [envid('a').param(0), envid('b').param(1), 2])
+                              def test_foo(i):
+                                  pass
+
+                              @envid.agnostic
+                              def test_bar():
+                                  pass
+                              """))
+
+    def shipped():
+        return [testdir.tmpdir.join("shipped_gw%s.txt" % i).read() for i in range(2)]
+
+    # no index yet: the workers evaluate the items, and the first one writes the index
+    result = runpytest('--pilot-index', '--envid=a')
+    result.assert_outcomes(passed=2)
+    assert shipped() == ["False", "False"]
+
+    # index is up to date: the selection is shipped to the workers
+    result = runpytest('--envid=a')
+    result.assert_outcomes(passed=2)
+    assert shipped() == ["True", "True"]
+
+    # skip mode: the reasons are evaluated on the workers
+    result = runpytest('--envid=b', '--pilot-skip')
+    result.assert_outcomes(passed=2, skipped=2)
+    assert shipped() == ["True", "True"]
+
+    # the marker definition changes (unmarked items are not skipped anymore): the index is not used
+    testdir.makepyfile(envmarkers=marker_definition % 'extender')
+    result = runpytest('--pilot-index', '--envid=a')
+    result.assert_outcomes(passed=3)
+    assert shipped() == ["False", "False"]
+
+    # the index written by the previous run is up to date
+    result = runpytest('--envid=a')
+    result.assert_outcomes(passed=3)
+    assert shipped() == ["True", "True"]
+
+
+def test_xdist_concurrency(testdir):
+    """checks that --pilot-concurrency limits the number of tests marked with a value that run at the same time"""
+    pytest.importorskip("xdist")
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='hard_filter')
+                                """))
+    test_module = dedent("""
+                         import time
+                         import pytest
+                         from conftest import envid
+
+                         def record(name):
+                             start = time.time()
+                             time.sleep(0.2)
+                             with open('intervals.txt', 'a') as f:
+                                 f.write('%s %s %s\\n' % (name, start, time.time()))
+
+                         @pytest.mark.parametrize('i', range(3))
+                         @envid('lab')
+                         def test_lab(i):
+                             record('lab')
+
+                         @pytest.mark.parametrize('i', range(3))
+                         def test_other(i):
+                             record('other')
+                         """)
+    testdir.makepyfile(test_a=test_module, test_b=test_module)
+
+    result = testdir.runpytest_subprocess(testdir.tmpdir, '-n', '3', '--pilot-concurrency', 'envid:lab=1')
+    result.assert_outcomes(passed=12)
+
+    intervals = [line.split() for line in testdir.tmpdir.join('intervals.txt').read().splitlines()]
+    lab = sorted((float(start), float(end)) for name, start, end in intervals if name == 'lab')
+    assert len(lab) == 6
+    for (_, end), (next_start, _) in zip(lab, lab[1:]):
+        assert end <= next_start
+    # the other tests ran while the lab tests were running
+    other = [(float(start), float(end)) for name, start, end in intervals if name == 'other']
+    assert any(start < lab[-1][0] for start, _ in other)
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-concurrency', 'envid=1')
+    result.stderr.fnmatch_lines(["*Invalid `--pilot-concurrency envid=1`: the values of marker 'envid' should be "
+                                 "provided*"])
+
+
+def test_xdist_concurrency_scheduling(testdir):
+    """checks that with --pilot-concurrency the items queued on a worker do not wait behind a limited item"""
+    pytest.importorskip("xdist")
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='soft_filter')
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                """))
+    # limited and unlimited items alternate, so that the queue of each worker mixes them
+    testdir.makepyfile(dedent("""
+                              import time
+                              import pytest
+                              from conftest import envid, slow
+
+                              def record(name, duration):
+                                  start = time.time()
+                                  time.sleep(duration)
+                                  with open('intervals.txt', 'a') as f:
+                                      f.write('%s %s %s\\n' % (name, start, time.time()))
+
+                              @envid('lab')
+                              def test_lab0():
+                                  record('lab', 1)
+
+                              def test_other0():
+                                  record('other', 0.05)
+
+                              @envid('lab')
+                              def test_lab1():
+                                  record('lab', 1)
+
+                              @pytest.mark.parametrize('i', range(6))
+                              def test_other(i):
+                                  record('other', 0.05)
+
+                              # items with several limits
+                              @slow
+                              @envid('lab')
+                              def test_lab_slow():
+                                  record('lab', 0.05)
+
+                              @slow
+                              def test_slow():
+                                  record('slow', 0.05)
+                              """))
+
+    result = testdir.runpytest_subprocess(testdir.tmpdir, '-n', '2', '-v', '--slow', '--pilot-concurrency',
+                                          'envid:lab=1', '--pilot-concurrency', 'slow=1')
+    result.stdout.fnmatch_lines(["*scheduling tests via LimitedLoadScheduling*"])
+    result.assert_outcomes(passed=11)
+
+    intervals = [line.split() for line in testdir.tmpdir.join('intervals.txt').read().splitlines()]
+    lab = sorted((float(start), float(end)) for name, start, end in intervals if name == 'lab')
+    for (_, end), (next_start, _) in zip(lab, lab[1:]):
+        assert end <= next_start
+    # the unlimited items did not wait for the first lab item to finish, except maybe the one queued after it
+    other = [float(start) for name, start, _ in intervals if name == 'other']
+    assert len([start for start in other if start >= lab[0][1]]) <= 1
+
+
+def test_group(testdir):
+    """checks that --pilot-group runs the tests grouped by marker values, and reports the fixture setups"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='soft_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid
+
+                              @pytest.fixture(scope='module')
+                              def resource():
+                                  return 'ok'
+
+                              @envid('a')
+                              def test_1(resource):
+                                  pass
+
+                              @envid('b')
+                              def test_2(resource):
+                                  pass
+
+                              def test_3(resource):
+                                  pass
+
+                              @envid('a')
+                              def test_4(resource):
+                                  pass
+
+                              @envid('b')
+                              def test_5(resource):
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '-v', '--pilot-group', 'envid')
+    result.assert_outcomes(passed=5)
+    result.stdout.fnmatch_lines(["pytest-pilot: tests grouped by envid, 2 value change(s) instead of 4, 1 "
+                                 "higher-scoped fixture setup(s) instead of 1",
+                                 "*::test_1 PASSED*",
+                                 "*::test_4 PASSED*",
+                                 "*::test_2 PASSED*",
+                                 "*::test_5 PASSED*",
+                                 "*::test_3 PASSED*"])
+
+    # doctest text files: their items have no module
+    testdir.makeconftest(dedent("""
+                                import pytest
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='soft_filter')
+
+                                @pytest.fixture(scope='module', autouse=True)
+                                def module_resource():
+                                    return 'ok'
+                                """))
+    testdir.maketxtfile(test_doc=">>> 1 + 1\n2\n")
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-group', 'envid')
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines(["pytest-pilot: tests grouped by envid, 2 value change(s) instead of 5, 3 "
+                                 "higher-scoped fixture setup(s) instead of 3"])
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-group', 'envid,flavour')
+    result.stderr.fnmatch_lines(["*Invalid `--pilot-group envid,flavour`: 'flavour' is not a known marker*"])
+
+
+def test_what_if(testdir):
+    """checks that --pilot-what-if reports the selection of all configurations, from the collection or the index"""
+
+    def runpytest(*args):
+        # note: testdir.runpytest would create a new directory in testdir for each run, invalidating the index
+        return testdir.run(sys.executable, '-m', 'pytest', *args)
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos', allowed_values=('a', 'b', 'c'))
+                                flavour = EasyMarker('flavour', mode='hard_filter')
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid, flavour, slow
+
+                              @envid('a')
+                              @flavour('red')
+                              def test_a_red():
+                                  pass
+
+                              @envid('a')
+                              @envid('b')
+                              def test_a_or_b():
+                                  pass
+
+                              @envid.agnostic
+                              @flavour('yellow')
+                              def test_agnostic_yellow():
+                                  pass
+
+                              @slow
+                              def test_slow():
+                                  pass
+
+                              def test_unmarked():
+                                  pass
+                              """))
+
+    # note: flavour has no allowed values, the values used by tests are used
+    expected = ["*pytest-pilot what-if*",
+                "(no option): 2 selected",
+                "--flavour=red: 0 selected",
+                "--flavour=yellow: 1 selected",
+                "--envid=a: 3 selected",
+                "--envid=a --flavour=red: 1 selected",
+                "--envid=a --flavour=yellow: 1 selected",
+                "--envid=b: 2 selected",
+                "--envid=b --flavour=red: 0 selected",
+                "--envid=b --flavour=yellow: 1 selected",
+                "--envid=c: 1 selected",
+                "--envid=c --flavour=red: 0 selected",
+                "--envid=c --flavour=yellow: 1 selected"]
+
+    result = runpytest('--pilot-what-if', 'envid', '--pilot-what-if', 'flavour', '--pilot-index', '-v')
+    result.assert_outcomes()
+    result.stdout.fnmatch_lines(expected + ["total: 12 configuration(s) evaluated on 5 item(s) (from the collection)"])
+    result.stdout.fnmatch_lines(["--envid=b: 2 selected",
+                                 "  test_what_if.py::test_a_or_b",
+                                 "  test_what_if.py::test_agnostic_yellow",
+                                 "--envid=b --flavour=red: 0 selected"])
+
+    # the second time, the marks index is used
+    result = runpytest('--pilot-what-if', 'envid', '--pilot-what-if', 'flavour')
+    result.stdout.fnmatch_lines(expected + ["total: 12 configuration(s) evaluated on 5 item(s) (from the marks index)"])
+
+    # the other options apply to all configurations
+    result = runpytest('--pilot-what-if', 'envid=a|b,c', '--slow')
+    result.stdout.fnmatch_lines(["--envid=a: 3 selected",
+                                 "--envid=b,c: 2 selected",
+                                 "total: 2 configuration(s) evaluated on 5 item(s) (from the marks index)"])
+
+    # the index does not know about the deselection of `-k`: collection is used
+    result = runpytest('--pilot-what-if', 'envid', '-k', 'test_a_')
+    result.stdout.fnmatch_lines(["(no option): 0 selected",
+                                 "--envid=a: 2 selected",
+                                 "--envid=b: 1 selected",
+                                 "--envid=c: 0 selected",
+                                 "total: 4 configuration(s) evaluated on 2 item(s) (from the collection)"])
+
+    result = runpytest('--pilot-what-if', 'envid=a|d')
+    result.stderr.fnmatch_lines(["*Invalid `--pilot-what-if envid=a|d`*"])
+
+
+def test_inventory(testdir):
+    """checks that --pilot-inventory reports the values used by tests, without running them"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                flavour = EasyMarker('flavour', allowed_values=('red', 'yellow'), mode='soft_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid, flavour
+
+                              @envid('a')
+                              @flavour('red')
+                              def test_foo():
+                                  pass
+
+                              @pytest.mark.parametrize('i', [envid('a').param(0), envid('b').param(1), 2])
+                              def test_bar(i):
+                                  pass
+
+                              @pytest.mark.flavour('pink')
+                              def test_pink():
+                                  pass
+
+                              @envid.agnostic
+                              def test_agnostic():
+                                  pass
+                              """))
+
+    json_path = testdir.tmpdir.join("inventory.json")
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-inventory', '--pilot-inventory-json', str(json_path))
+    result.stdout.fnmatch_lines(["*pytest-pilot inventory*",
+                                 "envid (--envid): 2 unmarked, 1 agnostic",
+                                 "  a * 2",
+                                 "  b * 1",
+                                 "flavour (--flavour): 4 unmarked, 0 agnostic",
+                                 "  red * 1",
+                                 "  pink * 1  (not an allowed value)",
+                                 "  yellow * 0  (allowed value with no test)",
+                                 "total: 6 collected item(s) (json written to *inventory.json)"])
+    result.assert_outcomes()
+
+    inventory = json.loads(json_path.read())
+    assert inventory["items"] == 6
+    assert inventory["markers"]["envid"]["values"] == [dict(value="a", count=2), dict(value="b", count=1)]
+    assert inventory["markers"]["envid"]["declared_values"] == ["a", "b"]
+    assert inventory["markers"]["flavour"]["unused_allowed_values"] == ["yellow"]
+    assert inventory["markers"]["flavour"]["undeclared_values"] == ["pink"]
+
+
+def test_profile(testdir):
+    """checks that --pilot-profile reports the time spent in pytest-pilot, and writes it as json"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                """))
+    testdir.makepyfile(dedent("""
+                              from conftest import envid
+
+                              @envid('a')
+                              def test_a():
+                                  pass
+
+                              @envid('a')
+                              def test_fixture(easymarkers):
+                                  assert easymarkers.envid == 'a'
+
+                              def test_unmarked():
+                                  pass
+                              """))
+
+    json_path = str(testdir.tmpdir.join("profile.json"))
+    result = testdir.runpytest(testdir.tmpdir, '--envid=a', '--pilot-profile', '--pilot-profile-json', json_path)
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(["*pytest-pilot profile*",
+                                 "pytest_load_initial_conftests * 1 call(s)*",
+                                 "pytest_configure * 1 call(s)*",
+                                 "pytest_collection_modifyitems * 1 call(s)*",
+                                 "pytest_runtest_setup * 2 call(s)*",
+                                 "easymarkers fixture * 1 call(s)*",
+                                 "3 item(s), 5 (item, marker) evaluation(s)"])
+    # note: markers are sorted by decreasing time
+    result.stdout.fnmatch_lines(["  envid * 3 eval(s)*"])
+    result.stdout.fnmatch_lines(["  slow * 2 eval(s)*"])
+    result.stdout.fnmatch_lines(["json written to %s" % json_path])
+
+    with open(json_path) as f:
+        data = json.load(f)
+    assert data["items"] == 3
+    assert data["evaluations"] == 5
+    assert data["phases"]["pytest_runtest_setup"]["calls"] == 2
+    assert {k: v["evaluations"] for k, v in data["markers"].items()} == {"envid": 3, "slow": 2}
+
+    # without the flag, nothing is measured
+    result = testdir.runpytest(testdir.tmpdir, '--envid=a')
+    result.assert_outcomes(passed=2)
+    result.stdout.no_fnmatch_line("*pytest-pilot profile*")
+
+
+def test_all_values(testdir):
+    """checks that --<option>=all runs marked tests once per value, in a single session"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='extender')
+                                flavour = EasyMarker('flavour', allowed_values=('red', 'yellow'), mode='soft_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import pytest
+                              from conftest import envid, flavour
+
+                              @envid('a')
+                              @envid('b')
+                              def test_foo(easymarkers):
+                                  assert easymarkers.envid in ('a', 'b')
+
+                              @envid('b')
+                              @flavour('red')
+                              @flavour('yellow')
+                              def test_bar(easymarkers):
+                                  assert (easymarkers.envid, easymarkers.flavour) in (('b', 'red'), ('b', 'yellow'))
+
+                              @pytest.mark.parametrize('i', [envid('c').param(1), 2])
+                              def test_param(i, easymarkers):
+                                  assert easymarkers.envid == ('c' if i == 1 else 'all')
+
+                              def test_nomark(easymarkers):
+                                  assert easymarkers.envid == 'all'
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '-v', '--envid=all', '--flavour=all')
+    result.stdout.fnmatch_lines(["*::test_foo[[]envid=a[]] PASSED*",
+                                 "*::test_foo[[]envid=b[]] PASSED*",
+                                 "*::test_bar[[]envid=b-flavour=red[]] PASSED*",
+                                 "*::test_bar[[]envid=b-flavour=yellow[]] PASSED*",
+                                 "*::test_param[[]1-envid=c[]] PASSED*",
+                                 "*::test_param[[]2[]] PASSED*",
+                                 "*::test_nomark PASSED*"])
+    result.assert_outcomes(passed=7)
+
+    result = testdir.runpytest(testdir.tmpdir, '--envid=all', '--flavour=red')
+    result.assert_outcomes(passed=6)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="--pilot-matrix requires os.fork")
+def test_pilot_matrix(testdir):
+    """checks that --pilot-matrix runs the tests once per value, in forked children"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', allowed_values=('a', 'b', 'c'), mode='silos')
+                                """))
+    testdir.makepyfile(dedent("""
+                              import os
+                              import pytest
+                              from conftest import envid
+
+                              @pytest.mark.parametrize('i', [envid('a').param(0), envid('c').param(1)])
+                              def test_foo(i, easymarkers, request):
+                                  # the child knows the value it runs with
+                                  assert easymarkers.envid == ['a', 'c'][i]
+                                  assert request.config.getoption('envid') == ['a', 'c'][i]
+
+                              @envid('b')
+                              def test_fail():
+                                  assert False
+
+                              @envid('c')
+                              def test_crash():
+                                  os._exit(3)
+
+                              @envid.agnostic
+                              def test_agnostic(easymarkers, request):
+                                  assert easymarkers.envid in ('a', 'b', 'c')
+                                  assert request.config.getoption('envid') == easymarkers.envid
+
+                              def test_nomark():
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-matrix', 'envid', '--pilot-matrix-jobs', '2')
+    result.stdout.fnmatch_lines(["pytest-pilot matrix: envid=a (2 items), envid=b (2 items), envid=c (3 items)"])
+    # (values run in parallel: the order of the failures is not known)
+    result.stdout.fnmatch_lines(["*test_fail*", "*", "*assert False*", "*pytest-pilot matrix*", "envid=b"])
+    result.stdout.fnmatch_lines(["*test_crash*", "*the child process running envid=c terminated with exit code 3*",
+                                 "*pytest-pilot matrix*", "envid=c"])
+    # (test_agnostic does not run with envid=c since the child crashed before)
+    result.assert_outcomes(passed=4, failed=2, deselected=1)
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-matrix', 'envid=a,c')
+    result.assert_outcomes(passed=3, failed=1, deselected=2)
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-matrix', 'envid', '--envid=a')
+    assert result.ret == 4
+    result.stderr.fnmatch_lines(["*`--envid` can not be used together with `--pilot-matrix envid`*"])
+
+
+@pytest.mark.parametrize("expr,results", [
+    ("envid == 'a'", dict(passed=2)),
+    ("envid in {a, b} and not slow", dict(passed=3)),
+    ("envid not in [a] or flavour == red", dict(passed=3)),
+    ("slow or not envid", dict(passed=3)),
+])
+def test_pilot_expr(testdir, expr, results):
+    """checks that --pilot-expr selects the tests correctly"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', mode='silos')
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                flavour = EasyMarker('flavour', allowed_values=('red', 'yellow'), mode='soft_filter')
+                                """))
+    testdir.makepyfile(dedent("""
+                              from conftest import envid, slow, flavour
+
+                              @envid('a')
+                              def test_a():
+                                  pass
+
+                              @envid('b')
+                              @flavour('red')
+                              def test_b_red():
+                                  pass
+
+                              @envid('a')
+                              @slow
+                              def test_a_slow():
+                                  pass
+
+                              @envid.agnostic
+                              def test_agnostic():
+                                  pass
+
+                              def test_nomark():
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-expr', expr)
+    result.assert_outcomes(**results)
+
+
+@pytest.mark.parametrize("expr,error", [
+    ("color == 'red'", "*'color' is not a known marker*"),
+    ("flavour == 'pink'", "*'pink' is not allowed for marker 'flavour'*"),
+    ("slow == 1", "*marker 'slow' has no argument*"),
+    ("flavour == ", "*Invalid `--pilot-expr flavour == `*"),
+])
+def test_pilot_expr_errors(testdir, expr, error):
+    """checks that invalid --pilot-expr are reported as usage errors"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                slow = EasyMarker('slow', has_arg=False, mode='extender')
+                                flavour = EasyMarker('flavour', allowed_values=('red', 'yellow'), mode='soft_filter')
+                                """))
+    result = testdir.runpytest(testdir.tmpdir, '--pilot-expr', expr)
+    assert result.ret == 4
+    result.stderr.fnmatch_lines([error])
+
+
+@pytest.mark.parametrize("query,results", [
+    ("a", dict(passed=2, deselected=4)),
+    ("a,b", dict(passed=4, deselected=2)),
+    ("@staging", dict(passed=4, deselected=2)),
+    ("b, @staging", dict(passed=5, deselected=1)),
+    ("@prod", "*Unknown group '@prod' for marker 'envid'*"),
+    ("a,pink", "*'pink' is not allowed for marker 'envid'*"),
+])
+def test_multi_value_queries(testdir, query, results):
+    """checks that queries can contain several values and named groups of values"""
+
+    testdir.makeconftest(dedent("""
+                                from pytest_pilot import EasyMarker
+
+                                envid = EasyMarker('envid', allowed_values=('a', 'b', 'c'), mode='silos')
+                                """))
+    testdir.makeini(dedent("""
+                           [pytest]
+                           pilot_groups =
+                               envid.staging = a, c
+                           """))
+    testdir.makepyfile(dedent("""
+                              from conftest import envid
+
+                              @envid('a')
+                              def test_a():
+                                  pass
+
+                              @envid('b')
+                              def test_b():
+                                  pass
+
+                              @envid('c')
+                              def test_c():
+                                  pass
+
+                              @envid('b')
+                              @envid('c')
+                              def test_b_or_c():
+                                  pass
+
+                              @envid.agnostic
+                              def test_agnostic():
+                                  pass
+
+                              def test_nomark():
+                                  pass
+                              """))
+
+    result = testdir.runpytest(testdir.tmpdir, '--envid=%s' % query)
+    if isinstance(results, dict):
+        result.assert_outcomes(**results)
+    else:
+        assert result.ret == 4
+        result.stderr.fnmatch_lines([results])
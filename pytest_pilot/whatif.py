@@ -0,0 +1,324 @@
+"""
+The `--pilot-what-if` option: the marks of all items are stored in a columnar table, with one column per EasyMarker,
+and the selection of many configurations of the marker options is then evaluated on the whole table at once.
+
+Each column stores, for each value of the marker, the set of items marked with it, as well as the set of items that
+have at least one mark and the set of agnostic items. These sets are bitsets (python integers where bit `i`
+corresponds to item `i`), so that the selection of a configuration is computed with a few bitwise operations per
+marker, instead of evaluating the markers on each item.
+"""
+from itertools import product
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, List, Optional, Tuple
+except ImportError:
+    pass
+
+from _pytest.config import UsageError
+
+from .pytest_marks import EasyMarker
+
+
+# the separator of the queries of a marker in the option, for example `envid=a|b|a,b`
+ALTERNATIVES_SEP = '|'
+
+
+def to_bitset(indices, nb_items):
+    # type: (Iterable[int], int) -> int
+    """Return the bitset containing `indices`"""
+    buf = bytearray((nb_items >> 3) + 1)
+    for i in indices:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bytes(buf), "little")
+
+
+def count_bits(bitset):
+    # type: (int) -> int
+    """Return the number of items in `bitset`"""
+    return bin(bitset).count("1")
+
+
+class MarkerColumn(object):
+    """
+    The column of a marker in a `MarksTable`.
+    """
+    __slots__ = 'marker', 'values', 'value_bits', 'marked', 'agnostic'
+
+    def __init__(self,
+                 marker,      # type: EasyMarker
+                 values,      # type: List
+                 value_bits,  # type: List[int]
+                 marked,      # type: int
+                 agnostic     # type: int
+                 ):
+        self.marker = marker
+        # the values used by items, by order of appearance, and the items marked with each of them
+        self.values = values
+        self.value_bits = value_bits
+        # the items with at least one non-agnostic mark, and the items with the agnostic mark
+        self.marked = marked
+        self.agnostic = agnostic
+
+    def get_compliant(self,
+                      query,       # type: Any
+                      groups,      # type: Optional[Dict[str, Tuple]]
+                      all_items    # type: int
+                      ):
+        # type: (...) -> int
+        """
+        Return the bitset of the items that are compliant with `query`. This is the vectorized equivalent of the
+        function created by `EasyMarker.compile_query`.
+
+        :param query: the query, as the value of the commandline option
+        :param groups: the named groups of values of this marker
+        :param all_items: the bitset of all items
+        :return:
+        """
+        marker = self.marker
+        unmarked = all_items & ~self.marked
+        if marker.is_no_query(query):
+            return unmarked if marker.not_filtering_skips_marked else all_items
+
+        if not marker.has_arg and not marker.filtering_skips_unmarked:
+            return all_items
+
+        # marked items: one matching value is enough
+        if marker.has_arg and not marker.is_all_query(query):
+            query_values = marker.parse_query(query, groups)
+            compliant = 0
+            for v, bits in zip(self.values, self.value_bits):
+                try:
+                    matches = v in query_values
+                except TypeError:
+                    # unhashable value
+                    matches = any(v == q for q in query_values)
+                if matches:
+                    compliant |= bits
+        else:
+            compliant = self.marked
+
+        # unmarked items
+        if marker.filtering_skips_unmarked:
+            compliant |= unmarked & self.agnostic
+        else:
+            compliant |= unmarked
+        return compliant
+
+
+class MarksTable(object):
+    """
+    The marks of all items, by columns. Use `MarksTable.create` to create it.
+    """
+    __slots__ = 'nodeids', 'columns', 'all_items'
+
+    def __init__(self, nodeids, columns):
+        self.nodeids = nodeids
+        # {marker_id: MarkerColumn}
+        self.columns = columns
+        self.all_items = (1 << len(nodeids)) - 1
+
+    @classmethod
+    def create(cls,
+               markers,  # type: Iterable[EasyMarker]
+               rows      # type: Iterable[Tuple[str, Dict[str, Tuple[List, bool]]]]
+               ):
+        # type: (...) -> MarksTable
+        """
+        Creates the table from the parsed marks of all items.
+
+        :param markers: the markers
+        :param rows: an iterable of (nodeid, {marker_id: (values, is_agnostic)}). Markers that are absent are
+            considered as not marked. This is the format of the records of the marks index.
+        :return:
+        """
+        markers = tuple(markers)
+        nodeids = []
+        # for each marker: the values, the item indices for each value, the marked indices and the agnostic indices
+        builders = [([], [], [], []) for _ in markers]
+        for i, (nodeid, parsed_marks) in enumerate(rows):
+            nodeids.append(nodeid)
+            for marker, (values, value_indices, marked, agnostic) in zip(markers, builders):
+                try:
+                    required_marks, is_agnostic = parsed_marks[marker.marker_id]
+                except KeyError:
+                    continue
+                if is_agnostic:
+                    agnostic.append(i)
+                if len(required_marks) == 0:
+                    continue
+                marked.append(i)
+                seen = []
+                for v in required_marks:
+                    if v in seen:
+                        continue
+                    seen.append(v)
+                    for code, known in enumerate(values):
+                        if known == v:
+                            value_indices[code].append(i)
+                            break
+                    else:
+                        values.append(v)
+                        value_indices.append([i])
+
+        nb_items = len(nodeids)
+        columns = dict()
+        for marker, (values, value_indices, marked, agnostic) in zip(markers, builders):
+            columns[marker.marker_id] = MarkerColumn(marker, values,
+                                                     [to_bitset(indices, nb_items) for indices in value_indices],
+                                                     to_bitset(marked, nb_items), to_bitset(agnostic, nb_items))
+        return cls(nodeids, columns)
+
+    def select(self,
+               queries,  # type: Dict[str, Any]
+               groups    # type: Dict[str, Dict[str, Tuple]]
+               ):
+        # type: (...) -> int
+        """
+        Return the bitset of the items that are compliant with all `queries`.
+
+        :param queries: a dictionary {marker_id: query}
+        :param groups: the named groups of values of all markers, see `read_query_groups`
+        :return:
+        """
+        selected = self.all_items
+        for marker_id, query in queries.items():
+            selected &= self.columns[marker_id].get_compliant(query, groups.get(marker_id), self.all_items)
+        return selected
+
+    def get_nodeids(self, bitset):
+        # type: (int) -> List[str]
+        """Return the node ids of the items in `bitset`"""
+        nodeids = self.nodeids
+        res = []
+        for byte_index, byte in enumerate(bitset.to_bytes((len(nodeids) >> 3) + 1, "little")):
+            while byte:
+                low = byte & -byte
+                res.append(nodeids[(byte_index << 3) + low.bit_length() - 1])
+                byte ^= low
+        return res
+
+
+class WhatIfGrid(object):
+    """
+    A parsed `--pilot-what-if` option: for each marker of the grid, the queries to evaluate. Use `parse_what_if` to
+    create it.
+    """
+    __slots__ = 'axes', 'groups'
+
+    def __init__(self,
+                 axes,    # type: List[Tuple[EasyMarker, Optional[List]]]
+                 groups   # type: Dict[str, Dict[str, Tuple]]
+                 ):
+        # a list of (marker, queries), where queries is None for "all possible queries"
+        self.axes = axes
+        self.groups = groups
+
+    @property
+    def marker_ids(self):
+        return tuple(m.marker_id for m, _ in self.axes)
+
+    def get_queries(self, marker, queries, table):
+        """Return the queries to use for `marker`, resolving the default ones from the table if needed"""
+        if queries is not None:
+            return queries
+        if not marker.has_arg:
+            return [False, True]
+        if marker.allowed_values is not None:
+            values = marker.allowed_values
+        else:
+            values = table.columns[marker.marker_id].values
+        # note: the values are used as is (a tuple is a valid query), so that non-string values match
+        return [None] + [(v,) for v in values]
+
+    def evaluate(self,
+                 table,         # type: MarksTable
+                 base_queries,  # type: Dict[str, Any]
+                 base=None      # type: int
+                 ):
+        # type: (...) -> List[Tuple[str, int]]
+        """
+        Evaluates all the configurations of the grid.
+
+        :param table: the marks of all items
+        :param base_queries: the queries {marker_id: query} of the other markers, applied to all configurations
+        :param base: an optional bitset of items that can be selected (for example the items matching `--pilot-expr`)
+        :return: a list of (description, bitset of selected items), one per configuration
+        """
+        selected = table.select(base_queries, self.groups)
+        if base is not None:
+            selected &= base
+
+        axes = []
+        for marker, queries in self.axes:
+            column = table.columns[marker.marker_id]
+            groups = self.groups.get(marker.marker_id)
+            axes.append([(_describe(marker, q), column.get_compliant(q, groups, table.all_items))
+                         for q in self.get_queries(marker, queries, table)])
+
+        results = []
+        for configuration in product(*axes):
+            bits = selected
+            for _, compliant in configuration:
+                bits &= compliant
+            results.append((" ".join(d for d, _ in configuration if d) or "(no option)", bits))
+        return results
+
+
+def _describe(marker, query):
+    """Return the commandline option corresponding to `query`"""
+    if marker.is_no_query(query):
+        return ""
+    elif not marker.has_arg:
+        return marker.cmdoption_long
+    elif isinstance(query, tuple):
+        query = ",".join(str(v) for v in query)
+    return "%s=%s" % (marker.cmdoption_long, query)
+
+
+def parse_what_if(sources,  # type: List[str]
+                  markers,  # type: Iterable[EasyMarker]
+                  groups    # type: Dict[str, Dict[str, Tuple]]
+                  ):
+    # type: (...) -> WhatIfGrid
+    """
+    Parses the `--pilot-what-if` options. Each option is either `<marker_id>`, to evaluate the marker option not set
+    and set to each of its allowed values (or each of the values used by items if there are no allowed values), or
+    `<marker_id>=<query>|<query>...` to evaluate some queries only, for example `envid=a|b|a,b|@staging`.
+
+    :param sources: the option values
+    :param markers: the available markers
+    :param groups: the named groups of values of all markers, see `read_query_groups`
+    :return:
+    :raises UsageError: if an option is invalid
+    """
+    markers_by_id = {m.marker_id: m for m in markers}
+    axes = []
+    seen = set()
+    for source in sources:
+        marker_id, _, alternatives = source.partition("=")
+        marker_id = marker_id.strip()
+        try:
+            marker = markers_by_id[marker_id]
+        except KeyError:
+            raise UsageError("Invalid `--pilot-what-if %s`: %r is not a known marker. Known markers are %s"
+                             % (source, marker_id, sorted(markers_by_id)))
+        if marker_id in seen:
+            raise UsageError("Invalid `--pilot-what-if %s`: marker %r is used several times" % (source, marker_id))
+        seen.add(marker_id)
+
+        if not alternatives:
+            queries = None
+        elif not marker.has_arg:
+            raise UsageError("Invalid `--pilot-what-if %s`: marker %r has no argument" % (source, marker_id))
+        else:
+            queries = [q.strip() for q in alternatives.split(ALTERNATIVES_SEP)]
+            for q in queries:
+                if marker.is_all_query(q):
+                    continue
+                try:
+                    marker.parse_query(q, groups.get(marker_id))
+                except ValueError as e:
+                    raise UsageError("Invalid `--pilot-what-if %s`: %s" % (source, e))
+        axes.append((marker, queries))
+
+    return WhatIfGrid(axes, groups)
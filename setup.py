@@ -16,7 +16,7 @@ from setuptools_scm import get_version  # noqa: E402
 INSTALL_REQUIRES = ['enum34;python_version<"3.4"']
 DEPENDENCY_LINKS = []
 SETUP_REQUIRES = ['pytest-runner', 'setuptools_scm']
-TESTS_REQUIRE = ['pytest', 'pytest-logging', 'pytest-harvest']
+TESTS_REQUIRE = ['pytest', 'pytest-logging', 'pytest-harvest', 'pytest-xdist']
 EXTRAS_REQUIRE = {}
 
 # ************** ID card *****************